@@ -0,0 +1,88 @@
+"""Memory and filter latency of store availability as sets vs. bitsets.
+
+    $ python -m benchmarks.availability [n_items]
+
+Every one of the synthetic stores has a third of `n_items` inventory items
+available. The product numbers are kept as one set of strings per store or
+as an `AvailabilityMatrix`, and the top 5 and the count of the items under
+a price cap are looked up at a single store and at any of three stores,
+by filtering with the sets and with a `RecommendationIndex` respectively.
+"""
+import gc
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Tuple
+
+from benchmarks.run import N_STORES
+from benchmarks.synthetic import load_fixtures, scale_inventory, \
+    scale_red_wines, scale_store_products
+from src.availability import AvailabilityMatrix
+from src.recommender import RecommendationIndex
+from src.systembolaget import InventoryItem
+
+N_QUERIES = 1000
+
+
+def traced(function: Callable) -> Tuple[Any, int]:
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def timed(function: Callable) -> float:
+    start = time.perf_counter()
+    function()
+    return (time.perf_counter() - start) / N_QUERIES
+
+
+def main() -> None:
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 13248
+    rng = random.Random(17)
+    red_wines, inventory = load_fixtures()
+    inventory = scale_inventory(
+        inventory, scale_red_wines(red_wines, 1000, rng), n_items, rng)
+    product_numbers = [item['ProductNumber'] for item in inventory]
+    # Product numbers parsed from the API are separate strings per store
+    store_products, sets_size = traced(lambda: {
+        store_name: {"".join(product) for product in products}
+        for (store_name, products)
+        in scale_store_products(inventory, N_STORES, rng).items()})
+    availability, bits_size = traced(
+        lambda: AvailabilityMatrix(store_products))
+    print(f"{N_STORES} stores, {len(product_numbers)} products\n"
+          f"  sets    {sets_size / 2 ** 20:8.1f} MiB\n"
+          f"  bitsets {bits_size / 2 ** 20:8.1f} MiB")
+
+    sorted_matches = [(InventoryItem(**item), 100, None)
+                      for item in rng.sample(inventory, len(inventory))]
+    index = RecommendationIndex(sorted_matches, availability)
+    store_names = list(store_products)
+    queries = [(rng.sample(store_names, k), rng.choice([100, 200, 400]))
+               for k in (1, 3) for _ in range(N_QUERIES)]
+
+    def filter_sets(stores, max_price):
+        available = [triple for triple in sorted_matches
+                     if triple[0].Price <= max_price and
+                     any(triple[0].ProductNumber in store_products[store]
+                         for store in stores)]
+        return available[:5], len(available)
+
+    for k in (1, 3):
+        k_queries = [query for query in queries if len(query[0]) == k]
+        sets_latency = timed(lambda: [filter_sets(*query)
+                                      for query in k_queries])
+        bits_latency = timed(lambda: [
+            (index.top(5, stores, max_price), index.count(stores, max_price))
+            for (stores, max_price) in k_queries])
+        print(f"any of {k} store{'s' if k > 1 else ''}\n"
+              f"  sets    {sets_latency * 1e6:8.1f} us/query\n"
+              f"  bitsets {bits_latency * 1e6:8.1f} us/query")
+
+
+if __name__ == "__main__":
+    main()
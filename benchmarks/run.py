@@ -0,0 +1,187 @@
+"""Benchmarks the loading, matching and query stages on synthetic data.
+
+    $ python -m benchmarks.run [--scales 10 100 full] [--output FILE]
+
+The fixtures in `tests/data` are scaled up to the given sizes, where `full`
+is the size of the whole GWS database. Wall time, items per second and the
+peak memory (traced in a separate run) are reported per stage and scale,
+and also written as JSON to `--output` so runs can be diffed. Matching is
+benchmarked with each of the `--engines`, by default with rapidfuzz too if
+it is installed.
+"""
+import argparse
+import gc
+import importlib.util
+import io
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, List, Tuple
+
+from benchmarks.synthetic import FULL_GWS_SIZE, load_fixtures, \
+    scale_inventory, scale_red_wines, scale_store_products
+from src.availability import AvailabilityMatrix
+from src.globalwinescore import GlobalWineScore
+from src.recommender import ENGINES, TIERS, Query, RecommendationIndex, \
+    TopMatches, answer_queries, assign_scorings, stream_top_matches, \
+    write_results
+from src.systembolaget import SystembolagetAPI
+
+N_STORES = 450
+N_QUERIES = 1000
+
+
+def measure(stage: str, n_items: int, function: Callable,
+            trace_memory: bool) -> Tuple[dict, Any]:
+    gc.collect()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+
+    peak_memory = None
+    if trace_memory:
+        gc.collect()
+        tracemalloc.start()
+        function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print(f"  {stage:26} {n_items:8} items {seconds:9.3f} s "
+          f"{n_items / seconds:11.0f} items/s"
+          + (f" {peak_memory / 2 ** 20:9.1f} MiB peak" if trace_memory
+             else ""), file=sys.stderr)
+    return {'stage': stage, 'items': n_items, 'seconds': seconds,
+            'items_per_second': n_items / seconds,
+            'peak_memory_bytes': peak_memory}, result
+
+
+def top_matches(matches: List[tuple], n: int, max_price: int) -> List[tuple]:
+    top = TopMatches(n, max_price=max_price)
+    for _ in stream_top_matches(matches, {'top': top}):
+        pass
+    return top.matches()
+
+
+def run_scale(scale: str, n_scores: int, cache_dir: Path,
+              engines: List[str], trace_memory: bool) -> List[dict]:
+    rng = random.Random(17)
+    red_wines, inventory = load_fixtures()
+    red_wines = scale_red_wines(red_wines, n_scores, rng)
+    inventory = scale_inventory(inventory, red_wines, n_scores // 2, rng)
+    store_products = scale_store_products(inventory, N_STORES, rng)
+
+    sb = SystembolagetAPI('api_token')
+    sb._inventory_file = cache_dir / f'sb_inventory_{scale}.json'
+    with sb._inventory_file.open('w') as file:
+        json.dump(inventory, file, indent=2, ensure_ascii=False)
+
+    gws = GlobalWineScore('api_token')
+    gws._wines_files['red'] = cache_dir / f'gws_red_wines_{scale}.json'
+    with gws._wines_files['red'].open('w') as file:
+        json.dump(red_wines, file, indent=2, ensure_ascii=False)
+
+    print(f"{scale}: {n_scores} scores, {len(inventory)} inventory items",
+          file=sys.stderr)
+    results = []
+
+    def stage(name: str, n_items: int, function: Callable):
+        result, value = measure(name, n_items, function, trace_memory)
+        results.append({'scale': scale, **result})
+        return value
+
+    inventory_items = stage('load_inventory', len(inventory),
+                            lambda: list(sb.get_inventory()))
+    scorings = stage('load_scores', n_scores, gws.get_red_wines)
+
+    red_wines = [item for item in inventory_items if item.is_red_wine()]
+    for engine in engines:
+        # The engines find the same matches
+        sorted_matches = stage(
+            'assign_scorings' + (f'[{engine}]' if engine != ENGINES[0]
+                                 else ''),
+            len(red_wines), lambda: sorted(
+                assign_scorings(red_wines, scorings, engine=engine,
+                                tiers=TIERS),
+                key=lambda triple: triple[2].score, reverse=True))
+
+    # The top 20 under SEK 400 of the matches in the order they are made, by
+    # sorting them all or by keeping a bounded heap
+    matches = rng.sample(sorted_matches, len(sorted_matches))
+    stage('sort_matches', len(matches), lambda: [
+        triple for triple in sorted(
+            matches, key=lambda triple: triple[2].score, reverse=True)
+        if int(triple[0].Price) <= 400][:20])
+    stage('top_matches', len(matches), lambda: top_matches(matches, 20, 400))
+
+    availability = stage('availability_matrix', len(store_products),
+                         lambda: AvailabilityMatrix(store_products))
+    index = stage('recommendation_index', len(sorted_matches),
+                  lambda: RecommendationIndex(sorted_matches, availability))
+
+    # Online, at a store or at any of three stores
+    store_names = list(store_products)
+    queries = [(rng.choice([None, rng.choice(store_names),
+                            rng.sample(store_names, 3)]),
+                rng.choice([None, 100, 200, 400, 1000]))
+               for _ in range(N_QUERIES)]
+    stage('recommend', len(queries), lambda: [
+        (index.top(5, store_name, max_price),
+         index.count(store_name, max_price))
+        for (store_name, max_price) in queries])
+
+    # As in a nightly batch of reports, written out as JSONL
+    batch_queries = [Query(i, 'red', store_name, max_price,
+                           rng.choice([None, 90, 95]), 10)
+                     for (i, (store_name, max_price)) in enumerate(queries)]
+    stage('answer_queries', len(batch_queries), lambda: write_results(
+        answer_queries(batch_queries, {'red': index}), io.StringIO()))
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', nargs='+', default=['10', '100', 'full'],
+                        help="scale factors of the fixtures, or 'full'")
+    parser.add_argument('--output', type=Path,
+                        help="file to write the results to as JSON")
+    parser.add_argument('--engines', nargs='+', choices=ENGINES,
+                        default=[engine for engine in ENGINES
+                                 if importlib.util.find_spec(engine)],
+                        help="matching engines to benchmark")
+    parser.add_argument('--skip-memory', action='store_true',
+                        help="skip the (slow) peak memory tracing runs")
+    args = parser.parse_args()
+
+    n_fixture_scores = len(load_fixtures()[0]['results'])
+    git_revision = subprocess.run(
+        ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+        text=True, cwd=Path(__file__).resolve().parent).stdout.strip()
+
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for scale in args.scales:
+            n_scores = FULL_GWS_SIZE if scale == 'full' \
+                else int(scale) * n_fixture_scores
+            results += run_scale(scale if scale == 'full' else f"{scale}x",
+                                 n_scores, Path(cache_dir), args.engines,
+                                 not args.skip_memory)
+
+    report = {'git_revision': git_revision,
+              'python': platform.python_version(),
+              'results': results}
+    if args.output:
+        with args.output.open('w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
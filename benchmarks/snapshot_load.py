@@ -0,0 +1,88 @@
+"""Cold-start load time and peak RSS of the JSON cache vs. the snapshots.
+
+    $ python -m benchmarks.snapshot_load [scale]
+
+The fixtures in `tests/data` are repeated `scale` times and every
+measurement runs in a fresh interpreter, so that nothing is warmed up.
+"""
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from src.globalwinescore import GWS_FIELDS, Scoring
+from src.snapshot import write_snapshot
+from src.systembolaget import INVENTORY_FIELDS, InventoryItem
+
+DATA_DIR = Path(__file__).resolve().parent.parent / 'tests' / 'data'
+
+LOAD_SCRIPT = '''
+import json, pickle, resource, sys, time
+from pathlib import Path
+from src.globalwinescore import Scoring
+from src.snapshot import read_snapshot
+from src.systembolaget import InventoryItem
+
+fmt, cache_dir = sys.argv[1], Path(sys.argv[2])
+start = time.perf_counter()
+if fmt == 'json':
+    with (cache_dir / 'gws_red_wines.json').open('r') as file:
+        scorings = [Scoring(**item) for item in json.load(file)['results']]
+    with (cache_dir / 'sb_inventory.json').open('r') as file:
+        inventory = [InventoryItem(**item) for item in json.load(file)]
+else:
+    _, scorings = read_snapshot(cache_dir / 'gws_red_wines.pickle',
+                                cache_dir / 'gws_red_wines.json', Scoring)
+    _, inventory = read_snapshot(cache_dir / 'sb_inventory.pickle',
+                                 cache_dir / 'sb_inventory.json',
+                                 InventoryItem)
+    scorings, inventory = list(scorings), list(inventory)
+elapsed = time.perf_counter() - start
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'seconds': elapsed, 'max_rss_kb': max_rss,
+                  'rows': len(scorings) + len(inventory)}))
+'''
+
+
+def prepare(cache_dir: Path, scale: int) -> None:
+    with (DATA_DIR / 'gws_red_wines.json').open('r') as file:
+        red_wines = json.load(file)
+    red_wines['results'] *= scale
+    with (DATA_DIR / 'sb_inventory.json').open('r') as file:
+        inventory = json.load(file) * scale
+
+    with (cache_dir / 'gws_red_wines.json').open('w') as file:
+        json.dump(red_wines, file, indent=2, ensure_ascii=False)
+    with (cache_dir / 'sb_inventory.json').open('w') as file:
+        json.dump(inventory, file, indent=2, ensure_ascii=False)
+
+    write_snapshot(cache_dir / 'gws_red_wines.pickle',
+                   (Scoring(**item) for item in red_wines['results']),
+                   GWS_FIELDS, count=red_wines['count'])
+    write_snapshot(cache_dir / 'sb_inventory.pickle',
+                   (InventoryItem(**item) for item in inventory),
+                   INVENTORY_FIELDS)
+
+
+def measure(fmt: str, cache_dir: Path) -> dict:
+    output = subprocess.run(
+        [sys.executable, '-c', LOAD_SCRIPT, fmt, str(cache_dir)],
+        cwd=DATA_DIR.parent.parent, check=True, capture_output=True,
+        text=True).stdout
+    return json.loads(output)
+
+
+def main() -> None:
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    with tempfile.TemporaryDirectory() as cache_dir:
+        prepare(Path(cache_dir), scale)
+        for fmt in ('json', 'snapshot'):
+            result = measure(fmt, Path(cache_dir))
+            print(f"{fmt:8} | {result['rows']:8} rows | "
+                  f"{result['seconds']:6.3f} s | "
+                  f"{result['max_rss_kb'] / 1024:7.1f} MiB max RSS")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import json
+import random
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+from src.globalwinescore import Scoring
+from src.systembolaget import InventoryItem
+
+DATA_DIR = Path(__file__).resolve().parent.parent / 'tests' / 'data'
+
+# Number of red wine scores in the full GWS database, as of April 2020
+FULL_GWS_SIZE = 26496
+
+WORDS = (
+    "Chateau Domaine Bodega Tenuta Vina Casa Clos Mas Cantina Weingut Estate "
+    "Reserva Riserva Gran Grand Cru Premier Vieilles Vignes Rosso Tinto Rouge "
+    "Cabernet Sauvignon Merlot Syrah Shiraz Pinot Noir Malbec Tempranillo "
+    "Sangiovese Nebbiolo Grenache Zinfandel Barolo Rioja Bordeaux Margaux "
+    "Pauillac Brunello Montalcino Chianti Classico Napa Valley Barossa "
+    "Mendoza Maipo Cornas Hermitage Saint Joseph Emilion Pomerol Ribera Duero "
+    "Priorat Toscana Piemonte Rhone Bourgogne Beaune Nuits Gevrey Chambertin "
+    "Alta Baja Norte Sur Vieux Nouveau Old New Hill Creek River Stone Oak"
+).split()
+
+
+def load_fixtures() -> Tuple[dict, List[dict]]:
+    with (DATA_DIR / 'gws_red_wines.json').open('r') as file:
+        red_wines = json.load(file)
+    with (DATA_DIR / 'sb_inventory.json').open('r') as file:
+        inventory = json.load(file)
+    return red_wines, inventory
+
+
+def scale_red_wines(red_wines: dict, n_scores: int,
+                    rng: random.Random) -> dict:
+    # Fixture scores with made up names, vintages and countries so that the
+    # (country, vintage) buckets fill up like they do in the real database
+    countries = Scoring.COUNTRY_LIST + ('Portugal', 'Germany', 'Austria')
+    results = []
+    for i in range(n_scores):
+        item = dict(red_wines['results'][i % len(red_wines['results'])])
+        wine = " ".join(rng.sample(WORDS, rng.randint(3, 6)))
+        item.update(
+            wine=f"{wine} {i}",
+            wine_id=i,
+            wine_slug=f"synthetic-{i}",
+            appellation=" ".join(rng.sample(WORDS, rng.randint(1, 3))),
+            country=rng.choice(countries),
+            vintage=str(rng.randint(1990, 2018)),
+            score=round(rng.uniform(80, 100), 2))
+        results.append(item)
+    return {'count': FULL_GWS_SIZE, 'next': None, 'previous': None,
+            'results': results}
+
+
+def scale_inventory(inventory: List[dict], red_wines: dict, n_items: int,
+                    rng: random.Random) -> List[dict]:
+    # About half of the red wines are named after a score, with words
+    # dropped, shuffled and misspelled, the rest are unlikely to match
+    template = next(item for item in inventory
+                    if InventoryItem(**item).is_red_wine())
+    swedish_names = {v: k for (k, v) in
+                     InventoryItem.COUNTRY_NAME_LANGUAGE_CONVERSION.items()}
+    items = []
+    for i in range(n_items):
+        if i % 5 == 4:
+            item = dict(inventory[i % len(inventory)])
+        else:
+            item = dict(template)
+            scoring = rng.choice(red_wines['results'])
+            if i % 2:
+                words = f"{scoring['wine']} {scoring['appellation']}".split()
+                rng.shuffle(words)
+                words = words[:rng.randint(2, len(words))]
+                if rng.random() < 0.5:
+                    position = rng.randrange(len(words))
+                    words[position] = words[position][:-1]
+            else:
+                words = rng.sample(WORDS, rng.randint(2, 5))
+            item.update(
+                ProductNameBold=" ".join(words[:2]),
+                ProductNameThin=" ".join(words[2:]),
+                Country=swedish_names.get(scoring['country'],
+                                          scoring['country']),
+                Vintage=int(scoring['vintage']))
+        item.update(ProductId=str(i), ProductNumber=str(i),
+                    ProductNumberShort=str(i),
+                    Price=float(rng.randint(59, 999)))
+        items.append(item)
+    return items
+
+
+def scale_store_products(inventory: List[dict], n_stores: int,
+                         rng: random.Random) -> Dict[str, Set[str]]:
+    product_numbers = [item['ProductNumber'] for item in inventory]
+    return {f"Store {i}": set(rng.sample(product_numbers,
+                                         len(product_numbers) // 3))
+            for i in range(n_stores)}
@@ -0,0 +1,76 @@
+from typing import Dict, Iterable, Iterator, Optional, Sequence
+
+
+def to_bits(positions: Iterable[int], size: int) -> int:
+    # Sets the bits through a byte array, shifting an int per bit would copy
+    # all of it every time
+    buffer = bytearray((size + 7) // 8)
+    for position in positions:
+        buffer[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def iter_bits(bits: int) -> Iterator[int]:
+    # Positions of the set bits, lowest first
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+def count_bits(bits: int) -> int:
+    return bin(bits).count('1')
+
+
+class AvailabilityMatrix:
+    # Which products are available in which stores. Products get dense IDs
+    # once and every store keeps its products as the bits of an int, so
+    # that stores are combined with bitwise operations.
+
+    def __init__(self, store_products: Dict[str, Iterable[str]]):
+        self._product_ids = {}
+        product_ids = {
+            store_name: [self._product_ids.setdefault(product,
+                                                      len(self._product_ids))
+                         for product in products]
+            for (store_name, products) in store_products.items()}
+        self._store_bits = {
+            store_name: to_bits(ids, len(self._product_ids))
+            for (store_name, ids) in product_ids.items()}
+
+    def __len__(self) -> int:
+        return len(self._product_ids)
+
+    def store_names(self) -> Iterable[str]:
+        return self._store_bits.keys()
+
+    def product_id(self, product_number: str) -> Optional[int]:
+        return self._product_ids.get(product_number)
+
+    def bits(self, *store_names: str) -> int:
+        # Products available in any of the stores
+        bits = 0
+        for store_name in store_names:
+            bits |= self._store_bits.get(store_name, 0)
+        return bits
+
+    def is_available(self, product_number: str, *store_names: str) -> bool:
+        product_id = self.product_id(product_number)
+        return product_id is not None and \
+            bool(self.bits(*store_names) >> product_id & 1)
+
+    def reindex(self, product_numbers: Sequence[str]) -> Dict[str, int]:
+        # The stores' bits over the positions of the given products instead
+        # of over the product IDs
+        product_ids = [self.product_id(product_number)
+                       for product_number in product_numbers]
+        n_bytes = (len(self) + 7) // 8
+        reindexed = {}
+        for store_name, bits in self._store_bits.items():
+            store_bytes = bits.to_bytes(n_bytes, 'little')
+            reindexed[store_name] = to_bits(
+                (position for (position, product_id) in enumerate(product_ids)
+                 if product_id is not None and
+                 store_bytes[product_id >> 3] >> (product_id & 7) & 1),
+                len(product_ids))
+        return reindexed
@@ -0,0 +1,183 @@
+import pickle
+import zlib
+from array import array
+from sys import intern
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from src.globalwinescore import Scoring
+from src.systembolaget import InventoryItem
+
+
+def _column(typecode: str, values: List) -> Sequence:
+    # Falls back to a list for columns with missing (None) values
+    try:
+        return array(typecode, values)
+    except TypeError:
+        return values
+
+
+class RowView:
+    # Reads its fields from the columns of a table, so that it can be used
+    # in place of the namedtuple the table was built from
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table: 'Table', index: int):
+        self._table, self._index = table, index
+
+    def __getattr__(self, name: str):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self._table.value(self._index, name)
+
+    def __iter__(self) -> Iterator:
+        return (self._table.value(self._index, name)
+                for name in self._table.fields)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (RowView, tuple)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(tuple(self))
+
+    def _asdict(self) -> dict:
+        return dict(zip(self._table.fields, self))
+
+
+class Table:
+    # Categorical columns are interned into codes, numeric columns are kept
+    # in arrays and the lazy columns are only decompressed when accessed
+    row_view: type = RowView
+
+    def __init__(self, row_type: type, rows: Iterable[tuple],
+                 categorical: Iterable[str] = (),
+                 numeric: Dict[str, str] = None,
+                 lazy: Iterable[str] = ()):
+        self.row_type = row_type
+        self.fields = row_type._fields
+        numeric = numeric or {}
+        categorical, lazy = list(categorical), list(lazy)
+        plain = [name for name in self.fields
+                 if name not in categorical and name not in numeric
+                 and name not in lazy]
+
+        values = {name: [] for name in self.fields}
+        self._lazy_fields = {name: i for (i, name) in enumerate(lazy)}
+        self._lazy_rows = []
+        self._categories = {name: {} for name in categorical}
+        for row in rows:
+            for name in categorical:
+                value = getattr(row, name)
+                codes = self._categories[name]
+                values[name].append(codes.setdefault(value, len(codes)))
+            for name in (*numeric, *plain):
+                values[name].append(getattr(row, name))
+            self._lazy_rows.append(zlib.compress(pickle.dumps(
+                tuple(getattr(row, name) for name in lazy),
+                pickle.HIGHEST_PROTOCOL)))
+
+        self._columns = {}
+        for name in categorical:
+            typecode = 'H' if len(self._categories[name]) <= 1 << 16 else 'L'
+            self._columns[name] = array(typecode, values[name])
+            self._categories[name] = list(self._categories[name])
+        for name, typecode in numeric.items():
+            self._columns[name] = _column(typecode, values[name])
+        for name in plain:
+            # Interned as the same names are repeated across the rows
+            self._columns[name] = [
+                intern(value) if isinstance(value, str) else value
+                for value in values[name]]
+
+    def __len__(self) -> int:
+        return len(self._lazy_rows)
+
+    def __getitem__(self, index: int) -> RowView:
+        if not -len(self) <= index < len(self):
+            raise IndexError(index)
+        return self.row_view(self, index % len(self))
+
+    def __iter__(self) -> Iterator[RowView]:
+        return map(self.row_view, [self] * len(self), range(len(self)))
+
+    def value(self, index: int, name: str):
+        if name in self._lazy_fields:
+            lazy_values = pickle.loads(
+                zlib.decompress(self._lazy_rows[index]))
+            return lazy_values[self._lazy_fields[name]]
+        try:
+            value = self._columns[name][index]
+        except KeyError:
+            raise AttributeError(name) from None
+        if name in self._categories:
+            return self._categories[name][value]
+        return value
+
+    def row(self, index: int) -> tuple:
+        return self.row_type(*self[index])
+
+
+class InventoryRow(RowView):
+    __slots__ = ()
+    COUNTRY_NAME_LANGUAGE_CONVERSION = \
+        InventoryItem.COUNTRY_NAME_LANGUAGE_CONVERSION
+    CATEGORY_COLORS = InventoryItem.CATEGORY_COLORS
+    is_red_wine = InventoryItem.is_red_wine
+    color = InventoryItem.color
+    fuzzy_name = InventoryItem.fuzzy_name
+    get_country = InventoryItem.get_country
+    get_url = InventoryItem.get_url
+    __str__ = InventoryItem.__str__
+    __repr__ = InventoryItem.__repr__
+
+
+class InventoryTable(Table):
+    row_view = InventoryRow
+
+    def __init__(self, inventory_items: Iterable[InventoryItem]):
+        super().__init__(
+            InventoryItem, inventory_items,
+            categorical=('Category', 'Country', 'Type', 'Style',
+                         'SubCategory', 'OriginLevel1', 'OriginLevel2',
+                         'BottleTextShort', 'Seal', 'AssortmentText',
+                         'Assortment'),
+            numeric={'Price': 'd', 'Volume': 'd', 'AlcoholPercentage': 'd',
+                     'RecycleFee': 'd', 'Vintage': 'l'},
+            lazy=('BeverageDescriptionShort', 'Usage', 'Taste',
+                  'EthicalLabel', 'SupplierName', 'SellStartDate'))
+
+
+class ScoringRow(RowView):
+    __slots__ = ()
+    COUNTRY_LIST = Scoring.COUNTRY_LIST
+    is_red_wine = Scoring.is_red_wine
+    fuzzy_name = Scoring.fuzzy_name
+    get_country = Scoring.get_country
+    get_url = Scoring.get_url
+    __str__ = Scoring.__str__
+    __repr__ = Scoring.__repr__
+
+
+class ScoringTable(Table):
+    row_view = ScoringRow
+
+    def __init__(self, scorings: Iterable[Scoring]):
+        super().__init__(
+            Scoring, scorings,
+            categorical=('color', 'wine_type', 'country', 'vintage',
+                         'confidence_index', 'appellation'),
+            numeric={'score': 'd', 'wine_id': 'l', 'journalist_count': 'l'},
+            lazy=('regions', 'classification', 'date', 'is_primeurs', 'lwin',
+                  'lwin_11', 'appellation_slug'))
+
+
+def compact_matches(
+        matches: Iterable[Tuple[InventoryItem, int, Scoring]]
+) -> List[Tuple[InventoryRow, int, ScoringRow]]:
+    # Same matches, in the same order, but backed by compact tables
+    matches = list(matches)
+    inventory_table = InventoryTable(item for (item, _, _) in matches)
+    scoring_table = ScoringTable(scoring for (_, _, scoring) in matches)
+    return [(inventory_table[i], certainty, scoring_table[i])
+            for (i, (_, certainty, _)) in enumerate(matches)]
@@ -0,0 +1,99 @@
+from heapq import heappush, heappushpop
+from math import cos, radians, sin
+from typing import Iterable, List, Optional, Tuple
+
+from geopy.distance import distance
+
+Point = Tuple[float, float, float]
+
+
+def to_unit_sphere(latitude: float, longitude: float) -> Point:
+    phi, theta = radians(latitude), radians(longitude)
+    return cos(phi) * cos(theta), cos(phi) * sin(theta), sin(phi)
+
+
+def _squared_chord(a: Point, b: Point) -> float:
+    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+
+
+class _Node:
+    __slots__ = ('axis', 'split', 'left', 'right', 'positions')
+
+    def __init__(self, axis: int = 0, split: float = 0.0,
+                 left: '_Node' = None, right: '_Node' = None,
+                 positions: Optional[List[int]] = None):
+        self.axis, self.split = axis, split
+        self.left, self.right = left, right
+        self.positions = positions
+
+
+class SiteIndex:
+    # A k-d tree over the sites as points on the unit sphere, where the chord
+    # distance orders them the same way as the great-circle distance does.
+    # Only the closest candidates are ranked by the exact geodesic distance.
+
+    def __init__(self, sites: Iterable[dict], leaf_size: int = 8):
+        self._sites = [site for site in sites
+                       if site.get('Position') is not None]
+        self._points = [to_unit_sphere(site['Position']['Lat'],
+                                       site['Position']['Long'])
+                        for site in self._sites]
+        self._leaf_size = leaf_size
+        self._root = self._build(list(range(len(self._sites))))
+
+    def __len__(self) -> int:
+        return len(self._sites)
+
+    def _build(self, positions: List[int]) -> _Node:
+        if len(positions) <= self._leaf_size:
+            return _Node(positions=positions)
+
+        # Splitting on the axis with the largest spread
+        spreads = [max(self._points[p][axis] for p in positions) -
+                   min(self._points[p][axis] for p in positions)
+                   for axis in range(3)]
+        axis = spreads.index(max(spreads))
+        positions.sort(key=lambda p: self._points[p][axis])
+        middle = len(positions) // 2
+        return _Node(axis, self._points[positions[middle]][axis],
+                     self._build(positions[:middle]),
+                     self._build(positions[middle:]))
+
+    def _search(self, node: _Node, point: Point, k: int,
+                heap: List[Tuple[float, int]]) -> None:
+        if node.positions is not None:
+            for position in node.positions:
+                item = (-_squared_chord(point, self._points[position]),
+                        position)
+                if len(heap) < k:
+                    heappush(heap, item)
+                elif item > heap[0]:
+                    heappushpop(heap, item)
+            return
+
+        offset = point[node.axis] - node.split
+        near, far = (node.right, node.left) if offset >= 0 \
+            else (node.left, node.right)
+        self._search(near, point, k, heap)
+        if len(heap) < k or offset ** 2 < -heap[0][0]:
+            self._search(far, point, k, heap)
+
+    def nearest_candidates(self, latitude: float, longitude: float,
+                           k: int) -> List[dict]:
+        heap = []
+        if self._sites and k > 0:
+            self._search(self._root, to_unit_sphere(latitude, longitude), k,
+                         heap)
+        return [self._sites[position]
+                for (_, position) in sorted(
+                    heap, key=lambda item: (-item[0], item[1]))]
+
+    def nearest(self, latitude: float, longitude: float,
+                k: int) -> List[dict]:
+        # The earth is not a perfect sphere, so a few extra candidates are
+        # re-ranked by the geodesic distance (which takes latitude first)
+        candidates = self.nearest_candidates(latitude, longitude, 2 * k + 2)
+        candidates.sort(key=lambda site: distance(
+            (latitude, longitude),
+            (site['Position']['Lat'], site['Position']['Long'])))
+        return candidates[:k]
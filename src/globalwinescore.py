@@ -1,14 +1,25 @@
 import json
 import logging
+import os
+import time
 from collections import namedtuple
+from datetime import timedelta
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, List, Tuple
 from urllib.parse import urlencode
 
 import requests
 
+from src.revalidation import conditional_headers, is_fresh, \
+    metadata_file, write_metadata
+from src.snapshot import read_snapshot, write_snapshot
+from src.stats import stats
+
 logger = logging.getLogger("GlobalWineScores")
 
+# Colors as named by the API, each with its own scores
+COLORS = ('red', 'white', 'rose')
+
 GWS_FIELDS = [
     "wine", "wine_id", "wine_slug", "appellation", "appellation_slug", "color",
     "wine_type", "regions", "country", "classification", "vintage", "date",
@@ -40,9 +51,44 @@ class Scoring(namedtuple("Scoring", GWS_FIELDS)):
         return self.__str__()
 
 
+class TokenBucket:
+
+    def __init__(self, requests_per_minute: float, capacity: int = 1,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self._rate = requests_per_minute / 60
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._clock, self._sleep = clock, sleep
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self._capacity,
+                           self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def acquire(self) -> None:
+        self._refill()
+        if self._tokens < 1:
+            self._sleep((1 - self._tokens) / self._rate)
+            self._refill()
+        self._tokens -= 1
+
+
 class GlobalWineScore:
+    # The API allows up to 10 requests per minute
+    REQUESTS_PER_MINUTE = 10
+    PAGE_SIZE = 10000
+    REFRESH_PAGE_SIZE = 100
+    MAX_RETRIES = 5
+    RETRY_BACKOFF = 6.0
+    # How long the scores are used before `refresh_wines` checks for newer
+    # ones, unless given another max age, e.g. the bot's refresh interval
+    MAX_AGE = timedelta(days=1)
 
-    def __init__(self, api_token: str):
+    def __init__(self, api_token: str, max_age: timedelta = MAX_AGE):
+        self._max_age = max_age
         self._api_url = \
             'https://api.globalwinescore.com/globalwinescores/latest/'
         self._headers = {
@@ -51,35 +97,205 @@ class GlobalWineScore:
         }
         self._cache_dir = Path(__file__).resolve().parent.parent / 'cache'
         self._cache_dir.mkdir(exist_ok=True)
-        self._red_wines_file = self._cache_dir / 'gws_red_wines.json'
+        # Every color is downloaded and cached on its own
+        self._wines_files = {color: self._cache_dir / f'gws_{color}_wines.json'
+                             for color in COLORS}
+        # Without bursts, a full bucket of 10 and the refills would allow
+        # about 19 requests in the first minute
+        self._rate_limiter = TokenBucket(self.REQUESTS_PER_MINUTE)
 
     def clear_cache(self) -> None:
         logger.info(f"Deleting cache files from '{self._cache_dir}'")
-        self._red_wines_file.unlink(missing_ok=True)
+        for cache_file in self._wines_files.values():
+            cache_file.unlink(missing_ok=True)
+            metadata_file(cache_file).unlink(missing_ok=True)
+            self._partial_file(cache_file).unlink(missing_ok=True)
+            self._snapshot_file(cache_file).unlink(missing_ok=True)
+
+    @staticmethod
+    def _snapshot_file(cache_file: Path) -> Path:
+        return cache_file.with_suffix('.pickle')
+
+    @staticmethod
+    def _partial_file(cache_file: Path) -> Path:
+        return cache_file.with_suffix('.partial')
+
+    def _get(self, url: str,
+             headers: Dict[str, str] = None) -> requests.Response:
+        for attempt in range(self.MAX_RETRIES + 1):
+            self._rate_limiter.acquire()
+            with stats.timed("download gws page"), \
+                    requests.get(url, headers={**self._headers,
+                                               **(headers or {})}) \
+                    as response:
+                retryable = response.status_code == 429 or \
+                    response.status_code >= 500
+                if not retryable or attempt == self.MAX_RETRIES:
+                    response.raise_for_status()
+                    return response
+
+                retry_after = response.headers.get('Retry-After', '')
+                delay = float(retry_after) if retry_after.isdecimal() \
+                    else self.RETRY_BACKOFF * 2 ** attempt
+                logger.warning(f"Got status {response.status_code} from "
+                               f"'{url}', retrying in {delay:.0f}s")
+                time.sleep(delay)
+
+    def _get_page(self, url: str) -> dict:
+        return self._get(url).json()
+
+    def _download_wines(self, color: str) -> None:
+        # Progress is kept in a partial file after every page, so that an
+        # interrupted download resumes from the last fetched page
+        cache_file = self._wines_files[color]
+        partial_file = self._partial_file(cache_file)
+        if partial_file.is_file():
+            with partial_file.open('r') as file:
+                wines = json.load(file)
+            logger.info(f"Resuming download of {color} wine scores after "
+                        f"{len(wines['results'])} scores")
+        else:
+            params = urlencode({
+                'color': color,
+                'limit': self.PAGE_SIZE,
+                'ordering': '-score'
+            })
+            wines = {'count': None, 'results': [],
+                     'next': self._api_url + f'?{params}'}
+
+        while wines['next']:
+            logger.info(f"Downloading {color} wine scores from "
+                        f"'{wines['next']}'")
+            page = self._get_page(wines['next'])
+            wines['count'] = page['count']
+            wines['results'] += page['results']
+            wines['next'] = page.get('next')
+
+            tmp_file = partial_file.with_suffix('.tmp')
+            with tmp_file.open('w') as file:
+                json.dump(wines, file, ensure_ascii=False)
+            os.replace(tmp_file, partial_file)
 
-    def _download_red_wines(self) -> None:
-        # As of mid April 2020 there are around 26.5k red wines in the database
+        # Scores can shift between pages while downloading
+        unique_results = {}
+        for item in wines['results']:
+            unique_results.setdefault((item['wine_id'], item['vintage']), item)
+        wines = {'count': wines['count'],
+                 'results': list(unique_results.values())}
+
+        self._write_wines(color, wines)
+        write_metadata(cache_file)
+        partial_file.unlink()
+
+    def _write_wines(self, color: str, wines: dict) -> None:
+        # Written to a temporary file first, so that an interrupted refresh
+        # never leaves truncated scores behind
+        cache_file = self._wines_files[color]
+        tmp_file = cache_file.with_name(cache_file.name + '.tmp')
+        with tmp_file.open('w') as file:
+            json.dump(wines, file, indent=2, ensure_ascii=False)
+        os.replace(tmp_file, cache_file)
+
+        write_snapshot(self._snapshot_file(cache_file),
+                       (Scoring(**item) for item in wines['results']),
+                       GWS_FIELDS, count=wines['count'])
+
+    def refresh_wines(self, color: str) -> Tuple[int, int]:
+        # Fetches the most recently dated scores until reaching scores older
+        # than the newest one in the cache, instead of downloading them all.
+        # Scores fetched less than max age ago are not refreshed at all, and
+        # neither are they if the first page has not changed since the last
+        # refresh.
+        cache_file = self._wines_files[color]
+        if not cache_file.is_file():
+            self._download_wines(color)
+            return len(self._load_wines(color)['results']), 0
+        if is_fresh(cache_file, self._max_age):
+            logger.info(f"{color.capitalize()} wine scores are up to date")
+            return 0, 0
+
+        wines = self._load_wines(color)
+        newest_date = max((item['date'] for item in wines['results']),
+                          default='')
         params = urlencode({
-            'color': 'red',
-            'limit': 10000,
-            'ordering': '-score'
+            'color': color,
+            'limit': self.REFRESH_PAGE_SIZE,
+            'ordering': '-date'
         })
-        red_wine_api_url = self._api_url + f'?{params}'
-        logger.info(f"Downloading red wine scores from '{red_wine_api_url}'")
+        url = self._api_url + f'?{params}'
+
+        logger.info(f"Refreshing {color} wine scores from '{url}'")
+        first_response = self._get(url, conditional_headers(cache_file))
+        if first_response.status_code == 304:
+            logger.info(f"{color.capitalize()} wine scores have not changed")
+            write_metadata(cache_file, first_response)
+            return 0, 0
+
+        new_results, page = [], first_response.json()
+        while True:
+            wines['count'] = page['count']
+            newer_results = [item for item in page['results']
+                             if item['date'] >= newest_date]
+            new_results += newer_results
 
-        with requests.get(red_wine_api_url, headers=self._headers) as response:
-            with self._red_wines_file.open('w') as file:
-                json.dump(response.json(), file, indent=2, ensure_ascii=False)
+            # Pages are ordered by date, so the rest are already cached
+            url = page.get('next')
+            if len(newer_results) < len(page['results']) or not url:
+                break
+            logger.info(f"Refreshing {color} wine scores from '{url}'")
+            page = self._get_page(url)
 
-    def _load_red_wines(self) -> dict:
-        if not self._red_wines_file.is_file():
-            self._download_red_wines()
+        results = {(item['wine_id'], item['vintage']): item
+                   for item in wines['results']}
+        added = updated = 0
+        for item in new_results:
+            key = (item['wine_id'], item['vintage'])
+            if key not in results:
+                added += 1
+            elif results[key] != item:
+                updated += 1
+            results[key] = item
 
-        with self._red_wines_file.open('r') as file:
+        if added or updated:
+            wines['results'] = sorted(
+                results.values(), key=lambda item: item['score'], reverse=True)
+            self._write_wines(color, wines)
+        write_metadata(cache_file, first_response)
+
+        logger.info(f"Refreshed {color} wine scores newer than {newest_date}, "
+                    f"{added} added and {updated} updated")
+        return added, updated
+
+    def refresh_red_wines(self) -> Tuple[int, int]:
+        return self.refresh_wines('red')
+
+    def _load_wines(self, color: str) -> dict:
+        cache_file = self._wines_files[color]
+        if not cache_file.is_file():
+            self._download_wines(color)
+
+        with stats.timed(f"load {cache_file.name}"), \
+                cache_file.open('r') as file:
             return json.load(file)
 
+    def get_wines(self, color: str) -> List[Scoring]:
+        cache_file = self._wines_files[color]
+        if not cache_file.is_file():
+            self._download_wines(color)
+
+        snapshot = read_snapshot(self._snapshot_file(cache_file), cache_file,
+                                 Scoring)
+        if snapshot is not None:
+            metadata, scorings = snapshot
+            scorings, count = list(scorings), metadata['count']
+        else:
+            wines = self._load_wines(color)
+            scorings = [Scoring(**item) for item in wines['results']]
+            count = wines['count']
+
+        logger.info(f"Loaded top {len(scorings)} {color} wine scores out of "
+                    f"{count} in database")
+        return scorings
+
     def get_red_wines(self) -> List[Scoring]:
-        red_wines = self._load_red_wines()
-        logger.info(f"Loaded top {len(red_wines['results'])} red wine "
-                    f"scores out of {red_wines['count']} in database")
-        return [Scoring(**item) for item in red_wines['results']]
+        return self.get_wines('red')
@@ -0,0 +1,354 @@
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from datetime import timedelta
+from hashlib import sha1
+from heapq import nlargest
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from fuzzywuzzy import fuzz, utils
+
+logger = logging.getLogger("Matching")
+
+Match = Tuple[str, int]
+Bucket = Tuple[str, str]
+
+CACHE_DIR = Path(__file__).resolve().parent.parent / 'cache'
+
+# Letters that are not decomposed into a base letter and an accent
+LETTER_FOLDING = str.maketrans({
+    'æ': 'ae', 'Æ': 'AE', 'œ': 'oe', 'Œ': 'OE', 'ø': 'o', 'Ø': 'O',
+    'ß': 'ss', 'đ': 'd', 'Đ': 'D', 'ł': 'l', 'Ł': 'L'})
+
+# Words describing the kind of producer rather than the wine, which one of
+# the sites often leaves out, e.g. 'Chateau Margaux' vs 'Margaux'
+PRODUCER_STOPWORDS = frozenset((
+    'ab', 'azienda', 'agricola', 'bodega', 'bodegas', 'cantina', 'cantine',
+    'caves', 'cellars', 'chateau', 'domaine', 'domaines', 'estate',
+    'estates', 'sa', 'srl', 'spa', 'tenuta', 'vineyard', 'vineyards',
+    'weingut', 'winery', 'wines'))
+
+# Bump whenever `normalize_name` changes, names normalized by other rules
+# (e.g. other stopwords) are not read from the cache file
+NORMALIZATION_VERSION = 2
+NORMALIZATION_RULES = sha1("\n".join([
+    str(NORMALIZATION_VERSION), json.dumps(LETTER_FOLDING, sort_keys=True),
+    *sorted(PRODUCER_STOPWORDS)]).encode()).hexdigest()
+
+
+def fold_name(name: str) -> str:
+    # Lowercase ASCII words, with accents folded (Viña -> vina) instead of
+    # dropping the non-ASCII letters like full_process does (Viña -> via)
+    folded = unicodedata.normalize('NFKD', name.translate(LETTER_FOLDING))
+    folded = folded.encode('ascii', 'ignore').decode('ascii')
+    return " ".join(re.sub(r'[^a-z0-9]+', ' ', folded.lower()).split())
+
+
+def normalize_name(name: str) -> str:
+    # Folds the name, then drops the stopwords unless that leaves less than
+    # two distinct words. 'Chateau Margaux, Margaux' reduced to 'margaux'
+    # would be a perfect token_set_ratio match for any wine from Margaux.
+    tokens = fold_name(name).split()
+    names = [token for token in tokens if token not in PRODUCER_STOPWORDS]
+    return " ".join(names if len(set(names)) >= 2 else tokens)
+
+
+def _read_cache(cache_file: Path) -> Optional[Any]:
+    # An unreadable cache, e.g. truncated by a crash, is the same as none
+    if not cache_file.is_file():
+        return None
+    try:
+        with cache_file.open('r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        logger.warning(f"Ignoring unreadable cache file '{cache_file}'")
+        return None
+
+
+def _write_cache(cache_file: Path, data: Any) -> None:
+    # Written to a temporary file first, so that a crash never leaves a
+    # truncated cache file
+    tmp_file = cache_file.with_name(cache_file.name + '.tmp')
+    with tmp_file.open('w') as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(tmp_file, cache_file)
+
+
+class NameNormalizer:
+    # Normalizes every name once, and across runs if given a cache file
+
+    def __init__(self, cache_file: Optional[Path] = None):
+        self._cache_file = cache_file
+        self._cached_names = {}
+        self._names = {}
+        cached = _read_cache(cache_file) if cache_file is not None else None
+        if isinstance(cached, dict) and \
+                cached.get('rules') == NORMALIZATION_RULES:
+            self._cached_names = cached['names']
+        elif cached is not None:
+            logger.info(f"Ignoring names in '{cache_file}' normalized by "
+                        f"other rules")
+
+    def __call__(self, name: str) -> str:
+        try:
+            return self._names[name]
+        except KeyError:
+            normalized = self._cached_names.get(name)
+            if normalized is None:
+                normalized = normalize_name(name)
+            self._names[name] = normalized
+            return normalized
+
+    def save(self) -> None:
+        # Only the names used in this run are kept
+        if self._cache_file is not None and \
+                self._names != self._cached_names:
+            _write_cache(self._cache_file, {'rules': NORMALIZATION_RULES,
+                                            'names': self._names})
+            self._cached_names = dict(self._names)
+
+
+class FuzzyKey:
+    __slots__ = ('name', 'processed', 'tokens', 'length', 'histogram')
+
+    def __init__(self, name: str):
+        self.name = name
+        # Same pre-processing as process.extractOne does for token_set_ratio
+        self.processed = utils.full_process(name, force_ascii=True)
+        self.tokens = frozenset(self.processed.split())
+        joined_tokens = " ".join(self.tokens)
+        self.length = len(joined_tokens)
+        self.histogram = Counter(joined_tokens)
+
+
+def token_set_ratio(query: FuzzyKey, candidate: FuzzyKey) -> int:
+    return fuzz.token_set_ratio(query.processed, candidate.processed,
+                                force_ascii=True, full_process=False)
+
+
+def token_set_ratio_upper_bound(query: FuzzyKey, candidate: FuzzyKey,
+                                floor: int = 0) -> int:
+    # token_set_ratio is the max of three ratios. The two involving the token
+    # intersection are exact given its length and the third is bounded by how
+    # many characters the (unique) token strings have in common.
+    if not query.tokens or not candidate.tokens:
+        return 0
+
+    bound = 0.0
+    intersection = query.tokens & candidate.tokens
+    if intersection:
+        sect_length = sum(map(len, intersection)) + len(intersection) - 1
+        bound = 2 * sect_length / (sect_length + min(query.length,
+                                                     candidate.length))
+
+    # Counting the characters in common is the costly part, so it is skipped
+    # if not even equally long token strings could reach the floor
+    total_length = query.length + candidate.length
+    length_bound = 2 * min(query.length, candidate.length) / total_length
+    if utils.intr(100 * length_bound) < floor:
+        return utils.intr(100 * max(bound, length_bound))
+
+    overlap = sum(min(count, candidate.histogram[char])
+                  for char, count in query.histogram.items())
+    bound = max(bound, 2 * overlap / total_length)
+    return utils.intr(100 * bound)
+
+
+class CandidateIndex:
+    # Postings scanned for the shortlist per comparison in the budget
+    POSTINGS_PER_COMPARISON = 100
+
+    def __init__(self, choices: Iterable[str]):
+        self._keys = [FuzzyKey(choice) for choice in choices]
+        # Number of full token_set_ratio comparisons made in `extract_one`
+        self.comparisons = 0
+        self._postings = defaultdict(list)
+        for position, key in enumerate(self._keys):
+            for token in key.tokens:
+                self._postings[token].append(position)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _shortlist(self, query: FuzzyKey, top_k: int,
+                   max_postings: Optional[int] = None) -> List[int]:
+        # Given `max_postings`, the rarest tokens are counted until that many
+        # postings are, as the most common ones say the least about a match
+        shared_tokens, scanned = Counter(), 0
+        for postings in sorted((self._postings.get(token, ())
+                                for token in query.tokens), key=len):
+            scanned += len(postings)
+            if max_postings is not None and scanned > max_postings:
+                break
+            shared_tokens.update(postings)
+        return nlargest(top_k, shared_tokens, key=shared_tokens.__getitem__)
+
+    def shortlist(self, query: str, top_k: int) -> List[str]:
+        return [self._keys[position].name
+                for position in self._shortlist(FuzzyKey(query), top_k)]
+
+    def extract_one(self, query: str, min_score: int = 0, top_k: int = 10,
+                    max_comparisons: Optional[int] = None) -> Optional[Match]:
+        # Gives the same result as process.extractOne with token_set_ratio
+        # whenever that result scores at least `min_score`. The shortlisted
+        # candidates set a floor that lets the remaining ones be skipped on
+        # their upper bound alone, without running the full comparison.
+        # With `max_comparisons` only that many of the candidates sharing the
+        # most tokens with the query are compared, at a bounded cost but no
+        # longer exact.
+        query_key = FuzzyKey(query)
+        if max_comparisons is not None:
+            return self._extract_within_budget(query_key, min_score,
+                                               max_comparisons)
+
+        scores = {position: token_set_ratio(query_key, self._keys[position])
+                  for position in self._shortlist(query_key, top_k)}
+        floor = max(min_score, *scores.values()) if scores else min_score
+        for position, key in enumerate(self._keys):
+            if position not in scores and token_set_ratio_upper_bound(
+                    query_key, key, floor) >= floor:
+                scores[position] = token_set_ratio(query_key, key)
+
+        return self._best(scores)
+
+    def _extract_within_budget(self, query_key: FuzzyKey, min_score: int,
+                               max_comparisons: int) -> Optional[Match]:
+        # Shortlisted candidates that cannot beat the best one so far are
+        # skipped on their upper bound and do not count against the budget
+        scores, floor = {}, min_score
+        for position in self._shortlist(
+                query_key, max_comparisons,
+                max_comparisons * self.POSTINGS_PER_COMPARISON):
+            key = self._keys[position]
+            if token_set_ratio_upper_bound(query_key, key, floor) >= floor:
+                scores[position] = token_set_ratio(query_key, key)
+                floor = max(floor, scores[position])
+        return self._best(scores)
+
+    def _best(self, scores: Dict[int, int]) -> Optional[Match]:
+        self.comparisons += len(scores)
+        if not scores:
+            return None
+
+        # Ties are resolved like process.extractOne, i.e. first choice wins
+        best = min(scores, key=lambda position: (-scores[position], position))
+        return self._keys[best].name, scores[best]
+
+
+def extract_best_batch(queries: List[str], choices: List[str],
+                       min_score: int, workers: int = 1
+                       ) -> List[Optional[Match]]:
+    # Scores all queries against all choices at once with rapidfuzz (an
+    # optional dependency, as is numpy), on `workers` threads (-1 for all
+    # cores). Gives the same result as `process.extractOne` with fuzzywuzzy's
+    # token_set_ratio whenever that scores at least `min_score`, else None.
+    import numpy as np
+    from rapidfuzz import fuzz as rapid_fuzz, process as rapid_process
+
+    if not queries or not choices:
+        return [None] * len(queries)
+
+    def full_process(names: List[str]) -> List[str]:
+        return [utils.full_process(name, force_ascii=True) for name in names]
+
+    # Scores are rounded like fuzzywuzzy does, before picking the first of
+    # the best ones, hence the cutoff half a point below the minimum
+    scores = np.rint(rapid_process.cdist(
+        full_process(queries), full_process(choices),
+        scorer=rapid_fuzz.token_set_ratio,
+        score_cutoff=max(0, min_score - 0.5), dtype=np.float64,
+        workers=workers))
+    best_matches = []
+    for query_scores in scores:
+        best = int(query_scores.argmax())
+        score = int(query_scores[best])
+        best_matches.append(
+            (choices[best], score) if score >= min_score else None)
+    return best_matches
+
+
+class MatchCache:
+    # Entries not used for `MAX_AGE` are dropped, the others are kept even
+    # if unused in a run, so that callers matching with other parameters
+    # (e.g. the bot and the command line) do not evict each other's entries
+    MAX_AGE = timedelta(days=30)
+
+    def __init__(self, cache_file: Optional[Path] = None):
+        if cache_file is None:
+            CACHE_DIR.mkdir(exist_ok=True)
+            cache_file = CACHE_DIR / 'match_cache.json'
+        self._cache_file = cache_file
+        self._now = int(time.time())
+        oldest = self._now - self.MAX_AGE.total_seconds()
+        # Entries written before they had a time of use count as used now
+        self._entries = {
+            key: [*entry[:3], entry[3] if len(entry) > 3 else self._now]
+            for (key, entry) in (_read_cache(cache_file) or {}).items()
+            if len(entry) == 3 or entry[3] >= oldest}
+        self._stored_entries = {}
+        self._fingerprints = {}
+        self.hits = self.misses = self.invalidations = 0
+        self._cached_items = {item_hash for (item_hash, _, _, _)
+                              in self._entries.values()}
+
+    def clear_cache(self) -> None:
+        logger.info(f"Deleting cache file '{self._cache_file}'")
+        self._cache_file.unlink(missing_ok=True)
+        self._entries, self._cached_items = {}, set()
+
+    def fingerprint_buckets(self, buckets: Dict[Bucket, Iterable[str]],
+                            fuzz_match_min_percentage: int,
+                            max_comparisons: Optional[int] = None) -> None:
+        # Best matches below the minimum certainty, or found within a budget
+        # of comparisons, are not exact when using the candidate index, hence
+        # both are part of the fingerprint
+        self._fingerprints = {}
+        for bucket, scoring_names in buckets.items():
+            content = "\n".join([str(fuzz_match_min_percentage),
+                                 *([] if max_comparisons is None
+                                   else [f"max {max_comparisons}"]),
+                                 *sorted(scoring_names)])
+            self._fingerprints[bucket] = sha1(content.encode()).hexdigest()
+
+    def _key(self, fuzzy_name: str, bucket: Bucket) -> Tuple[str, str]:
+        country, vintage = bucket
+        content = "\n".join([country, vintage, fuzzy_name])
+        item_hash = sha1(content.encode()).hexdigest()
+        return item_hash, f"{item_hash}:{self._fingerprints[bucket]}"
+
+    def lookup(self, fuzzy_name: str,
+               bucket: Bucket) -> Tuple[bool, Optional[Match]]:
+        item_hash, key = self._key(fuzzy_name, bucket)
+        if key in self._entries:
+            self.hits += 1
+            self._entries[key][3] = self._now
+            _, best_match_key, certainty, _ = self._entries[key]
+            if best_match_key is None:
+                return True, None
+            return True, (best_match_key, certainty)
+
+        if item_hash in self._cached_items:
+            self.invalidations += 1
+        else:
+            self.misses += 1
+        return False, None
+
+    def store(self, fuzzy_name: str, bucket: Bucket,
+              best_match: Optional[Match]) -> None:
+        item_hash, key = self._key(fuzzy_name, bucket)
+        best_match_key, certainty = best_match or (None, None)
+        self._stored_entries[key] = [item_hash, best_match_key, certainty,
+                                     self._now]
+
+    def save(self) -> None:
+        _write_cache(self._cache_file,
+                     {**self._entries, **self._stored_entries})
+
+    def stats(self) -> str:
+        return f"{self.hits} cache hits, {self.misses} misses and " \
+               f"{self.invalidations} invalidations"
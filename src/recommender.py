@@ -1,11 +1,28 @@
+import argparse
+import csv
+import heapq
+import json
 import os
 import logging
-from collections import defaultdict
-from typing import Iterable, Iterator, Tuple
+import math
+import multiprocessing
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import count, islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, \
+    TextIO, Tuple, Union
 
 from fuzzywuzzy import fuzz, process
 
-from src.globalwinescore import Scoring, GlobalWineScore
+from src.availability import AvailabilityMatrix, count_bits, iter_bits
+from src.globalwinescore import COLORS, Scoring, GlobalWineScore
+from src.matching import CACHE_DIR, Bucket, CandidateIndex, Match, \
+    MatchCache, NameNormalizer, extract_best_batch
+from src.stats import stats
 from src.systembolaget import InventoryItem, SystembolagetAPI
 
 logger = logging.getLogger("Recommender")
@@ -16,64 +33,789 @@ logging.basicConfig(
 
 Certainty = int
 ScoreAssignment = Tuple[InventoryItem, Certainty, Scoring]
+# Seconds spent and number of comparisons made matching a bucket
+BucketStats = Tuple[float, int]
+# A store, any of several stores or, with None, online
+StoreNames = Union[None, str, Sequence[str]]
+
+# fuzzywuzzy compares one name at a time and is kept as the reference,
+# rapidfuzz scores a whole bucket at once
+ENGINES = ('fuzzywuzzy', 'rapidfuzz')
+
+# Candidates are looked for in tiers, each one tried for the items left
+# unmatched by the previous ones: the item's own (country, vintage) bucket,
+# the buckets of the same country within `vintage_tolerance` years and all
+# the scorings. A tier compares an item with at most `max_comparisons`
+# candidates, those sharing the most tokens with it, or all if it is None.
+MatchTier = namedtuple("MatchTier", ["name", "max_comparisons"])
+TIER_NAMES = ('exact', 'adjacent_vintages', 'global')
+TIERS = (MatchTier('exact', None), MatchTier('adjacent_vintages', 50),
+         MatchTier('global', 20))
+
+# The matching processes are started by a server process rather than forked
+# from the caller, which may have threads running (e.g. the bot's), so that
+# none of them inherits a lock held by a thread that does not exist in it
+MATCHING_CONTEXT = multiprocessing.get_context('forkserver')
+
+
+class TierStats:
+    __slots__ = ('items', 'hits', 'comparisons')
+
+    def __init__(self):
+        self.items = self.hits = self.comparisons = 0
+
+    def __str__(self) -> str:
+        return f"{self.hits}/{self.items} matched with " \
+               f"{self.comparisons} comparisons"
+
+
+def _extract_one(
+        fuzzy_name: str, scoring_names: Iterable[str],
+        candidate_index: Optional[CandidateIndex],
+        fuzz_match_min_percentage: int, top_k: Optional[int],
+        max_comparisons: Optional[int]) -> Tuple[Optional[Match], int]:
+    # Also returns the number of comparisons it took
+    if candidate_index is None:
+        return process.extractOne(
+            fuzzy_name, scoring_names, scorer=fuzz.token_set_ratio), \
+            len(scoring_names)
+
+    comparisons = candidate_index.comparisons
+    best_match = candidate_index.extract_one(
+        fuzzy_name, fuzz_match_min_percentage, top_k, max_comparisons)
+    return best_match, candidate_index.comparisons - comparisons
+
+
+def _record_bucket_stats(bucket_stats: Dict[Bucket, BucketStats],
+                         tier_stats: TierStats) -> None:
+    for seconds, comparisons in bucket_stats.values():
+        stats.record("match bucket", seconds)
+        stats.count("match comparisons", comparisons)
+        tier_stats.comparisons += comparisons
+
+    if stats.enabled:
+        slowest = sorted(bucket_stats.items(), key=lambda item: item[1][0],
+                         reverse=True)[:5]
+        logger.info("Slowest buckets to match: " + ", ".join(
+            f"{country}/{vintage} {seconds:.3f}s ({comparisons} comparisons)"
+            for ((country, vintage), (seconds, comparisons)) in slowest))
+
+
+def _match_bucket(
+        fuzzy_names: List[str], scoring_names: List[str],
+        fuzz_match_min_percentage: int, top_k: Optional[int],
+        max_comparisons: Optional[int]
+) -> Tuple[List[Optional[Match]], BucketStats]:
+    # Runs in a worker process, so only plain strings are passed around
+    start = time.perf_counter()
+    candidate_index = CandidateIndex(scoring_names) \
+        if top_k is not None or max_comparisons is not None else None
+    best_matches, total_comparisons = [], 0
+    for fuzzy_name in fuzzy_names:
+        best_match, comparisons = _extract_one(
+            fuzzy_name, scoring_names, candidate_index,
+            fuzz_match_min_percentage, top_k, max_comparisons)
+        best_matches.append(best_match)
+        total_comparisons += comparisons
+    return best_matches, (time.perf_counter() - start, total_comparisons)
+
+
+def _match_serially(
+        inventory_items: Iterable[InventoryItem], fuzzy_scoring: dict,
+        fuzz_match_min_percentage: int, top_k: Optional[int],
+        max_comparisons: Optional[int], match_cache: Optional[MatchCache],
+        normalize: NameNormalizer, tier_stats: TierStats
+) -> Iterator[Tuple[InventoryItem, Optional[Match]]]:
+    # Built lazily per (country, vintage) bucket, `top_k=None` disables them
+    # (unless given a budget of comparisons) and falls back to comparing
+    # against every scoring in the bucket
+    use_index = top_k is not None or max_comparisons is not None
+    candidate_indexes = {}
+    bucket_stats = defaultdict(lambda: (0.0, 0))
+
+    for inventory_item in inventory_items:
+        country = inventory_item.get_country()
+        vintage = str(inventory_item.Vintage)
+        if not fuzzy_scoring[country][vintage]:
+            yield inventory_item, None
+            continue
+
+        fuzzy_name = normalize(inventory_item.fuzzy_name())
+        if match_cache is not None:
+            cached, best_match = match_cache.lookup(
+                fuzzy_name, (country, vintage))
+            if cached:
+                yield inventory_item, best_match
+                continue
+
+        start = time.perf_counter()
+        if use_index and (country, vintage) not in candidate_indexes:
+            candidate_indexes[country, vintage] = \
+                CandidateIndex(fuzzy_scoring[country][vintage].keys())
+
+        best_match, comparisons = _extract_one(
+            fuzzy_name, fuzzy_scoring[country][vintage].keys(),
+            candidate_indexes.get((country, vintage)),
+            fuzz_match_min_percentage, top_k, max_comparisons)
+        seconds, total_comparisons = bucket_stats[country, vintage]
+        bucket_stats[country, vintage] = (
+            seconds + time.perf_counter() - start,
+            total_comparisons + comparisons)
+
+        if match_cache is not None:
+            match_cache.store(fuzzy_name, (country, vintage), best_match)
+        yield inventory_item, best_match
+
+    _record_bucket_stats(bucket_stats, tier_stats)
+
+
+def _bucket_positions(
+        inventory_items: List[InventoryItem], fuzzy_names: List[str],
+        fuzzy_scoring: dict, match_cache: Optional[MatchCache],
+        best_matches: List[Optional[Match]]) -> Dict[Bucket, List[int]]:
+    # Positions of the items left to match per (country, vintage) bucket,
+    # the cached best matches are filled in right away
+    bucket_positions = defaultdict(list)
+    for position, inventory_item in enumerate(inventory_items):
+        country = inventory_item.get_country()
+        vintage = str(inventory_item.Vintage)
+        if not fuzzy_scoring[country][vintage]:
+            continue
+
+        if match_cache is not None:
+            cached, best_match = match_cache.lookup(
+                fuzzy_names[position], (country, vintage))
+            if cached:
+                best_matches[position] = best_match
+                continue
+
+        bucket_positions[country, vintage].append(position)
+    return bucket_positions
+
+
+def _match_in_parallel(
+        inventory_items: Iterable[InventoryItem], fuzzy_scoring: dict,
+        fuzz_match_min_percentage: int, top_k: Optional[int],
+        max_comparisons: Optional[int], match_cache: Optional[MatchCache],
+        normalize: NameNormalizer, tier_stats: TierStats, workers: int
+) -> Iterator[Tuple[InventoryItem, Optional[Match]]]:
+    inventory_items = list(inventory_items)
+    fuzzy_names = [normalize(inventory_item.fuzzy_name())
+                   for inventory_item in inventory_items]
+    best_matches = [None] * len(inventory_items)
+    bucket_stats = {}
+
+    # The (country, vintage) buckets are independent of each other, so every
+    # bucket is matched as a whole by one of the worker processes
+    bucket_positions = _bucket_positions(
+        inventory_items, fuzzy_names, fuzzy_scoring, match_cache,
+        best_matches)
+    position_buckets = {position: bucket
+                        for (bucket, positions) in bucket_positions.items()
+                        for position in positions}
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=MATCHING_CONTEXT) as executor:
+        futures = {
+            (country, vintage): executor.submit(
+                _match_bucket,
+                [fuzzy_names[p] for p in positions],
+                list(fuzzy_scoring[country][vintage].keys()),
+                fuzz_match_min_percentage, top_k, max_comparisons)
+            for ((country, vintage), positions) in bucket_positions.items()
+        }
+
+        # Same order as the serial path, i.e. the order of the inventory. An
+        # item is yielded as soon as its bucket has been matched, so that the
+        # matches can be used while the later buckets are still matching.
+        for position, inventory_item in enumerate(inventory_items):
+            bucket = position_buckets.get(position)
+            if bucket in futures:
+                bucket_matches, bucket_stats[bucket] = \
+                    futures.pop(bucket).result()
+                for bucket_position, best_match in zip(
+                        bucket_positions[bucket], bucket_matches):
+                    best_matches[bucket_position] = best_match
+                    if match_cache is not None:
+                        match_cache.store(fuzzy_names[bucket_position],
+                                          bucket, best_match)
+            yield inventory_item, best_matches[position]
+
+    _record_bucket_stats(bucket_stats, tier_stats)
+
+
+def _match_in_batches(
+        inventory_items: Iterable[InventoryItem], fuzzy_scoring: dict,
+        fuzz_match_min_percentage: int, match_cache: Optional[MatchCache],
+        normalize: NameNormalizer, tier_stats: TierStats,
+        workers: Optional[int]
+) -> Iterator[Tuple[InventoryItem, Optional[Match]]]:
+    inventory_items = list(inventory_items)
+    fuzzy_names = [normalize(inventory_item.fuzzy_name())
+                   for inventory_item in inventory_items]
+    best_matches = [None] * len(inventory_items)
+    bucket_stats = {}
+
+    # Every bucket is scored in a single call, on threads rather than
+    # processes as rapidfuzz does not hold the GIL while scoring
+    bucket_positions = _bucket_positions(
+        inventory_items, fuzzy_names, fuzzy_scoring, match_cache,
+        best_matches)
+    for (country, vintage), positions in bucket_positions.items():
+        start = time.perf_counter()
+        scoring_names = list(fuzzy_scoring[country][vintage].keys())
+        bucket_matches = extract_best_batch(
+            [fuzzy_names[p] for p in positions], scoring_names,
+            fuzz_match_min_percentage, workers or 1)
+        bucket_stats[country, vintage] = (
+            time.perf_counter() - start,
+            len(positions) * len(scoring_names))
+        for position, best_match in zip(positions, bucket_matches):
+            best_matches[position] = best_match
+            if match_cache is not None:
+                match_cache.store(fuzzy_names[position], (country, vintage),
+                                  best_match)
+
+    _record_bucket_stats(bucket_stats, tier_stats)
+    yield from zip(inventory_items, best_matches)
+
+
+def _vintage_distance(vintage: str, other: str) -> float:
+    # Non vintage wines are as far from any vintage as can be
+    if vintage.isdecimal() and int(vintage) and \
+            other.isdecimal() and int(other):
+        return abs(int(vintage) - int(other))
+    return 0 if vintage == other else math.inf
+
+
+class _FallbackTiers:
+    # The candidate indexes of the tiers after the exact one, built the first
+    # time they are needed. The same name may be scored for several vintages,
+    # then the score of the vintage closest to the item's is used.
+
+    def __init__(self, fuzzy_scoring: dict, vintage_tolerance: int):
+        self._fuzzy_scoring = fuzzy_scoring
+        self._vintage_tolerance = vintage_tolerance
+        self._indexes = {}
+
+    def _candidates(self, tier_name: str, country: str,
+                    vintage: str) -> Dict[str, List[Scoring]]:
+        buckets = []
+        if tier_name == 'global':
+            buckets = [bucket
+                       for country_buckets in self._fuzzy_scoring.values()
+                       for bucket in country_buckets.values()]
+        elif vintage.isdecimal() and int(vintage):
+            country_buckets = self._fuzzy_scoring.get(country, {})
+            for distance in range(1, self._vintage_tolerance + 1):
+                for year in (int(vintage) - distance,
+                             int(vintage) + distance):
+                    buckets.append(country_buckets.get(str(year), {}))
+
+        candidates = defaultdict(list)
+        for bucket in buckets:
+            for fuzzy_name, scoring in bucket.items():
+                candidates[fuzzy_name].append(scoring)
+        return candidates
+
+    def extract_one(self, tier: MatchTier, country: str, vintage: str,
+                    fuzzy_name: str, fuzz_match_min_percentage: int,
+                    tier_stats: TierStats
+                    ) -> Optional[Tuple[Certainty, Scoring]]:
+        key = (tier.name,) if tier.name == 'global' \
+            else (tier.name, country, vintage)
+        if key not in self._indexes:
+            candidates = self._candidates(tier.name, country, vintage)
+            self._indexes[key] = CandidateIndex(candidates), candidates
+        candidate_index, candidates = self._indexes[key]
+
+        best_match, comparisons = _extract_one(
+            fuzzy_name, candidates.keys(), candidate_index,
+            fuzz_match_min_percentage, tier.max_comparisons,
+            tier.max_comparisons)
+        tier_stats.comparisons += comparisons
+        if best_match is None or best_match[1] < fuzz_match_min_percentage:
+            return None
+        best_match_key, certainty = best_match
+        # The older of two equally close vintages
+        return certainty, min(
+            candidates[best_match_key],
+            key=lambda scoring: (_vintage_distance(vintage, scoring.vintage),
+                                 scoring.vintage))
 
 
 def assign_scorings(
         inventory_items: Iterable[InventoryItem], scorings: Iterable[Scoring],
-        fuzz_match_min_percentage: int = 90) -> Iterator[ScoreAssignment]:
+        fuzz_match_min_percentage: int = 90,
+        top_k: Optional[int] = 10,
+        workers: Optional[int] = None,
+        match_cache: Optional[MatchCache] = None,
+        name_normalizer: Optional[NameNormalizer] = None,
+        engine: str = 'fuzzywuzzy',
+        tiers: Sequence[MatchTier] = TIERS[:1],
+        vintage_tolerance: int = 1
+) -> Iterator[ScoreAssignment]:
+    # Names are compared in their normalized form, see `normalize_name`.
+    # With the rapidfuzz engine `top_k` and the budget of the exact tier are
+    # not used and `workers` are the number of threads to score with. Only
+    # the exact tier is parallel and cached, the others are bounded by their
+    # budgets instead. Only the exact tier is used unless given `tiers=TIERS`,
+    # as the other tiers take scores of other vintages or countries.
+    # In parallel, an item is yielded as soon as its bucket has been matched.
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', expected one of "
+                         f"{', '.join(ENGINES)}")
+    if not tiers or tiers[0].name != 'exact' or \
+            any(tier.name not in TIER_NAMES for tier in tiers):
+        raise ValueError(f"Tiers must start with the exact tier and be any "
+                         f"of {', '.join(TIER_NAMES)}")
+    exact_tier = tiers[0]
+    tier_stats = {tier.name: TierStats() for tier in tiers}
+    normalize = name_normalizer or NameNormalizer()
+
     # Optimising fuzzy match by pre-filtering GWS scores by country and vintage
     fuzzy_scoring = defaultdict(lambda: defaultdict(dict))
+    # Counted for the log, a color may have no scores or no items in stock
+    i = j = 0
     for i, scoring in enumerate(scorings, start=1):
         country, vintage = scoring.get_country(), scoring.vintage
-        fuzzy_scoring[country][vintage][scoring.fuzzy_name()] = scoring
+        fuzzy_scoring[country][vintage][normalize(scoring.fuzzy_name())] = \
+            scoring
+
+    if match_cache is not None:
+        match_cache.fingerprint_buckets(
+            {(country, vintage): bucket.keys()
+             for (country, buckets) in fuzzy_scoring.items()
+             for (vintage, bucket) in buckets.items()},
+            fuzz_match_min_percentage,
+            exact_tier.max_comparisons if engine == 'fuzzywuzzy' else None)
+
+    if engine == 'rapidfuzz':
+        best_matches = _match_in_batches(
+            inventory_items, fuzzy_scoring, fuzz_match_min_percentage,
+            match_cache, normalize, tier_stats['exact'], workers)
+    elif workers is None:
+        best_matches = _match_serially(
+            inventory_items, fuzzy_scoring, fuzz_match_min_percentage, top_k,
+            exact_tier.max_comparisons, match_cache, normalize,
+            tier_stats['exact'])
+    else:
+        best_matches = _match_in_parallel(
+            inventory_items, fuzzy_scoring, fuzz_match_min_percentage, top_k,
+            exact_tier.max_comparisons, match_cache, normalize,
+            tier_stats['exact'], workers)
 
+    fallback_tiers = _FallbackTiers(fuzzy_scoring, vintage_tolerance)
     matched_wines = 0
-    for j, inventory_item in enumerate(inventory_items, start=1):
-        fuzzy_name = inventory_item.fuzzy_name()
+    for j, (inventory_item, best_match) in enumerate(best_matches, start=1):
         country = inventory_item.get_country()
         vintage = str(inventory_item.Vintage)
-        if fuzzy_scoring[country][vintage]:
-            best_match_key, certainty = process.extractOne(
-                fuzzy_name, fuzzy_scoring[country][vintage].keys(),
-                scorer=fuzz.token_set_ratio)
+        tier_stats['exact'].items += 1
+        if best_match is not None and \
+                best_match[1] >= fuzz_match_min_percentage:
+            tier_stats['exact'].hits += 1
+            matched_wines += 1
+            best_match_key, certainty = best_match
+            yield inventory_item, certainty, \
+                fuzzy_scoring[country][vintage][best_match_key]
+            continue
 
-            if certainty >= fuzz_match_min_percentage:
+        fuzzy_name = normalize(inventory_item.fuzzy_name())
+        for tier in tiers[1:]:
+            tier_stats[tier.name].items += 1
+            fallback_match = fallback_tiers.extract_one(
+                tier, country, vintage, fuzzy_name,
+                fuzz_match_min_percentage, tier_stats[tier.name])
+            if fallback_match is not None:
+                tier_stats[tier.name].hits += 1
                 matched_wines += 1
-                scoring = fuzzy_scoring[country][vintage][best_match_key]
+                certainty, scoring = fallback_match
                 yield inventory_item, certainty, scoring
+                break
+
+    for name, tier_stat in tier_stats.items():
+        stats.count(f"match tier {name} items", tier_stat.items)
+        stats.count(f"match tier {name} hits", tier_stat.hits)
+        stats.count(f"match tier {name} comparisons", tier_stat.comparisons)
+
+    normalize.save()
+    cache_stats = ""
+    if match_cache is not None:
+        match_cache.save()
+        cache_stats = f" ({match_cache.stats()})"
 
     logger.info(f"{matched_wines}/{j} inventory items matched {i} scorings "
-                f"with minimum certainty of {fuzz_match_min_percentage}%")
+                f"with minimum certainty of {fuzz_match_min_percentage}%"
+                f"{cache_stats}")
+    logger.info("Matches per tier: " + ", ".join(
+        f"{name} {tier_stat}" for (name, tier_stat) in tier_stats.items()))
+
+
+def assign_scorings_by_color(
+        inventory_by_color: Dict[str, Iterable[InventoryItem]],
+        scorings_by_color: Dict[str, Iterable[Scoring]],
+        match_cache: Optional[MatchCache] = None,
+        name_normalizer: Optional[NameNormalizer] = None,
+        **kwargs
+) -> Dict[str, List[ScoreAssignment]]:
+    # Colors are matched one after the other against their own scores, all
+    # sharing the same normalized names and match cache. Matches of every
+    # color are sorted by score, highest first.
+    normalize = name_normalizer or NameNormalizer()
+    sorted_matches = {}
+    for color, inventory_items in inventory_by_color.items():
+        logger.info(f"Matching {color} wines")
+        with stats.timed(f"assign_scorings {color}"):
+            sorted_matches[color] = sorted(
+                assign_scorings(inventory_items, scorings_by_color[color],
+                                match_cache=match_cache,
+                                name_normalizer=normalize, **kwargs),
+                key=lambda triple: triple[2].score, reverse=True)
+    return sorted_matches
+
+
+class RecommendationIndex:
+    # Per store, the available matches as bits over their positions in score
+    # order, and per price the matches at most that expensive. A query ands
+    # the two and walks the lowest set bits until it has found enough
+    # matches, stores are combined by oring their bits. A minimum score
+    # keeps a prefix of the positions.
+
+    def __init__(self, sorted_matches: List[ScoreAssignment],
+                 availability: AvailabilityMatrix):
+        self._matches = sorted_matches
+        self._store_bits = availability.reindex(
+            [inventory_item.ProductNumber
+             for (inventory_item, _, _) in sorted_matches])
+        self._store_bits[None] = (1 << len(sorted_matches)) - 1
+        # Negated to be in ascending order for bisecting
+        self._negated_scores = array('d', (-float(scoring.score)
+                                           for (_, _, scoring)
+                                           in sorted_matches))
+
+        prices = [int(inventory_item.Price)
+                  for (inventory_item, _, _) in sorted_matches]
+        positions_by_price = sorted(range(len(prices)),
+                                    key=prices.__getitem__)
+        self._price_levels = array('l')
+        self._price_bits = []
+        buffer = bytearray((len(prices) + 7) // 8)
+        for i, position in enumerate(positions_by_price):
+            buffer[position >> 3] |= 1 << (position & 7)
+            price = prices[position]
+            if i + 1 == len(prices) or \
+                    prices[positions_by_price[i + 1]] != price:
+                self._price_levels.append(price)
+                self._price_bits.append(int.from_bytes(buffer, 'little'))
+
+    def __len__(self) -> int:
+        return len(self._matches)
+
+    def _bits(self, store_name: StoreNames, max_price: Optional[int],
+              min_score: Optional[float]) -> int:
+        if store_name is None or isinstance(store_name, str):
+            bits = self._store_bits.get(store_name, 0)
+        else:
+            bits = 0
+            for name in store_name:
+                bits |= self._store_bits.get(name, 0)
+        if max_price is not None:
+            level = bisect_right(self._price_levels, max_price)
+            bits &= self._price_bits[level - 1] if level else 0
+        if min_score is not None:
+            bits &= (1 << bisect_right(self._negated_scores, -min_score)) - 1
+        return bits
+
+    def count(self, store_name: StoreNames = None,
+              max_price: Optional[int] = None,
+              min_score: Optional[float] = None) -> int:
+        return count_bits(self._bits(store_name, max_price, min_score))
+
+    def top(self, n: Optional[int], store_name: StoreNames = None,
+            max_price: Optional[int] = None,
+            min_score: Optional[float] = None) -> List[ScoreAssignment]:
+        # `store_name=None` gives the matches available online, a list of
+        # store names the ones available in any of them, and `n=None` all
+        return [self._matches[position] for position in islice(
+            iter_bits(self._bits(store_name, max_price, min_score)), n)]
+
+
+class TopMatches:
+    # The best scored of the matches offered so far that pass the price cap,
+    # minimum score and, given an availability, are available at any of the
+    # stores. Kept in a min-heap of at most `n` matches, so that matches can
+    # be offered while they are being made without keeping them all.
+
+    def __init__(self, n: int, store_name: StoreNames = None,
+                 max_price: Optional[int] = None,
+                 min_score: Optional[float] = None,
+                 availability: Optional[AvailabilityMatrix] = None):
+        self.n = n
+        self.max_price = max_price
+        self.min_score = min_score
+        self.total = 0
+        self._heap = []
+        # Breaks ties of scores, the first offered ranking higher
+        self._offered = count()
+        self._availability = availability
+        self._store_bits = None
+        if availability is not None and store_name is not None:
+            self._store_bits = availability.bits(
+                *([store_name] if isinstance(store_name, str)
+                  else store_name))
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def _accepts(self, inventory_item: InventoryItem,
+                 scoring: Scoring) -> bool:
+        if self.max_price is not None and \
+                int(inventory_item.Price) > self.max_price:
+            return False
+        if self.min_score is not None and scoring.score < self.min_score:
+            return False
+        if self._store_bits is None:
+            return True
+        product_id = self._availability.product_id(
+            inventory_item.ProductNumber)
+        return product_id is not None and \
+            bool(self._store_bits >> product_id & 1)
+
+    def offer(self, match: ScoreAssignment) -> bool:
+        # Whether the match is among the top `n` so far
+        inventory_item, _, scoring = match
+        if self.n <= 0 or not self._accepts(inventory_item, scoring):
+            return False
+        self.total += 1
+        entry = (scoring.score, -next(self._offered), match)
+        if len(self._heap) < self.n:
+            heapq.heappush(self._heap, entry)
+            return True
+        return heapq.heappushpop(self._heap, entry) is not entry
+
+    def matches(self) -> List[ScoreAssignment]:
+        # Highest score first
+        return [match for (_, _, match) in sorted(self._heap, reverse=True)]
+
+
+def stream_top_matches(
+        matches: Iterable[ScoreAssignment], tops: Dict[Any, TopMatches]
+) -> Iterator[Tuple[Any, ScoreAssignment]]:
+    # Offers every match to each of the tops as it is made, e.g. by
+    # `assign_scorings`, yielding it with the key of every top it made it
+    # into so far. The final tops are complete once the matches are.
+    for match in matches:
+        for key, top in tops.items():
+            if top.offer(match):
+                yield key, match
+
+
+# A batch query, one JSON object per line with any of the fields below
+Query = namedtuple("Query", ["id", "color", "store", "max_price",
+                             "min_score", "limit"])
+QUERY_DEFAULTS = {'color': 'red', 'store': None, 'max_price': None,
+                  'min_score': None, 'limit': 10}
+RESULT_FIELDS = ['query', 'rank', 'total', 'score', 'certainty', 'price',
+                 'product_number', 'name', 'url', 'gws_wine', 'gws_url']
+OUTPUT_FORMATS = ('jsonl', 'csv')
+
+
+def _is_int(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _invalid_fields(query: Query) -> List[str]:
+    # Descriptions of the fields of the wrong type, checked up front so that
+    # an invalid query fails before downloading and matching
+    invalid = []
+    if query.color not in COLORS:
+        invalid.append(f"color '{query.color}', expected one of "
+                       f"{', '.join(COLORS)}")
+    if not (query.store is None or isinstance(query.store, str) or
+            isinstance(query.store, list) and
+            all(isinstance(store, str) for store in query.store)):
+        invalid.append("store, expected a name or a list of names")
+    if not (query.max_price is None or _is_int(query.max_price)):
+        invalid.append("max_price, expected an integer")
+    if not (query.min_score is None or _is_int(query.min_score) or
+            isinstance(query.min_score, float)):
+        invalid.append("min_score, expected a number")
+    if not (query.limit is None or
+            _is_int(query.limit) and query.limit >= 0):
+        invalid.append("limit, expected a non-negative integer")
+    return invalid
+
+
+def read_queries(file: TextIO) -> List[Query]:
+    # Queries without an id are identified by their line number
+    queries = []
+    for line_number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            fields = json.loads(line)
+        except ValueError as error:
+            raise ValueError(f"Invalid JSON in query on line {line_number}: "
+                             f"{error}") from error
+        if not isinstance(fields, dict):
+            raise ValueError(f"Query on line {line_number} is not a JSON "
+                             f"object")
+        unknown_fields = sorted(set(fields) - {'id', *QUERY_DEFAULTS})
+        if unknown_fields:
+            raise ValueError(f"Unknown fields {', '.join(unknown_fields)} "
+                             f"in query on line {line_number}")
+        query = Query(**{'id': line_number, **QUERY_DEFAULTS, **fields})
+        invalid_fields = _invalid_fields(query)
+        if invalid_fields:
+            raise ValueError(f"Invalid {'; '.join(invalid_fields)} in query "
+                             f"on line {line_number}")
+        queries.append(query)
+    return queries
+
+
+def answer_queries(queries: Iterable[Query],
+                   indexes: Dict[str, RecommendationIndex]) -> Iterator[dict]:
+    # One row per recommendation, in score order per query
+    for query in queries:
+        index = indexes[query.color]
+        total = index.count(query.store, query.max_price, query.min_score)
+        recommendations = index.top(query.limit, query.store,
+                                    query.max_price, query.min_score)
+        for rank, (inventory_item, certainty, scoring) in enumerate(
+                recommendations, start=1):
+            yield {'query': query.id, 'rank': rank, 'total': total,
+                   'score': scoring.score, 'certainty': certainty,
+                   'price': inventory_item.Price,
+                   'product_number': inventory_item.ProductNumber,
+                   'name': str(inventory_item),
+                   'url': inventory_item.get_url(),
+                   'gws_wine': str(scoring), 'gws_url': scoring.get_url()}
+
+
+def write_results(rows: Iterable[dict], file: TextIO,
+                  output_format: str = 'jsonl') -> int:
+    # Written as they are answered rather than collected first
+    n_rows = 0
+    if output_format == 'csv':
+        writer = csv.DictWriter(file, RESULT_FIELDS)
+        writer.writeheader()
+    for row in rows:
+        if output_format == 'csv':
+            writer.writerow(row)
+        else:
+            file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        n_rows += 1
+    return n_rows
+
+
+def load_availability(sb: SystembolagetAPI,
+                      sites: Iterable[dict]) -> AvailabilityMatrix:
+    sid_to_name = {site['SiteId']: site['Name'] for site in sites}
+    return AvailabilityMatrix({
+        sid_to_name[item['SiteId']]: [p['ProductNumber']
+                                      for p in item['Products']]
+        for item in sb.get_products_with_store()
+        if item['SiteId'] in sid_to_name
+    })
+
+
+def load_indexes(sb: SystembolagetAPI, gws: GlobalWineScore,
+                 colors: Iterable[str] = COLORS
+                 ) -> Dict[str, RecommendationIndex]:
+    # Downloads and matches once, for all the queries of the given colors
+    colors = list(colors)
+    sb.prefetch_all()
+    for color in colors:
+        gws.refresh_wines(color)
+
+    availability = load_availability(sb, sb.get_sites())
+    wines_by_color = sb.get_wines_by_color(stock_required=True)
+    sorted_matches = assign_scorings_by_color(
+        {color: wines_by_color[color] for color in colors},
+        {color: gws.get_wines(color) for color in colors},
+        workers=os.cpu_count(),
+        tiers=TIERS,
+        match_cache=MatchCache(),
+        name_normalizer=NameNormalizer(CACHE_DIR / 'normalized_names.json'))
+    return {color: RecommendationIndex(matches, availability)
+            for (color, matches) in sorted_matches.items()}
+
+
+def format_recommendation(match: ScoreAssignment) -> str:
+    inventory_item, certainty, scoring = match
+    return (f"Score: {scoring.score:.2f}% | "
+            f"SEK {int(inventory_item.Price):3} | "
+            f"{int(inventory_item.Volume):4}mL, "
+            f"{inventory_item.AlcoholPercentage:2.1f}% | "
+            f"{inventory_item} ({inventory_item.get_url()}) | "
+            f"{scoring} ({scoring.get_url()}) | "
+            f"{certainty:3d}% match")
+
+
+def print_red_wine_recommendations(sb: SystembolagetAPI,
+                                   gws: GlobalWineScore, n: int = 20) -> None:
+    sb.prefetch_all()
+    gws.refresh_red_wines()
+
+    print("Recommending red wines available online at Systembolaget.se "
+          "for a max price of SEK 400")
+    # Matches are printed to stderr as soon as they make it into the top,
+    # the final top to stdout once all inventory items have been matched
+    top = TopMatches(n, max_price=400, min_score=92)
+    matches = assign_scorings(
+        filter(lambda item: item.Price <= 400,
+               sb.get_red_wines(stock_required=True)),
+        filter(lambda scoring: scoring.score >= 92, gws.get_red_wines()),
+        workers=os.cpu_count(),
+        tiers=TIERS,
+        match_cache=MatchCache(),
+        name_normalizer=NameNormalizer(CACHE_DIR / 'normalized_names.json'))
+    for _, match in stream_top_matches(matches, {'red': top}):
+        print(f"Found {format_recommendation(match)}", file=sys.stderr,
+              flush=True)
+
+    print(f"Top {len(top)} out of {top.total} matches:")
+    for match in top.matches():
+        print(format_recommendation(match))
 
 
 def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Recommends wines available at Systembolaget by their "
+                    "scores on GlobalWineScore")
+    parser.add_argument('--queries', type=argparse.FileType('r'),
+                        help="JSONL file of queries to answer in one pass, "
+                             "'-' for stdin")
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout,
+                        help="file to write the recommendations to")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='jsonl',
+                        help="format of the recommendations")
+    parser.add_argument('--top', type=int, default=20,
+                        help="number of red wines to recommend without "
+                             "--queries")
+    args = parser.parse_args()
+
     SB_API_TOKEN = os.environ.get('SB_API_TOKEN')
     sb = SystembolagetAPI(SB_API_TOKEN)
 
     GWS_API_TOKEN = os.environ.get('GWS_API_TOKEN')
     gws = GlobalWineScore(GWS_API_TOKEN)
 
-    print("Recommending red wines available online at Systembolaget.se "
-          "for a max price of SEK 400")
-    sorted_red_wine_matches = sorted(
-        assign_scorings(
-            filter(lambda item: item.Price <= 400,
-                   sb.get_red_wines(stock_required=True)),
-            filter(lambda scoring: scoring.score >= 92,
-                   gws.get_red_wines())
-        ),
-        key=lambda triple: triple[2].score,
-        reverse=True
-    )
-
-    for (inventory_item, certainty, scoring) in sorted_red_wine_matches:
-        print(f"Score: {scoring.score:.2f}% | "
-              f"SEK {int(inventory_item.Price):3} | "
-              f"{int(inventory_item.Volume):4}mL, "
-              f"{inventory_item.AlcoholPercentage:2.1f}% | "
-              f"{inventory_item} ({inventory_item.get_url()}) | "
-              f"{scoring} ({scoring.get_url()}) | "
-              f"{certainty:3d}% match")
+    if args.queries is None:
+        print_red_wine_recommendations(sb, gws, args.top)
+        return
+
+    # Read up front, so that an invalid query fails before matching
+    with args.queries:
+        queries = read_queries(args.queries)
+    indexes = load_indexes(sb, gws, {query.color for query in queries})
+
+    start = time.perf_counter()
+    with args.output:
+        n_rows = write_results(answer_queries(queries, indexes), args.output,
+                               args.format)
+    print(f"Answered {len(queries)} queries with {n_rows} recommendations "
+          f"in {time.perf_counter() - start:.3f}s", file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Dict, Optional
+
+import requests
+
+logger = logging.getLogger("Revalidation")
+
+# Response headers kept to revalidate a cache file with the next request
+VALIDATORS = {'ETag': 'If-None-Match', 'Last-Modified': 'If-Modified-Since'}
+
+
+def metadata_file(cache_file: Path) -> Path:
+    return cache_file.with_suffix('.meta.json')
+
+
+def read_metadata(cache_file: Path) -> dict:
+    try:
+        with metadata_file(cache_file).open('r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_metadata(cache_file: Path,
+                   response: Optional[requests.Response] = None) -> None:
+    # A 304 response confirms the validators of the cached file, any other
+    # response replaces them
+    metadata = read_metadata(cache_file) \
+        if response is not None and response.status_code == 304 else {}
+    for header in VALIDATORS:
+        if response is not None and response.headers.get(header):
+            metadata[header] = response.headers[header]
+    metadata['fetched_at'] = time.time()
+
+    tmp_file = metadata_file(cache_file).with_suffix('.tmp')
+    with tmp_file.open('w') as file:
+        json.dump(metadata, file)
+    os.replace(tmp_file, metadata_file(cache_file))
+
+
+def is_fresh(cache_file: Path, max_age: timedelta) -> bool:
+    # The age of a cache file without metadata is unknown, so it is stale
+    fetched_at = read_metadata(cache_file).get('fetched_at')
+    return cache_file.is_file() and fetched_at is not None and \
+        time.time() - fetched_at < max_age.total_seconds()
+
+
+def conditional_headers(cache_file: Path) -> Dict[str, str]:
+    if not cache_file.is_file():
+        return {}
+    metadata = read_metadata(cache_file)
+    return {request_header: metadata[header]
+            for (header, request_header) in VALIDATORS.items()
+            if header in metadata}
@@ -0,0 +1,114 @@
+import logging
+import multiprocessing
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+logger = logging.getLogger("Serving")
+
+# Bump whenever the layout of the serving snapshot changes
+SERVING_SNAPSHOT_VERSION = 1
+
+# Called in a worker process with an update (as a dict) and the data, None
+# until there is a snapshot
+UpdateHandler = Callable[[dict, Optional[Any]], None]
+
+
+def write_serving_snapshot(snapshot_file: Path, data: Any) -> None:
+    # Written to a temporary file first, so that workers never read a
+    # partially written snapshot
+    tmp_file = snapshot_file.with_name(snapshot_file.name + '.tmp')
+    with tmp_file.open('wb') as file:
+        pickle.dump({'version': SERVING_SNAPSHOT_VERSION, 'data': data}, file,
+                    pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, snapshot_file)
+    logger.info(f"Wrote serving snapshot to '{snapshot_file}'")
+
+
+class ServingSnapshot:
+    # A worker process's own copy of the serving snapshot, loaded again once
+    # the file has been replaced by a newer snapshot
+
+    def __init__(self, snapshot_file: Path):
+        self._snapshot_file = snapshot_file
+        self._identity: Optional[Tuple[int, int]] = None
+        self._data = None
+
+    def get(self) -> Optional[Any]:
+        # None until the first snapshot has been written
+        try:
+            stat = self._snapshot_file.stat()
+        except FileNotFoundError:
+            return None
+        identity = (stat.st_ino, stat.st_mtime_ns)
+        if identity != self._identity:
+            with self._snapshot_file.open('rb') as file:
+                snapshot = pickle.load(file)
+            if snapshot['version'] != SERVING_SNAPSHOT_VERSION:
+                raise ValueError(f"Serving snapshot '{self._snapshot_file}' "
+                                 f"has version {snapshot['version']}, "
+                                 f"expected {SERVING_SNAPSHOT_VERSION}")
+            self._identity, self._data = identity, snapshot['data']
+            logger.info(f"Loaded serving snapshot in process {os.getpid()}")
+        return self._data
+
+
+def route_key(update: dict) -> int:
+    # Updates of the same chat go to the same worker, which keeps the chat's
+    # state (e.g. the chosen store) in memory
+    for kind in ('message', 'edited_message', 'channel_post'):
+        if kind in update:
+            return update[kind]['chat']['id']
+    return update['update_id']
+
+
+def _work(queue: multiprocessing.Queue, snapshot_file: Path,
+          handle: UpdateHandler) -> None:
+    snapshot = ServingSnapshot(snapshot_file)
+    for update in iter(queue.get, None):
+        try:
+            handle(update, snapshot.get())
+        except Exception:
+            logger.exception(f"Failed to handle update "
+                             f"{update.get('update_id')}")
+
+
+class WorkerPool:
+    # Dispatches updates to worker processes that all answer from the same
+    # serving snapshot, instead of each downloading and matching on its own
+
+    def __init__(self, snapshot_file: Path, handle: UpdateHandler,
+                 workers: int):
+        self._queues = [multiprocessing.Queue() for _ in range(workers)]
+        self._processes = [
+            multiprocessing.Process(target=_work,
+                                    args=(queue, snapshot_file, handle),
+                                    daemon=True)
+            for queue in self._queues]
+        for process in self._processes:
+            process.start()
+        logger.info(f"Started {workers} workers serving '{snapshot_file}'")
+
+    def dispatch(self, update: dict) -> None:
+        self._queues[route_key(update) % len(self._queues)].put(update)
+
+    def close(self) -> None:
+        # Lets the workers finish the updates already dispatched to them
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join()
+
+    def __enter__(self) -> 'WorkerPool':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def serve(updates: Iterable[dict], snapshot_file: Path,
+          handle: UpdateHandler, workers: int) -> None:
+    with WorkerPool(snapshot_file, handle, workers) as pool:
+        for update in updates:
+            pool.dispatch(update)
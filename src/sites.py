@@ -0,0 +1,74 @@
+from bisect import bisect_left
+from collections import Counter, defaultdict, namedtuple
+from datetime import date
+from heapq import nlargest
+from typing import Dict, Iterable, List, Optional, Set
+
+from src.matching import fold_name
+from src.systembolaget import SystembolagetAPI
+
+# A site with its opening hours already rendered, by date
+SiteEntry = namedtuple("SiteEntry", ["site", "opening_hours"])
+
+
+def trigrams(name: str) -> Set[str]:
+    # Padded so that the start of a name weighs more than its middle
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SiteDirectory:
+    # Sites by their folded name, so that choosing a store takes a dict
+    # lookup or two. Names that are not found get suggestions, first the
+    # names starting with it and then the ones sharing the most trigrams.
+    MIN_SIMILARITY = 0.3
+
+    def __init__(self, sites: Iterable[dict]):
+        self._entries: Dict[str, SiteEntry] = {}
+        for site in sites:
+            if not site['Name']:
+                continue
+            self._entries[fold_name(site['Name'])] = SiteEntry(site, {
+                date.fromisoformat(item['Date'][:10]):
+                    SystembolagetAPI.parse_opening_hours(item)
+                for item in site['OpeningHours']})
+
+        self._names = sorted(self._entries)
+        self._n_trigrams = {}
+        self._trigram_names = defaultdict(list)
+        for name in self._names:
+            name_trigrams = trigrams(name)
+            self._n_trigrams[name] = len(name_trigrams)
+            for trigram in name_trigrams:
+                self._trigram_names[trigram].append(name)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, name: str) -> Optional[SiteEntry]:
+        return self._entries.get(fold_name(name))
+
+    def suggest(self, name: str, n: int = 4) -> List[str]:
+        folded = fold_name(name)
+        if not folded:
+            return []
+
+        suggestions = []
+        position = bisect_left(self._names, folded)
+        while position < len(self._names) and len(suggestions) < n and \
+                self._names[position].startswith(folded):
+            suggestions.append(self._names[position])
+            position += 1
+
+        # Dice coefficient of the trigrams shared with every candidate
+        query = trigrams(folded)
+        shared = Counter(candidate for trigram in query
+                         for candidate in self._trigram_names.get(trigram, ()))
+        similar = nlargest(n, (
+            (2 * count / (len(query) + self._n_trigrams[candidate]), candidate)
+            for (candidate, count) in shared.items()
+            if candidate not in suggestions))
+        suggestions += [candidate for (similarity, candidate) in similar
+                        if similarity >= self.MIN_SIMILARITY]
+        return [self._entries[candidate].site['Name']
+                for candidate in suggestions[:n]]
@@ -0,0 +1,69 @@
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from src.stats import stats
+
+logger = logging.getLogger("Snapshot")
+
+# Bump whenever the layout of the snapshot files changes
+SNAPSHOT_VERSION = 1
+BATCH_SIZE = 1000
+
+
+def write_snapshot(snapshot_file: Path, rows: Iterable[tuple],
+                   fields: List[str], **metadata) -> int:
+    # The rows are pickled as plain tuples in batches, after a header with
+    # the schema, so they can be read back one batch at a time
+    tmp_file = snapshot_file.with_name(snapshot_file.name + '.tmp')
+    n_rows = 0
+    with tmp_file.open('wb') as file:
+        pickle.dump({'version': SNAPSHOT_VERSION, 'fields': list(fields),
+                     'metadata': metadata}, file, pickle.HIGHEST_PROTOCOL)
+        batch = []
+        for row in rows:
+            batch.append(tuple(row))
+            if len(batch) == BATCH_SIZE:
+                pickle.dump(batch, file, pickle.HIGHEST_PROTOCOL)
+                n_rows += len(batch)
+                batch = []
+        pickle.dump(batch, file, pickle.HIGHEST_PROTOCOL)
+        n_rows += len(batch)
+
+    os.replace(tmp_file, snapshot_file)
+    logger.info(f"Wrote snapshot of {n_rows} rows to '{snapshot_file}'")
+    return n_rows
+
+
+def _read_rows(file, row_type: type) -> Iterator[tuple]:
+    with file:
+        while True:
+            try:
+                batch = pickle.load(file)
+            except EOFError:
+                return
+            yield from map(row_type._make, batch)
+
+
+def read_snapshot(snapshot_file: Path, source_file: Path,
+                  row_type: type) -> Optional[Tuple[dict, Iterator[tuple]]]:
+    # Returns None, and the caller falls back to the source file, unless the
+    # snapshot is at least as new as its source and has the current schema
+    if not snapshot_file.is_file() or (
+            source_file.is_file() and
+            snapshot_file.stat().st_mtime < source_file.stat().st_mtime):
+        return None
+
+    file = snapshot_file.open('rb')
+    header = pickle.load(file)
+    if header.get('version') != SNAPSHOT_VERSION or \
+            header.get('fields') != list(row_type._fields):
+        logger.info(f"Ignoring snapshot '{snapshot_file}' with outdated "
+                    f"schema")
+        file.close()
+        return None
+
+    return header['metadata'], stats.timed_iter(
+        f"load {snapshot_file.name}", _read_rows(file, row_type))
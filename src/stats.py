@@ -0,0 +1,124 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import wraps
+from typing import Callable, Dict, Iterable, Iterator, List, TypeVar
+
+logger = logging.getLogger("Stats")
+
+T = TypeVar('T')
+
+# Latest samples kept per timer for the percentiles
+MAX_SAMPLES = 10000
+
+
+class Timer:
+    __slots__ = ('count', 'total', 'samples')
+
+    def __init__(self):
+        self.count, self.total = 0, 0.0
+        self.samples = deque(maxlen=MAX_SAMPLES)
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.samples.append(seconds)
+
+    def percentile(self, percent: float) -> float:
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1,
+                           int(percent / 100 * len(samples)))]
+
+
+class Stats:
+    # Opt-in, i.e. recording is a no-op unless enabled, either by calling
+    # `enable()` or by setting the environment variable WINE_TO_DINE_STATS
+
+    def __init__(self):
+        self.enabled = bool(os.environ.get('WINE_TO_DINE_STATS'))
+        self._lock = threading.Lock()
+        self._timers: Dict[str, Timer] = defaultdict(Timer)
+        self._counters: Dict[str, int] = defaultdict(int)
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def reset(self) -> None:
+        with self._lock:
+            self._timers.clear()
+            self._counters.clear()
+
+    def record(self, name: str, seconds: float) -> None:
+        if self.enabled:
+            with self._lock:
+                self._timers[name].add(seconds)
+
+    def count(self, name: str, n: int = 1) -> None:
+        if self.enabled:
+            with self._lock:
+                self._counters[name] += n
+
+    @contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed_iter(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        # Only the time spent producing the items is recorded, not the time
+        # the consumer spends in between
+        iterator, elapsed = iter(iterable), 0.0
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.record(name, elapsed + time.perf_counter() - start)
+                return
+            elapsed += time.perf_counter() - start
+            yield item
+
+    def timed_function(self, name: str) -> Callable:
+        def decorator(function: Callable) -> Callable:
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timed(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def report(self) -> str:
+        with self._lock:
+            lines: List[str] = []
+            for name, timer in sorted(self._timers.items()):
+                lines.append(
+                    f"{name}: n={timer.count} "
+                    f"total={timer.total:.3f}s "
+                    f"p50={timer.percentile(50) * 1000:.1f}ms "
+                    f"p90={timer.percentile(90) * 1000:.1f}ms "
+                    f"p99={timer.percentile(99) * 1000:.1f}ms")
+            for name, value in sorted(self._counters.items()):
+                lines.append(f"{name}: {value}")
+        return "\n".join(lines) or "No stats recorded"
+
+    def log_report(self) -> None:
+        logger.info(f"Stats of process {os.getpid()}:\n{self.report()}")
+
+    def log_periodically(self, interval: timedelta) -> None:
+        # For processes without a job queue, e.g. the bot's workers
+        def log() -> None:
+            while True:
+                time.sleep(interval.total_seconds())
+                self.log_report()
+        threading.Thread(target=log, daemon=True).start()
+
+
+stats = Stats()
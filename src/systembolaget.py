@@ -1,13 +1,24 @@
 import json
 import logging
+import os
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from pathlib import Path
-from typing import Iterator, List
+from typing import Any, Dict, Iterator, List, Optional, TextIO
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from src.revalidation import conditional_headers, is_fresh, \
+    metadata_file, write_metadata
+from src.snapshot import read_snapshot, write_snapshot
+from src.stats import stats
 
 logger = logging.getLogger("Systembolaget")
 
+CHUNK_SIZE = 1 << 16
+
 INVENTORY_FIELDS = [
     "ProductId", "ProductNumber", "ProductNameBold", "ProductNameThin",
     "Category", "ProductNumberShort", "ProducerName", "SupplierName",
@@ -35,9 +46,19 @@ class InventoryItem(namedtuple("InventoryItem", INVENTORY_FIELDS)):
         'USA': 'Usa'
     }
 
+    # Wine categories by their color as named by GlobalWineScore
+    CATEGORY_COLORS = {
+        'Röda viner': 'red',
+        'Vita viner': 'white',
+        'Roséviner': 'rose'
+    }
+
     def is_red_wine(self) -> bool:
         return self.Category == "Röda viner"
 
+    def color(self) -> Optional[str]:
+        return self.CATEGORY_COLORS.get(self.Category)
+
     def fuzzy_name(self) -> str:
         return f"{self.ProductNameBold} {self.ProductNameThin} " \
                f"{self.ProducerName}"
@@ -55,11 +76,65 @@ class InventoryItem(namedtuple("InventoryItem", INVENTORY_FIELDS)):
         return self.__str__()
 
 
+def iter_json_array(file: TextIO,
+                    chunk_size: int = CHUNK_SIZE) -> Iterator[Any]:
+    # Parses a top level JSON array one element at a time so that only the
+    # element being decoded, and not the whole document, is held in memory
+    decoder = json.JSONDecoder()
+    buffer, eof = file.read(chunk_size).lstrip(), False
+    if not buffer.startswith('['):
+        raise ValueError(f"Expected a JSON array in '{file.name}'")
+    buffer = buffer[1:]
+
+    while True:
+        buffer = buffer.lstrip()
+        if buffer.startswith(','):
+            buffer = buffer[1:].lstrip()
+        if buffer.startswith(']'):
+            return
+
+        try:
+            element, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            end = None
+
+        # An element running up to the end of the buffer may be truncated
+        if end is None or (end == len(buffer) and not eof):
+            # Growing the reads with the buffer keeps large elements linear
+            chunk = file.read(max(chunk_size, len(buffer)))
+            eof = not chunk
+            buffer += chunk
+            continue
+
+        yield element
+        buffer = buffer[end:]
+
+
 class SystembolagetAPI:
     _api_url = 'https://api-extern.systembolaget.se/'
+    # Seconds to wait for connecting and, then, in between received bytes
+    TIMEOUT = (10, 60)
+    SITES_ENDPOINT = 'site/v1/site'
+    INVENTORY_ENDPOINT = 'product/v1/product/'
+    PRODUCTS_WITH_STORE_ENDPOINT = 'product/v1/product/getproductswithstore'
+    # How long a cache file is used before it is revalidated by prefetch_all
+    MAX_AGE = {
+        SITES_ENDPOINT: timedelta(minutes=30),
+        INVENTORY_ENDPOINT: timedelta(minutes=30),
+        PRODUCTS_WITH_STORE_ENDPOINT: timedelta(minutes=30)
+    }
 
     def __init__(self, api_token: str):
-        self._headers = {'Ocp-Apim-Subscription-Key': api_token}
+        # A single session, with a connection per endpoint kept alive, for
+        # all downloads. Responses are gzipped unless the server refuses.
+        self._session = requests.Session()
+        self._session.headers.update({
+            'Ocp-Apim-Subscription-Key': api_token,
+            'Accept-Encoding': 'gzip'})
+        self._session.mount('https://', HTTPAdapter(pool_maxsize=3))
+        self._session.mount('http://', HTTPAdapter(pool_maxsize=3))
         self._cache_dir = Path(__file__).resolve().parent.parent / 'cache'
         self._cache_dir.mkdir(exist_ok=True)
         self._all_sites_file = self._cache_dir / 'systembolaget_all_sites.json'
@@ -69,74 +144,151 @@ class SystembolagetAPI:
 
     def clear_cache(self) -> None:
         logger.info(f"Deleting cache files from '{self._cache_dir}'")
-        self._all_sites_file.unlink(missing_ok=True)
-        self._inventory_file.unlink(missing_ok=True)
-        self._products_with_stores_file.unlink(missing_ok=True)
+        for cache_file in (self._all_sites_file, self._inventory_file,
+                           self._products_with_stores_file):
+            cache_file.unlink(missing_ok=True)
+            metadata_file(cache_file).unlink(missing_ok=True)
+        self._snapshot_file(self._inventory_file).unlink(missing_ok=True)
+
+    def _download(self, api_url: str, cache_file: Path) -> bool:
+        # The response body is written as is, without ever parsing it, to a
+        # temporary file that replaces the cache file once it is complete.
+        # Returns False if the cache file was still up to date.
+        tmp_file = cache_file.with_suffix('.tmp')
+        try:
+            with stats.timed(f"download {cache_file.name}"), \
+                    self._session.get(api_url, stream=True,
+                                      headers=conditional_headers(cache_file),
+                                      timeout=self.TIMEOUT) as response:
+                response.raise_for_status()
+                if response.status_code == 304:
+                    logger.info(f"'{cache_file.name}' is up to date")
+                    write_metadata(cache_file, response)
+                    return False
+
+                with tmp_file.open('wb') as file:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        file.write(chunk)
+            os.replace(tmp_file, cache_file)
+            write_metadata(cache_file, response)
+            return True
+        finally:
+            tmp_file.unlink(missing_ok=True)
+
+    def prefetch_all(self) -> None:
+        # Downloads, in parallel, the endpoints that are not cached yet or
+        # have been cached for longer than their max age, rather than one at
+        # a time when first loaded. Unchanged ones are not downloaded again.
+        downloads = [download for (endpoint, cache_file, download) in (
+            (self.SITES_ENDPOINT, self._all_sites_file,
+             self._download_all_sites),
+            (self.INVENTORY_ENDPOINT, self._inventory_file,
+             self._download_inventory),
+            (self.PRODUCTS_WITH_STORE_ENDPOINT,
+             self._products_with_stores_file,
+             self._download_products_with_store))
+            if not is_fresh(cache_file, self.MAX_AGE[endpoint])]
+        if not downloads:
+            return
+
+        with stats.timed("prefetch all"), \
+                ThreadPoolExecutor(len(downloads)) as executor:
+            for future in [executor.submit(download)
+                           for download in downloads]:
+                future.result()
+
+    @staticmethod
+    def _snapshot_file(cache_file: Path) -> Path:
+        return cache_file.with_suffix('.pickle')
+
+    @staticmethod
+    def _load(cache_file: Path) -> Iterator[dict]:
+        with cache_file.open('r', encoding='utf-8') as file:
+            yield from stats.timed_iter(f"load {cache_file.name}",
+                                        iter_json_array(file))
 
     def _download_all_sites(self) -> None:
-        api_url = self._api_url + 'site/v1/site'
+        api_url = self._api_url + self.SITES_ENDPOINT
         logger.info(f"Downloading info on sites from '{api_url}'")
-        with requests.get(api_url, headers=self._headers) as response:
-            response.raise_for_status()
-            with self._all_sites_file.open('w') as file:
-                json.dump(response.json(), file, indent=2, ensure_ascii=False)
+        self._download(api_url, self._all_sites_file)
 
-    def _load_all_sites(self) -> List[dict]:
+    def _load_all_sites(self) -> Iterator[dict]:
         if not self._all_sites_file.is_file():
             self._download_all_sites()
-        with self._all_sites_file.open('r') as file:
-            all_sites = json.load(file)
-        logger.info(f"Loaded {len(all_sites)} site info items")
-        return all_sites
+        i = 0
+        for i, site in enumerate(self._load(self._all_sites_file), start=1):
+            yield site
+        logger.info(f"Loaded {i} site info items")
 
     def get_sites(self) -> Iterator[dict]:
         yield from self._load_all_sites()
 
     def _download_products_with_store(self) -> None:
-        api_url = self._api_url + 'product/v1/product/getproductswithstore'
+        api_url = self._api_url + self.PRODUCTS_WITH_STORE_ENDPOINT
         logger.info(f"Downloading product-store availability from '{api_url}'")
-        with requests.get(api_url, headers=self._headers) as response:
-            response.raise_for_status()
-            with self._products_with_stores_file.open('w') as file:
-                json.dump(response.json(), file, indent=2, ensure_ascii=False)
+        self._download(api_url, self._products_with_stores_file)
 
-    def _load_products_with_store(self) -> List[dict]:
+    def _load_products_with_store(self) -> Iterator[dict]:
         if not self._products_with_stores_file.is_file():
             self._download_products_with_store()
-        with self._products_with_stores_file.open('r') as file:
-            products_with_store = json.load(file)
-        logger.info(f"Loaded {len(products_with_store)} product-store items")
-        return products_with_store
+        i = 0
+        for i, item in enumerate(self._load(self._products_with_stores_file),
+                                 start=1):
+            yield item
+        logger.info(f"Loaded {i} product-store items")
 
     def get_products_with_store(self) -> Iterator[dict]:
         yield from self._load_products_with_store()
 
     def _download_inventory(self) -> None:
-        api_url = self._api_url + 'product/v1/product/'
+        api_url = self._api_url + self.INVENTORY_ENDPOINT
         logger.info(f"Downloading inventory from '{api_url}'")
-        with requests.get(api_url, headers=self._headers) as response:
-            response.raise_for_status()
-            with self._inventory_file.open('w') as file:
-                json.dump(response.json(), file, indent=2, ensure_ascii=False)
+        snapshot_file = self._snapshot_file(self._inventory_file)
+        if self._download(api_url, self._inventory_file) or \
+                not snapshot_file.is_file():
+            write_snapshot(snapshot_file,
+                           (InventoryItem(**item)
+                            for item in self._load(self._inventory_file)),
+                           INVENTORY_FIELDS)
 
-    def _load_inventory(self) -> List[dict]:
+    def _load_inventory(self) -> Iterator[InventoryItem]:
         if not self._inventory_file.is_file():
             self._download_inventory()
-        with self._inventory_file.open('r') as file:
-            inventory = json.load(file)
-        logger.info(f"Loaded {len(inventory)} inventory items")
-        return inventory
+
+        snapshot = read_snapshot(self._snapshot_file(self._inventory_file),
+                                 self._inventory_file, InventoryItem)
+        if snapshot is not None:
+            _, inventory = snapshot
+        else:
+            inventory = (InventoryItem(**item)
+                         for item in self._load(self._inventory_file))
+
+        i = 0
+        for i, inventory_item in enumerate(inventory, start=1):
+            yield inventory_item
+        logger.info(f"Loaded {i} inventory items")
 
     def get_inventory(self, stock_required=False) -> Iterator[InventoryItem]:
-        for item in self._load_inventory():
-            if not stock_required or not item['IsCompletelyOutOfStock']:
-                yield InventoryItem(**item)
+        for inventory_item in self._load_inventory():
+            if not stock_required or \
+                    not inventory_item.IsCompletelyOutOfStock:
+                yield inventory_item
 
     def get_red_wines(self, stock_required=False) -> Iterator[InventoryItem]:
         for inventory_item in self.get_inventory(stock_required):
             if inventory_item.is_red_wine():
                 yield inventory_item
 
+    def get_wines_by_color(self, stock_required=False) \
+            -> Dict[str, List[InventoryItem]]:
+        # Partitions the inventory in a single pass instead of one per color
+        wines = {color: [] for color in InventoryItem.CATEGORY_COLORS.values()}
+        for inventory_item in self.get_inventory(stock_required):
+            color = inventory_item.color()
+            if color is not None:
+                wines[color].append(inventory_item)
+        return wines
+
     @staticmethod
     def parse_opening_hours(opening_hours: dict) -> str:
         if opening_hours['IsOpen']:
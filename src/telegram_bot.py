@@ -1,19 +1,40 @@
 import os
 import logging
-from datetime import date, timedelta
-
-from geopy.distance import distance
-from telegram import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+import threading
+import time
+from collections import namedtuple
+from datetime import timedelta
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+from telegram import Bot, KeyboardButton, ReplyKeyboardMarkup, \
+    ReplyKeyboardRemove, Update
 from telegram.ext import Updater, CommandHandler, CallbackContext, \
-    DispatcherHandlerStop, MessageHandler, Filters
+    Dispatcher, DispatcherHandlerStop, MessageHandler, Filters, TypeHandler
 
-from src.globalwinescore import GlobalWineScore
+from src.globalwinescore import COLORS, GlobalWineScore
 from src.systembolaget import SystembolagetAPI
-from src.recommender import assign_scorings
+from src.serving import WorkerPool, write_serving_snapshot
+from src.stats import stats
 
 logger = logging.getLogger("TelegramBot")
 logging.getLogger().setLevel(logging.INFO)
 
+REFRESH_INTERVAL = timedelta(
+    minutes=int(os.environ.get('REFRESH_INTERVAL_MINUTES', 60)))
+STATS_LOG_INTERVAL = timedelta(
+    minutes=int(os.environ.get('STATS_LOG_INTERVAL_MINUTES', 15)))
+ADMIN_USER_IDS = {
+    int(user_id) for user_id in os.environ.get('ADMIN_USER_IDS', '').split(',')
+    if user_id}
+# With more than one worker, updates are answered by that many processes,
+# each loading its own copy of the recommendation data from a serving
+# snapshot
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 1))
+SERVING_SNAPSHOT_FILE = \
+    Path(__file__).resolve().parent.parent / 'cache' / 'serving.pickle'
+
 START_MSG = (
     "Hi! You can use me find highly rated wines from Systembolaget. "
     "If you want to filter the recommendations by store availability, run"
@@ -23,7 +44,9 @@ START_MSG = (
     "location in order to find a nearby store for you.\n\n"
     "If you don't care about store availability, you can instead type"
     "\n\n```  /recommend_red_wines <max_price>```\n\n"
-    "where `max_price` is an optional maximal price in SEK."
+    "where `max_price` is an optional maximal price in SEK. White and rosé "
+    "wines are recommended with /recommend_white_wines and "
+    "/recommend_rose_wines in the same way."
 )
 
 HELP_MSG = "\n".join((
@@ -31,9 +54,33 @@ HELP_MSG = "\n".join((
     "/set_store <store_name> - picks a preferred store to base suggestions on",
     "/clear_store - clears the preferred store",
     "/recommend_red_wines <max_price> - recommends top 5 red wines available",
+    "/recommend_white_wines <max_price> - recommends top 5 white wines "
+    "available",
+    "/recommend_rose_wines <max_price> - recommends top 5 rosé wines "
+    "available",
     "/help - this message",
 ))
 
+WARMING_UP_MSG = (
+    "I'm still warming up, fetching the latest inventory and wine scores. "
+    "Please try again in a minute!"
+)
+UNKNOWN_OPENING_HOURS = "Opening hours unknown"
+
+
+def requires_data(handler: Callable) -> Callable:
+    # Commands that need the recommendation data reply that the bot is
+    # warming up until it has been loaded
+    @wraps(handler)
+    def wrapper(update, context: CallbackContext):
+        if app is None or app.preloaded is None:
+            logger.info(f"cmd '{update.message.text}' by "
+                        f"{update.message.from_user} while warming up")
+            update.message.reply_text(WARMING_UP_MSG)
+            return
+        return handler(update, context)
+    return wrapper
+
 
 def start_cmd(update, context: CallbackContext):
     logger.info(f"cmd '{update.message.text}' by {update.message.from_user}")
@@ -61,6 +108,8 @@ def clear_store(update, context: CallbackContext):
             reply_markup=ReplyKeyboardRemove())
 
 
+@stats.timed_function("cmd set_store")
+@requires_data
 def set_store(update, context: CallbackContext):
     logger.info(f"cmd '{update.message.text}' by {update.message.from_user}")
 
@@ -75,13 +124,24 @@ def set_store(update, context: CallbackContext):
         raise DispatcherHandlerStop
 
     store_name = " ".join(context.args)
-    if store_name.lower() not in sites_as_dict:
-        update.message.reply_text(
-            f"Store name '{store_name}' not recognised, please try again.",
-            reply_markup=ReplyKeyboardRemove())
+    site_directory = app.preloaded.site_directory
+    entry = site_directory.lookup(store_name)
+    if entry is None:
+        suggestions = site_directory.suggest(store_name)
+        if not suggestions:
+            update.message.reply_text(
+                f"Store name '{store_name}' not recognised, please try again.",
+                reply_markup=ReplyKeyboardRemove())
+        else:
+            update.message.reply_text(
+                f"Store name '{store_name}' not recognised, did you mean any "
+                f"of these?", reply_markup=ReplyKeyboardMarkup(
+                    [[KeyboardButton(text=f"/set_store {name}")]
+                     for name in suggestions] +
+                    [[KeyboardButton(text="Cancel")]], one_time_keyboard=True))
         raise DispatcherHandlerStop
 
-    site = sites_as_dict[store_name.lower()]
+    site = entry.site
     context.chat_data['store_name'] = site['Name']
 
     update.message.reply_text(
@@ -90,28 +150,24 @@ def set_store(update, context: CallbackContext):
     update.message.reply_location(
         longitude=site['Position']['Long'], latitude=site['Position']['Lat'])
 
-    opening_hours = {date.fromisoformat(item['Date'][:10]): item
-                     for item in site['OpeningHours']}
-
+    # Rendered when the sites were loaded
     today = update.message['date'].date()
     tomorrow = today + timedelta(days=1)
     update.message.reply_text("Today ({}): {}\nTomorrow: {}".format(
         today,
-        SystembolagetAPI.parse_opening_hours(opening_hours[today]),
-        SystembolagetAPI.parse_opening_hours(opening_hours[tomorrow])
+        entry.opening_hours.get(today, UNKNOWN_OPENING_HOURS),
+        entry.opening_hours.get(tomorrow, UNKNOWN_OPENING_HOURS)
     ))
 
 
+@stats.timed_function("cmd handle_location")
+@requires_data
 def handle_location(update, context: CallbackContext):
     logger.info(f"'location shared' by {update.message.from_user}")
 
     location = update.message.location
-    nearest_sites = sorted(
-        filter(lambda site: site.get('Position') is not None, sites),
-        key=lambda site: distance(
-            (location['longitude'], location['latitude']),
-            (site['Position']['Long'], site['Position']['Lat'])
-        ))
+    nearest_sites = app.preloaded.site_index.nearest(
+        location['latitude'], location['longitude'], k=4)
 
     rkm = ReplyKeyboardMarkup([
         [KeyboardButton(text=f"/set_store {nearest_sites[0]['Name']}")],
@@ -122,6 +178,22 @@ def handle_location(update, context: CallbackContext):
     update.message.reply_text("Choose location", reply_markup=rkm)
 
 
+def stats_cmd(update, context: CallbackContext):
+    logger.info(f"cmd '{update.message.text}' by {update.message.from_user}")
+    if update.message.from_user.id not in ADMIN_USER_IDS:
+        update.message.reply_text(HELP_MSG)
+    elif not stats.enabled:
+        update.message.reply_text(
+            "Stats are not being recorded, restart me with the environment "
+            "variable WINE_TO_DINE_STATS=1 to do so.")
+    elif BOT_WORKERS > 1:
+        # Every worker records and logs its own stats
+        update.message.reply_text(f"Stats of worker process {os.getpid()} "
+                                  f"only:\n{stats.report()}")
+    else:
+        update.message.reply_text(stats.report())
+
+
 def handle_text_responses(update, context: CallbackContext):
     logger.info(f"cmd '{update.message.text}' by {update.message.from_user}")
     if update.message.text == 'Cancel' or update.message.text.startswith('No'):
@@ -131,35 +203,33 @@ def handle_text_responses(update, context: CallbackContext):
         update.message.reply_text(HELP_MSG)
 
 
-def recommend_red_wines(update, context: CallbackContext):
+# Color names as shown in the recommendations
+COLOR_NAMES = {'red': "red", 'white': "white", 'rose': "rosé"}
+
+
+def _recommend_wines(update, context: CallbackContext, color: str):
     logger.info(f"cmd '{update.message.text}' by {update.message.from_user}")
-    recommendations = sorted_red_wine_matches
+    # Read once, the refresh job may swap in new data at any time
+    recommendation_index = app.preloaded.recommendation_indexes[color]
     N = 5
 
-    max_price_msg = ""
+    max_price, max_price_msg = None, ""
     if context.args and context.args[0].isdecimal():
         max_price = int(context.args[0])
         max_price_msg = f" with max price of SEK {max_price}"
-        recommendations = filter(
-            lambda triple: int(triple[0].Price) <= max_price,
-            recommendations)
-
-    store_name = None
-    if 'store_name' in context.chat_data:
-        store_name = context.chat_data['store_name']
-        recommendations = filter(
-            lambda triple: triple[0].ProductNumber in store_products[store_name],
-            recommendations)
-
-    recommendations = list(recommendations)
+
+    store_name = context.chat_data.get('store_name')
+    recommendations = recommendation_index.top(N, store_name, max_price)
     update.message.reply_text(
-        "Top {} out of {} red wines available {}{}:".format(
-            min(N, len(recommendations)), len(recommendations),
+        "Top {} out of {} {} wines available {}{}:".format(
+            len(recommendations),
+            recommendation_index.count(store_name, max_price),
+            COLOR_NAMES[color],
             f"at _{store_name}_" if store_name else "_online_",
             max_price_msg
         ), parse_mode='Markdown')
 
-    for (inventory_item, certainty, scoring) in list(recommendations)[:N]:
+    for (inventory_item, certainty, scoring) in recommendations:
         update.message.reply_text(
             f"[{inventory_item}]({inventory_item.get_url()}) "
             f"(SEK {int(inventory_item.Price)})\n"
@@ -168,54 +238,228 @@ def recommend_red_wines(update, context: CallbackContext):
             parse_mode='Markdown')
 
 
-def recommend_white_wines(update, context: CallbackContext):
-    logger.info(f"cmd '{update.message.text}' by {update.message.from_user}")
-    update.message.reply_text("Coming soon! Stay tuned :)")
-
-
-SB_API_TOKEN = os.environ.get('SB_API_TOKEN')
-sb = SystembolagetAPI(SB_API_TOKEN)
-
-# Ensure fresh inventory status and opening hours
-sb.clear_cache()
-
-GWS_API_TOKEN = os.environ.get('GWS_API_TOKEN')
-gws = GlobalWineScore(GWS_API_TOKEN)
-
-# The bot runs as a process with objects staying in memory
-logger.info("Pre-loading commonly accessed data")
-sites = list(sb.get_sites())
-sites_as_dict = {site['Name'].lower(): site for site in sites if site['Name']}
-sid_to_name = {site['SiteId']: site['Name'] for site in sites}
-store_products = {
-    sid_to_name[item['SiteId']]: {p['ProductNumber'] for p in item['Products']}
-    for item in sb.get_products_with_store() if item['SiteId'] in sid_to_name
-}
-
-logger.info("Pre-calculating red wine score matching")
-sorted_red_wine_matches = sorted(
-    assign_scorings(
-        sb.get_red_wines(stock_required=True),
-        gws.get_red_wines()
-    ),
-    key=lambda triple: triple[2].score,
-    reverse=True
-)
-
-token = os.environ.get('TELEGRAM_TOKEN')
-updater = Updater(token, use_context=True)
-dp = updater.dispatcher
-
-dp.add_handler(CommandHandler('start', start_cmd))
-dp.add_handler(CommandHandler('help', help_cmd))
-dp.add_handler(CommandHandler('set_store', set_store))
-dp.add_handler(CommandHandler('clear_store', clear_store))
-dp.add_handler(CommandHandler('recommend_red_wines', recommend_red_wines))
-dp.add_handler(CommandHandler('recommend_white_wines', recommend_white_wines))
+@stats.timed_function("cmd recommend_red_wines")
+@requires_data
+def recommend_red_wines(update, context: CallbackContext):
+    _recommend_wines(update, context, 'red')
 
-dp.add_handler(MessageHandler(Filters.text, handle_text_responses))
-dp.add_handler(MessageHandler(Filters.location, handle_location))
 
-updater.start_polling()
-logger.info("Bot is up and ready!")
-updater.idle()
+@stats.timed_function("cmd recommend_white_wines")
+@requires_data
+def recommend_white_wines(update, context: CallbackContext):
+    _recommend_wines(update, context, 'white')
+
+
+@stats.timed_function("cmd recommend_rose_wines")
+@requires_data
+def recommend_rose_wines(update, context: CallbackContext):
+    _recommend_wines(update, context, 'rose')
+
+
+Preloaded = namedtuple("Preloaded", [
+    "sites", "site_directory", "site_index", "recommendation_indexes"])
+
+
+class WineToDine:
+    # The bot's state. Creating it is cheap, so that the bot starts polling
+    # right away, and the recommendation data is loaded in the background.
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sb = SystembolagetAPI(os.environ.get('SB_API_TOKEN'))
+        # Scores are checked for newer ones at every refresh of the data
+        self.gws = GlobalWineScore(os.environ.get('GWS_API_TOKEN'),
+                                   max_age=REFRESH_INTERVAL)
+        self.preloaded: Optional[Preloaded] = None
+        self._responded = False
+
+    def load_data(self) -> Preloaded:
+        # Imported here rather than with the bot, which does not need the
+        # matching to answer the cheap commands
+        from src.columnar import compact_matches
+        from src.geo import SiteIndex
+        from src.matching import CACHE_DIR, MatchCache, NameNormalizer
+        from src.recommender import TIERS, RecommendationIndex, \
+            assign_scorings_by_color, load_availability
+        from src.sites import SiteDirectory
+
+        # Downloads sites, inventory and store availability all at once,
+        # unless they are unchanged since cached, to keep stock and opening
+        # hours fresh
+        self.sb.prefetch_all()
+        sites = list(self.sb.get_sites())
+        site_directory = SiteDirectory(sites)
+        site_index = SiteIndex(sites)
+        # One bitset of available products per store, rather than sets of
+        # product numbers
+        availability = load_availability(self.sb, sites)
+
+        # Only inventory items that changed since the last time are
+        # re-matched, the others are read from the match cache
+        logger.info("Pre-calculating wine score matching")
+        sorted_matches = assign_scorings_by_color(
+            self.sb.get_wines_by_color(stock_required=True),
+            {color: self.gws.get_wines(color) for color in COLORS},
+            workers=os.cpu_count(),
+            tiers=TIERS,
+            match_cache=MatchCache(),
+            name_normalizer=NameNormalizer(
+                CACHE_DIR / 'normalized_names.json'))
+
+        # Kept in memory as compact columns instead of one namedtuple per item
+        return Preloaded(sites, site_directory, site_index, {
+            color: RecommendationIndex(compact_matches(matches), availability)
+            for (color, matches) in sorted_matches.items()})
+
+    def reload_data(self) -> Preloaded:
+        logger.info("Refreshing inventory, store availability and scores")
+        for color in COLORS:
+            self.gws.refresh_wines(color)
+        return self.load_data()
+
+    def _warm_up(self, on_loaded: Optional[Callable[[Preloaded], None]]):
+        try:
+            preloaded = self.load_data()
+        except Exception:
+            logger.exception("Loading data failed, warming up again at the "
+                             "next refresh")
+            return
+        if on_loaded is not None:
+            on_loaded(preloaded)
+        self.preloaded = preloaded
+        logger.info(f"Warmed up {time.perf_counter() - self.started:.1f}s "
+                    f"after starting")
+
+    def warm_up(self, on_loaded: Optional[Callable[[Preloaded], None]] = None):
+        threading.Thread(target=self._warm_up, args=(on_loaded,),
+                         daemon=True).start()
+
+    def refresh_data(self, context: CallbackContext):
+        # Runs in the job queue thread, the handlers keep using the current
+        # data until the new one is completely built and swapped in at once
+        try:
+            self.preloaded = self.reload_data()
+        except Exception:
+            logger.exception("Refresh failed, keeping the current data")
+
+    def refresh_snapshot_periodically(self):
+        # The workers load the new snapshot once it has replaced the old one
+        while True:
+            time.sleep(REFRESH_INTERVAL.total_seconds())
+            try:
+                write_serving_snapshot(SERVING_SNAPSHOT_FILE,
+                                       self.reload_data())
+            except Exception:
+                logger.exception("Refresh failed, keeping the current "
+                                 "snapshot")
+
+    def log_first_response(self, update, context: CallbackContext):
+        # Runs after the commands (in the default group 0) have replied
+        if not self._responded:
+            self._responded = True
+            logger.info(f"Answered the first update "
+                        f"{time.perf_counter() - self.started:.3f}s after "
+                        f"starting")
+
+
+app: Optional[WineToDine] = None
+
+
+def add_handlers(dp: Dispatcher):
+    dp.add_handler(CommandHandler('start', start_cmd))
+    dp.add_handler(CommandHandler('help', help_cmd))
+    dp.add_handler(CommandHandler('set_store', set_store))
+    dp.add_handler(CommandHandler('clear_store', clear_store))
+    dp.add_handler(CommandHandler('recommend_red_wines', recommend_red_wines))
+    dp.add_handler(CommandHandler('recommend_white_wines',
+                                  recommend_white_wines))
+    dp.add_handler(CommandHandler('recommend_rose_wines',
+                                  recommend_rose_wines))
+    dp.add_handler(CommandHandler('stats', stats_cmd))
+
+    dp.add_handler(MessageHandler(Filters.text, handle_text_responses))
+    dp.add_handler(MessageHandler(Filters.location, handle_location))
+
+    dp.add_handler(TypeHandler(Update, app.log_first_response), group=1)
+
+
+worker_dispatcher = None
+
+
+def handle_in_worker(update: dict, data: Optional[Preloaded]):
+    # Runs in a worker process with the data of the latest serving snapshot,
+    # or without any until the first one has been written, dispatching to
+    # the same handlers as the single process bot
+    global app, worker_dispatcher
+    if app is None:
+        app = WineToDine()
+        if stats.enabled:
+            stats.log_periodically(STATS_LOG_INTERVAL)
+    app.preloaded = data
+    if worker_dispatcher is None:
+        worker_dispatcher = Dispatcher(
+            Bot(os.environ.get('TELEGRAM_TOKEN')), None, use_context=True)
+        add_handlers(worker_dispatcher)
+    worker_dispatcher.process_update(
+        Update.de_json(update, worker_dispatcher.bot))
+
+
+def poll_updates(bot: Bot) -> Iterator[dict]:
+    offset = None
+    while True:
+        for update in bot.get_updates(offset=offset, timeout=30):
+            offset = update.update_id + 1
+            yield update.to_dict()
+
+
+def main():
+    global app
+    app = WineToDine()
+    # CPU time of the process so far, which is mostly spent importing
+    logger.info(f"Imported the bot with {time.process_time():.3f}s of CPU "
+                f"time")
+    token = os.environ.get('TELEGRAM_TOKEN')
+
+    if BOT_WORKERS > 1:
+        # The data is built once here and only read by the workers, which
+        # are warming up until the first snapshot has been written. The
+        # workers are forked before any thread is started, so that none of
+        # them inherits a lock held by a thread that does not exist in it.
+        SERVING_SNAPSHOT_FILE.unlink(missing_ok=True)
+        with WorkerPool(SERVING_SNAPSHOT_FILE, handle_in_worker,
+                        BOT_WORKERS) as pool:
+            app.warm_up(lambda preloaded: write_serving_snapshot(
+                SERVING_SNAPSHOT_FILE, preloaded))
+            threading.Thread(target=app.refresh_snapshot_periodically,
+                             daemon=True).start()
+            if stats.enabled:
+                stats.log_periodically(STATS_LOG_INTERVAL)
+            logger.info(f"Bot is polling with {BOT_WORKERS} workers "
+                        f"{time.perf_counter() - app.started:.3f}s after "
+                        f"starting, warming up")
+            for update in poll_updates(Bot(token)):
+                pool.dispatch(update)
+        return
+
+    # The bot runs as a process with objects staying in memory
+    updater = Updater(token, use_context=True)
+    add_handlers(updater.dispatcher)
+
+    # Keeps inventory status and opening hours fresh while running
+    updater.job_queue.run_repeating(app.refresh_data,
+                                    interval=REFRESH_INTERVAL,
+                                    first=REFRESH_INTERVAL)
+    if stats.enabled:
+        updater.job_queue.run_repeating(lambda context: stats.log_report(),
+                                        interval=STATS_LOG_INTERVAL)
+
+    # Cheap commands are answered right away, while the data is loading
+    updater.start_polling()
+    logger.info(f"Bot is polling {time.perf_counter() - app.started:.3f}s "
+                f"after starting, warming up")
+    app.warm_up()
+    updater.idle()
+
+
+if __name__ == "__main__":
+    main()
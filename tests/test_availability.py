@@ -0,0 +1,51 @@
+import unittest
+import random
+
+from src.availability import AvailabilityMatrix, count_bits, iter_bits, \
+    to_bits
+
+
+class TestBits(unittest.TestCase):
+
+    def test_round_trip(self) -> None:
+        positions = [0, 3, 7, 8, 64, 129]
+        bits = to_bits(positions, 130)
+        self.assertEqual(sum(1 << position for position in positions), bits)
+        self.assertEqual(positions, list(iter_bits(bits)))
+        self.assertEqual(len(positions), count_bits(bits))
+        self.assertEqual([], list(iter_bits(to_bits([], 0))))
+
+
+class TestAvailabilityMatrix(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = random.Random(17)
+        self.store_products = {
+            f"Store {i}": {str(rng.randrange(500)) for _ in range(100)}
+            for i in range(5)}
+        self.store_products["Empty store"] = set()
+        self.availability = AvailabilityMatrix(self.store_products)
+
+    def test_identical_to_sets(self) -> None:
+        store_names = ["Store 0", "Store 3", "Unknown store"]
+        for product_number in map(str, range(510)):
+            for store_name in self.store_products:
+                self.assertEqual(
+                    product_number in self.store_products[store_name],
+                    self.availability.is_available(product_number,
+                                                   store_name))
+            self.assertEqual(
+                any(product_number in self.store_products.get(name, ())
+                    for name in store_names),
+                self.availability.is_available(product_number, *store_names))
+
+    def test_reindex(self) -> None:
+        product_numbers = [str(i) for i in range(0, 600, 3)]
+        reindexed = self.availability.reindex(product_numbers)
+        self.assertEqual(set(self.store_products), set(reindexed))
+        for store_name, bits in reindexed.items():
+            self.assertEqual(
+                [position for (position, product_number)
+                 in enumerate(product_numbers)
+                 if product_number in self.store_products[store_name]],
+                list(iter_bits(bits)))
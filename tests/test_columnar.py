@@ -0,0 +1,98 @@
+import unittest
+import gc
+import json
+import tracemalloc
+from pathlib import Path
+
+from src.availability import AvailabilityMatrix
+from src.columnar import InventoryTable, ScoringTable, compact_matches
+from src.globalwinescore import Scoring
+from src.recommender import RecommendationIndex, assign_scorings
+from src.systembolaget import InventoryItem
+from tests import test_matching
+
+
+class TestColumnarTables(unittest.TestCase):
+
+    def setUp(self) -> None:
+        inventory, scorings = test_matching.load_test_data()
+        self.inventory = inventory + list(
+            test_matching.inventory_variants(inventory, scorings))
+        self.scorings = scorings
+
+    def test_rows_equal_namedtuples(self) -> None:
+        for rows, table in [(self.inventory, InventoryTable(self.inventory)),
+                            (self.scorings, ScoringTable(self.scorings))]:
+            self.assertEqual(len(rows), len(table))
+            for row, view in zip(rows, table):
+                self.assertEqual(row, view)
+                self.assertEqual(row, table.row(view._index))
+                self.assertEqual(row._asdict(), view._asdict())
+                self.assertEqual(str(row), str(view))
+                self.assertEqual(row.fuzzy_name(), view.fuzzy_name())
+                self.assertEqual(row.get_country(), view.get_country())
+                self.assertEqual(row.get_url(), view.get_url())
+                self.assertEqual(row.is_red_wine(), view.is_red_wine())
+
+    def test_field_access(self) -> None:
+        table = InventoryTable(self.inventory)
+        self.assertEqual(self.inventory[0].Taste, table[0].Taste)
+        self.assertEqual(self.inventory[-1].Price, table[-1].Price)
+        self.assertEqual(self.inventory[-1].Country, table[-1].Country)
+        with self.assertRaises(AttributeError):
+            table[0].NoSuchField
+        with self.assertRaises(IndexError):
+            table[len(table)]
+
+    def test_assign_scorings(self) -> None:
+        expected = list(assign_scorings(self.inventory, self.scorings))
+        actual = list(assign_scorings(InventoryTable(self.inventory),
+                                      ScoringTable(self.scorings)))
+        self.assertTrue(expected)
+        self.assertEqual(expected, actual)
+
+    def test_compact_matches(self) -> None:
+        matches = sorted(assign_scorings(self.inventory, self.scorings),
+                         key=lambda triple: triple[2].score, reverse=True)
+        compacted = compact_matches(matches)
+        self.assertEqual(matches, compacted)
+
+        availability = AvailabilityMatrix(
+            {"Store": [item.ProductNumber for item in self.inventory[::2]]})
+        for store_name in (None, "Store"):
+            self.assertEqual(
+                RecommendationIndex(matches, availability).top(
+                    5, store_name, 400),
+                RecommendationIndex(compacted, availability).top(
+                    5, store_name, 400))
+
+    def test_less_memory_than_namedtuples(self) -> None:
+        data_dir = Path(__file__).resolve().parent / 'data'
+        with (data_dir / 'sb_inventory.json').open('r') as file:
+            document = json.dumps(json.load(file) * 2000)
+
+        def traced_size(build):
+            gc.collect()
+            tracemalloc.start()
+            rows = build()
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del rows
+            return size
+
+        namedtuples = traced_size(lambda: [
+            InventoryItem(**item) for item in json.loads(document)])
+        table = traced_size(lambda: InventoryTable(
+            InventoryItem(**item) for item in json.loads(document)))
+        self.assertLess(table * 2, namedtuples)
+
+
+class TestScoringTable(unittest.TestCase):
+
+    def test_missing_numeric_values(self) -> None:
+        scorings = test_matching.load_test_data()[1]
+        scorings[0] = scorings[0]._replace(journalist_count=None)
+        table = ScoringTable(scorings)
+        self.assertIsNone(table[0].journalist_count)
+        self.assertEqual(scorings, [table.row(i) for i in range(len(table))])
+        self.assertIsInstance(table.row(0), Scoring)
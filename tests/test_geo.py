@@ -0,0 +1,63 @@
+import unittest
+import json
+import random
+from pathlib import Path
+
+from geopy.distance import distance
+
+from src.geo import SiteIndex
+
+
+def brute_force_nearest(sites, latitude, longitude, k):
+    return sorted(
+        filter(lambda site: site.get('Position') is not None, sites),
+        key=lambda site: distance(
+            (latitude, longitude),
+            (site['Position']['Lat'], site['Position']['Long'])
+        ))[:k]
+
+
+class TestSiteIndex(unittest.TestCase):
+
+    def setUp(self) -> None:
+        sites_file = Path(__file__).resolve().parent / 'data' / \
+            'sb_all_sites.json'
+        with sites_file.open('r') as file:
+            self.sites = json.load(file)
+
+        # Spread around Sweden like the real ~450 stores are
+        rng = random.Random(17)
+        self.random_sites = [
+            {'Name': f"Site {i}", 'Position': {
+                'Lat': rng.uniform(55.3, 69.0), 'Long': rng.uniform(11.0, 24.0)
+            }} for i in range(500)]
+        self.random_sites.append({'Name': "Without position",
+                                  'Position': None})
+        self.locations = [(rng.uniform(55.0, 69.5), rng.uniform(10.5, 24.5))
+                          for _ in range(25)]
+
+    def test_identical_to_brute_force_on_test_data(self) -> None:
+        index = SiteIndex(self.sites)
+        for latitude, longitude in [(59.30, 18.08), (59.33, 18.06),
+                                    (57.70, 11.97), (67.85, 20.22)]:
+            for k in range(1, 4):
+                self.assertEqual(
+                    brute_force_nearest(self.sites, latitude, longitude, k),
+                    index.nearest(latitude, longitude, k))
+
+    def test_identical_to_brute_force(self) -> None:
+        index = SiteIndex(self.random_sites)
+        self.assertEqual(500, len(index))
+        for latitude, longitude in self.locations:
+            self.assertEqual(
+                brute_force_nearest(self.random_sites, latitude, longitude, 4),
+                index.nearest(latitude, longitude, 4))
+
+    def test_latitude_comes_first(self) -> None:
+        index = SiteIndex(self.random_sites)
+        nearest = index.nearest(59.33, 18.06, k=1)[0]['Position']
+        self.assertLess(abs(nearest['Lat'] - 59.33), 1)
+        self.assertLess(abs(nearest['Long'] - 18.06), 2)
+
+    def test_empty_index(self) -> None:
+        self.assertEqual([], SiteIndex([]).nearest(59.33, 18.06, k=4))
@@ -1,8 +1,20 @@
 import unittest
 import json
+import tempfile
+import threading
+import unittest.mock
+from datetime import timedelta
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlparse
 
-from src.globalwinescore import Scoring, GlobalWineScore
+from requests import HTTPError
+
+from src.globalwinescore import COLORS, Scoring, GlobalWineScore, \
+    TokenBucket
+
+DATA_DIR = Path(__file__).resolve().parent / 'data'
 
 
 class TestScoring(unittest.TestCase):
@@ -46,9 +58,245 @@ class TestGlobalWineScore(unittest.TestCase):
         self.gws = GlobalWineScore('api_token')
 
         # Overwrite file path to use test cache data
-        self.gws._red_wines_file = \
-            Path(__file__).resolve().parent / 'data' / 'gws_red_wines.json'
+        self.gws._wines_files['red'] = DATA_DIR / 'gws_red_wines.json'
 
     def test_get_red_wines(self) -> None:
         red_wines = self.gws.get_red_wines()
         self.assertEqual(10, len(red_wines))
+
+
+class StubGlobalWineScoreHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self) -> None:
+        self.server.requests.append(self.path)
+        status = self.server.failures.pop(len(self.server.requests), None)
+        if status is not None:
+            self.send_response(status)
+            self.end_headers()
+            return
+
+        query = parse_qs(urlparse(self.path).query)
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query['limit'][0])
+        results = self.server.results
+        if query.get('ordering') == ['-date']:
+            results = sorted(results, key=lambda item: item['date'],
+                             reverse=True)
+        results = results[offset:offset + limit]
+        next_url = None
+        if offset + limit < len(self.server.results):
+            params = urlencode({**{k: v[0] for (k, v) in query.items()},
+                                'offset': offset + limit})
+            next_url = f"http://{self.server.server_address[0]}:" \
+                       f"{self.server.server_address[1]}/?{params}"
+
+        body = json.dumps({'count': len(self.server.results),
+                           'next': next_url, 'results': results})
+        etag = f'"{sha1(body.encode()).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class StubServerTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        with (DATA_DIR / 'gws_red_wines.json').open('r') as file:
+            self.results = json.load(file)['results']
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          StubGlobalWineScoreHandler)
+        self.server.results, self.server.requests = self.results, []
+        self.server.failures = {}
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.gws = self.stub_client()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache_dir.cleanup()
+
+    def stub_client(self, max_age: timedelta = timedelta(0)
+                    ) -> GlobalWineScore:
+        gws = GlobalWineScore('api_token', max_age=max_age)
+        gws._api_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        gws._wines_files = {
+            color: Path(self.cache_dir.name) / f'gws_{color}_wines.json'
+            for color in COLORS}
+        gws._rate_limiter = TokenBucket(60000)
+        gws.PAGE_SIZE, gws.RETRY_BACKOFF = 3, 0
+        return gws
+
+
+class TestPaginatedDownload(StubServerTestCase):
+
+    def test_downloads_all_pages(self) -> None:
+        red_wines = self.gws.get_red_wines()
+        self.assertEqual([Scoring(**item) for item in self.results],
+                         red_wines)
+        self.assertEqual(4, len(self.server.requests))
+        self.assertFalse(GlobalWineScore._partial_file(
+            self.gws._wines_files['red']).exists())
+
+    def test_retries_rate_limited_and_failed_requests(self) -> None:
+        self.server.failures = {2: 429, 3: 503}
+        self.assertEqual(len(self.results), len(self.gws.get_red_wines()))
+        self.assertEqual(6, len(self.server.requests))
+        self.assertEqual(self.server.requests[1], self.server.requests[2])
+
+    def test_resumes_after_interruption(self) -> None:
+        self.gws.MAX_RETRIES = 0
+        self.server.failures = {3: 500}
+        with self.assertRaises(HTTPError):
+            self.gws.get_red_wines()
+        self.assertFalse(self.gws._wines_files['red'].exists())
+
+        self.server.requests.clear()
+        red_wines = self.stub_client().get_red_wines()
+        self.assertEqual([Scoring(**item) for item in self.results],
+                         red_wines)
+        self.assertIn('offset=6', self.server.requests[0])
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_downloads_colors_into_separate_caches(self) -> None:
+        white_wines = self.gws.get_wines('white')
+        self.assertEqual(len(self.results), len(white_wines))
+        self.assertTrue(all('color=white' in path
+                            for path in self.server.requests))
+        self.assertTrue(self.gws._wines_files['white'].exists())
+        self.assertFalse(self.gws._wines_files['red'].exists())
+
+
+class TestIncrementalRefresh(StubServerTestCase):
+
+    def test_refresh_without_cache_downloads_everything(self) -> None:
+        self.assertEqual((len(self.results), 0),
+                         self.gws.refresh_red_wines())
+
+    def test_refresh_merges_newer_scores(self) -> None:
+        self.gws.get_red_wines()
+        self.server.requests.clear()
+
+        new_score = dict(self.results[-1], wine_id=1, date='2020-05-01')
+        updated_score = dict(self.results[-2], score=99.99,
+                             date='2020-05-02')
+        self.server.results = [new_score, updated_score] + self.results[:-2]
+
+        self.gws.REFRESH_PAGE_SIZE = 2
+        self.assertEqual((1, 1), self.gws.refresh_red_wines())
+        self.assertEqual(3, len(self.server.requests))
+
+        red_wines = self.stub_client().get_red_wines()
+        self.assertEqual(len(self.results) + 1, len(red_wines))
+        self.assertIn(Scoring(**new_score), red_wines)
+        self.assertIn(Scoring(**updated_score), red_wines)
+        self.assertEqual(sorted(red_wines, key=lambda s: s.score,
+                                reverse=True), red_wines)
+
+    def test_interrupted_refresh_keeps_scores(self) -> None:
+        red_wines = self.gws.get_red_wines()
+        content = self.gws._wines_files['red'].read_text()
+        self.server.results = [dict(self.results[-1], wine_id=1,
+                                    date='2020-05-01')] + self.results
+
+        def truncated_dump(data, file, **kwargs):
+            file.write('{"count": ')
+            raise OSError("No space left on device")
+
+        with unittest.mock.patch('src.globalwinescore.json.dump',
+                                 side_effect=truncated_dump), \
+                self.assertRaises(OSError):
+            self.gws.refresh_red_wines()
+        self.assertEqual(content, self.gws._wines_files['red'].read_text())
+        self.assertEqual(red_wines, self.stub_client().get_red_wines())
+
+    def test_refresh_without_newer_scores(self) -> None:
+        self.gws.get_red_wines()
+        self.gws.REFRESH_PAGE_SIZE = 2
+        self.assertEqual((0, 0), self.gws.refresh_red_wines())
+
+
+class TestRevalidation(StubServerTestCase):
+
+    def test_fresh_scores_are_not_refreshed(self) -> None:
+        self.gws.get_red_wines()
+        self.server.requests.clear()
+        gws = self.stub_client(max_age=timedelta(hours=1))
+        self.assertEqual((0, 0), gws.refresh_red_wines())
+        self.assertEqual([], self.server.requests)
+
+        # E.g. the bot refreshing more often than the default max age
+        self.assertEqual((0, 0), self.stub_client().refresh_red_wines())
+        self.assertTrue(self.server.requests)
+
+    def test_unchanged_scores_are_revalidated(self) -> None:
+        self.gws.get_red_wines()
+        self.gws.REFRESH_PAGE_SIZE = 2
+        self.assertEqual((0, 0), self.gws.refresh_red_wines())
+        self.server.requests.clear()
+
+        modified = self.gws._wines_files['red'].stat().st_mtime_ns
+        self.assertEqual((0, 0), self.gws.refresh_red_wines())
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(modified,
+                         self.gws._wines_files['red'].stat().st_mtime_ns)
+
+        # New scores change the first page
+        new_score = dict(self.results[-1], wine_id=1, date='2020-05-01')
+        self.server.results = [new_score] + self.results
+        self.assertEqual((1, 0), self.gws.refresh_red_wines())
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_respects_rate(self) -> None:
+        now, sleeps = [0.0], []
+
+        def sleep(seconds: float) -> None:
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        bucket = TokenBucket(10, capacity=2, clock=lambda: now[0],
+                             sleep=sleep)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual([], sleeps)
+        bucket.acquire()
+        self.assertEqual([6.0], sleeps)
+        now[0] += 3
+        bucket.acquire()
+        self.assertEqual([6.0, 3.0], sleeps)
+
+    def test_client_stays_under_limit(self) -> None:
+        now = [0.0]
+
+        def sleep(seconds: float) -> None:
+            now[0] += seconds
+
+        # The limiter of a client, on a fake clock
+        bucket = GlobalWineScore('api_token')._rate_limiter
+        bucket._clock, bucket._sleep, bucket._updated = \
+            (lambda: now[0]), sleep, 0.0
+        acquired = []
+        for _ in range(30):
+            bucket.acquire()
+            acquired.append(now[0])
+        for start in acquired:
+            self.assertLessEqual(
+                sum(start <= t < start + 60 for t in acquired),
+                GlobalWineScore.REQUESTS_PER_MINUTE)
+        self.assertEqual(10, sum(t < 60 for t in acquired))
@@ -0,0 +1,457 @@
+import unittest
+import unittest.mock
+import importlib.util
+import json
+import multiprocessing
+import random
+import re
+import tempfile
+from pathlib import Path
+
+from fuzzywuzzy import fuzz, process
+
+from src.globalwinescore import Scoring
+from src.matching import NORMALIZATION_RULES, CandidateIndex, MatchCache, \
+    NameNormalizer, extract_best_batch, normalize_name
+from src import recommender
+from src.recommender import TIERS, MatchTier, assign_scorings
+from src.systembolaget import InventoryItem
+
+
+def load_test_data():
+    data_dir = Path(__file__).resolve().parent / 'data'
+    with (data_dir / 'gws_red_wines.json').open('r') as file:
+        scorings = [Scoring(**item) for item in json.load(file)['results']]
+    with (data_dir / 'sb_inventory.json').open('r') as file:
+        inventory = [InventoryItem(**item) for item in json.load(file)]
+    return inventory, scorings
+
+
+def inventory_variants(inventory, scorings, seed=17):
+    # Inventory items named like the GWS scorings, with some words dropped,
+    # shuffled or misspelled the way they differ between the two sites
+    rng = random.Random(seed)
+    swedish_names = {v: k for (k, v) in
+                     InventoryItem.COUNTRY_NAME_LANGUAGE_CONVERSION.items()}
+    template = inventory[-1]
+    for scoring in scorings:
+        for _ in range(5):
+            words = scoring.fuzzy_name().replace(',', '').split()
+            rng.shuffle(words)
+            words = words[:rng.randint(2, len(words))]
+            if rng.random() < 0.5:
+                position = rng.randrange(len(words))
+                words[position] = words[position][:-1]
+            yield template._replace(
+                ProductNameBold=" ".join(words[:2]),
+                ProductNameThin=" ".join(words[2:]),
+                ProducerName=rng.choice(('', words[0])),
+                Country=swedish_names.get(scoring.country, scoring.country),
+                Vintage=int(scoring.vintage))
+
+
+class TestCandidateIndex(unittest.TestCase):
+
+    def setUp(self) -> None:
+        inventory, scorings = load_test_data()
+        self.choices = [scoring.fuzzy_name() for scoring in scorings]
+        self.queries = [item.fuzzy_name() for item in
+                        inventory_variants(inventory, scorings)]
+
+    def test_shortlist_ranks_by_shared_tokens(self) -> None:
+        index = CandidateIndex(self.choices)
+        shortlist = index.shortlist("Masseto Toscana", top_k=1)
+        self.assertEqual(["Masseto, Toscana Toscana"], shortlist)
+
+    def test_identical_to_brute_force(self) -> None:
+        index = CandidateIndex(self.choices)
+        for min_score in (0, 50, 90):
+            for top_k in (1, 3, 10):
+                for query in self.queries:
+                    expected = process.extractOne(
+                        query, self.choices, scorer=fuzz.token_set_ratio)
+                    actual = index.extract_one(query, min_score, top_k)
+                    if expected[1] >= min_score:
+                        self.assertEqual(expected, actual, query)
+                    else:
+                        self.assertTrue(actual is None
+                                        or actual[1] < min_score)
+
+    def test_empty_index(self) -> None:
+        self.assertIsNone(CandidateIndex([]).extract_one("Masseto"))
+
+    def test_budget_bounds_comparisons(self) -> None:
+        index = CandidateIndex(self.choices)
+        for query in self.queries:
+            comparisons = index.comparisons
+            actual = index.extract_one(query, 50, max_comparisons=2)
+            self.assertLessEqual(index.comparisons - comparisons, 2)
+            if actual is not None:
+                expected = index.extract_one(query, 50)
+                self.assertLessEqual(actual[1], expected[1])
+        self.assertEqual(("Masseto, Toscana Toscana", 100), index.extract_one(
+            "Masseto Toscana", 90, max_comparisons=1))
+
+
+class TestAssignScoringsWithIndex(unittest.TestCase):
+
+    def test_identical_to_brute_force(self) -> None:
+        inventory, scorings = load_test_data()
+        inventory += list(inventory_variants(inventory, scorings))
+        for fuzz_match_min_percentage in (50, 90):
+            expected = list(assign_scorings(
+                inventory, scorings, fuzz_match_min_percentage, top_k=None))
+            actual = list(assign_scorings(
+                inventory, scorings, fuzz_match_min_percentage))
+            self.assertTrue(expected)
+            self.assertEqual(expected, actual)
+
+
+# Inherited by the workers, which are forked for that, the bucket of the
+# slow name is not matched until released
+released = multiprocessing.Event()
+slow_matched = multiprocessing.Event()
+slow_name = None
+match_bucket = recommender._match_bucket
+
+
+def slow_match_bucket(fuzzy_names, *args):
+    if slow_name in fuzzy_names:
+        released.wait(timeout=10)
+        slow_matched.set()
+    return match_bucket(fuzzy_names, *args)
+
+
+class TestAssignScoringsInParallel(unittest.TestCase):
+
+    def test_identical_to_serial(self) -> None:
+        inventory, scorings = load_test_data()
+        inventory += list(inventory_variants(inventory, scorings))
+        for top_k in (None, 10):
+            expected = list(assign_scorings(inventory, scorings, top_k=top_k))
+            actual = list(assign_scorings(inventory, scorings, top_k=top_k,
+                                          workers=2))
+            self.assertTrue(expected)
+            self.assertEqual(expected, actual)
+
+    def test_matches_are_yielded_while_matching(self) -> None:
+        global slow_name
+        inventory, scorings = load_test_data()
+        inventory += list(inventory_variants(inventory, scorings))
+        normalize = NameNormalizer()
+        expected = list(assign_scorings(inventory, scorings, tiers=TIERS[:1]))
+        slow_name = normalize(expected[-1][0].fuzzy_name())
+        slow_items = [item for (item, _, _) in expected
+                      if normalize(item.fuzzy_name()) == slow_name]
+
+        released.clear()
+        slow_matched.clear()
+        with unittest.mock.patch.object(recommender, '_match_bucket',
+                                        slow_match_bucket), \
+                unittest.mock.patch.object(
+                    recommender, 'MATCHING_CONTEXT',
+                    multiprocessing.get_context('fork')):
+            matches = assign_scorings(inventory, scorings, workers=2,
+                                      tiers=TIERS[:1])
+            first_match = next(matches)
+            self.assertFalse(slow_matched.is_set())
+            released.set()
+            actual = [first_match, *matches]
+        self.assertNotIn(first_match[0], slow_items)
+        # Still in the order of the inventory
+        self.assertEqual(expected, actual)
+
+
+@unittest.skipUnless(importlib.util.find_spec('rapidfuzz') and
+                     importlib.util.find_spec('numpy'),
+                     "rapidfuzz and numpy are not installed")
+class TestBatchEngine(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.inventory, self.scorings = load_test_data()
+        self.inventory += list(inventory_variants(self.inventory,
+                                                  self.scorings))
+
+    def test_identical_to_brute_force(self) -> None:
+        choices = [scoring.fuzzy_name() for scoring in self.scorings]
+        queries = [item.fuzzy_name() for item in self.inventory]
+        for min_score in (0, 50, 90):
+            actual = extract_best_batch(queries, choices, min_score)
+            for query, best_match in zip(queries, actual):
+                expected = process.extractOne(
+                    query, choices, scorer=fuzz.token_set_ratio)
+                if expected[1] >= min_score:
+                    self.assertEqual(expected, best_match, query)
+                else:
+                    self.assertIsNone(best_match)
+
+    def test_identical_to_fuzzywuzzy_engine(self) -> None:
+        for fuzz_match_min_percentage in (50, 90):
+            expected = list(assign_scorings(
+                self.inventory, self.scorings, fuzz_match_min_percentage))
+            actual = list(assign_scorings(
+                self.inventory, self.scorings, fuzz_match_min_percentage,
+                workers=2, engine='rapidfuzz'))
+            self.assertTrue(expected)
+            self.assertEqual(expected, actual)
+
+    def test_unknown_engine(self) -> None:
+        with self.assertRaises(ValueError):
+            list(assign_scorings(self.inventory, self.scorings,
+                                 engine='difflib'))
+
+
+class TestMatchTiers(unittest.TestCase):
+
+    def setUp(self) -> None:
+        inventory, self.scorings = load_test_data()
+        self.masseto = inventory[-1]._replace(
+            ProductNameBold="Masseto", ProductNameThin="Toscana",
+            ProducerName="")
+
+    def assign_scorings(self, inventory_items, **kwargs):
+        with self.assertLogs('Recommender') as logs:
+            matches = list(assign_scorings(inventory_items, self.scorings,
+                                           **kwargs))
+        return matches, logs.output[-1]
+
+    def test_adjacent_vintage(self) -> None:
+        masseto_2016 = self.masseto._replace(Vintage=2016)
+        matches, tier_stats = self.assign_scorings([masseto_2016],
+                                                   tiers=TIERS)
+        self.assertEqual([(masseto_2016, 100, self.scorings[7])], matches)
+        self.assertIn("exact 0/1 matched with 0 comparisons", tier_stats)
+        self.assertIn("adjacent_vintages 1/1 matched with 1 comparisons",
+                      tier_stats)
+        self.assertIn("global 0/0 matched", tier_stats)
+
+        matches, _ = self.assign_scorings([masseto_2016], tiers=TIERS[:2],
+                                          vintage_tolerance=0)
+        self.assertEqual([], matches)
+        matches, _ = self.assign_scorings([masseto_2016], tiers=TIERS[:1])
+        self.assertEqual([], matches)
+        # Only the exact tier unless asked for the others
+        matches, tier_stats = self.assign_scorings([masseto_2016])
+        self.assertEqual([], matches)
+        self.assertNotIn("adjacent_vintages", tier_stats)
+
+    def test_non_vintage_in_global_pool(self) -> None:
+        masseto_nv = self.masseto._replace(Vintage=0, Country='Frankrike')
+        matches, tier_stats = self.assign_scorings(
+            [masseto_nv], engine='rapidfuzz' if importlib.util.find_spec(
+                'rapidfuzz') else 'fuzzywuzzy', tiers=TIERS)
+        self.assertEqual([(masseto_nv, 100, self.scorings[7])], matches)
+        self.assertIn("adjacent_vintages 0/1 matched with 0 comparisons",
+                      tier_stats)
+        self.assertIn("global 1/1 matched with 1 comparisons", tier_stats)
+
+    def test_closest_vintage_in_global_pool(self) -> None:
+        # Scored for 2005, 2015, 1999 and 2012, but not in Italy
+        romanee_conti_2013 = self.masseto._replace(
+            ProductNameBold="Romanee Conti", ProductNameThin="Grand Cru",
+            ProducerName="Domaine De La Romanee Conti", Vintage=2013,
+            Country='Italien')
+        matches, tier_stats = self.assign_scorings([romanee_conti_2013],
+                                                   tiers=TIERS)
+        self.assertEqual([(romanee_conti_2013, 100, self.scorings[8])],
+                         matches)
+        self.assertIn("global 1/1 matched", tier_stats)
+
+    def test_budgets(self) -> None:
+        inventory = list(inventory_variants([self.masseto], self.scorings))
+        inventory = [item._replace(Vintage=0) for item in inventory]
+        for budget in (1, 3):
+            _, tier_stats = self.assign_scorings(
+                inventory, tiers=(TIERS[0], MatchTier('global', budget)))
+            comparisons = re.search(r"global \d+/\d+ matched with (\d+)",
+                                    tier_stats).group(1)
+            self.assertLessEqual(int(comparisons), budget * len(inventory))
+
+    def test_invalid_tiers(self) -> None:
+        for tiers in ((), TIERS[1:], (*TIERS, MatchTier('nearby', 1))):
+            with self.assertRaises(ValueError):
+                list(assign_scorings([self.masseto], self.scorings,
+                                     tiers=tiers))
+
+
+class TestMatchCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.inventory, self.scorings = load_test_data()
+        self.inventory += list(inventory_variants(self.inventory,
+                                                  self.scorings))
+        self.expected = list(assign_scorings(self.inventory, self.scorings))
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache_file = Path(self.cache_dir.name) / 'match_cache.json'
+
+    def tearDown(self) -> None:
+        self.cache_dir.cleanup()
+
+    def assign_scorings(self, scorings, **kwargs):
+        match_cache = MatchCache(self.cache_file)
+        matches = list(assign_scorings(self.inventory, scorings,
+                                       match_cache=match_cache, **kwargs))
+        return matches, match_cache
+
+    def test_rerun_hits_cache(self) -> None:
+        matches, match_cache = self.assign_scorings(self.scorings)
+        self.assertEqual(self.expected, matches)
+        self.assertEqual(0, match_cache.hits)
+        self.assertLess(0, match_cache.misses)
+
+        for workers in (None, 2):
+            matches, match_cache = self.assign_scorings(self.scorings,
+                                                        workers=workers)
+            self.assertEqual(self.expected, matches)
+            self.assertLess(0, match_cache.hits)
+            self.assertEqual(0, match_cache.misses)
+            self.assertEqual(0, match_cache.invalidations)
+
+    def test_changed_bucket_is_invalidated(self) -> None:
+        self.assign_scorings(self.scorings)
+
+        scorings = self.scorings[1:]
+        matches, match_cache = self.assign_scorings(scorings)
+        self.assertEqual(list(assign_scorings(self.inventory, scorings)),
+                         matches)
+        self.assertLess(0, match_cache.hits)
+        self.assertLess(0, match_cache.invalidations)
+
+    def test_other_parameters_keep_entries(self) -> None:
+        # E.g. the command line matching in between runs of the bot
+        self.assign_scorings(self.scorings)
+        self.assign_scorings(self.scorings, fuzz_match_min_percentage=50,
+                             tiers=TIERS)
+
+        matches, match_cache = self.assign_scorings(self.scorings)
+        self.assertEqual(self.expected, matches)
+        self.assertLess(0, match_cache.hits)
+        self.assertEqual(0, match_cache.misses)
+        self.assertEqual(0, match_cache.invalidations)
+
+    def test_entries_unused_for_max_age_are_dropped(self) -> None:
+        self.assign_scorings(self.scorings)
+        with self.cache_file.open('r') as file:
+            entries = json.load(file)
+        max_age = MatchCache.MAX_AGE.total_seconds()
+        for entry in entries.values():
+            entry[3] -= max_age + 1
+        with self.cache_file.open('w') as file:
+            json.dump(entries, file)
+
+        matches, match_cache = self.assign_scorings(self.scorings)
+        self.assertEqual(self.expected, matches)
+        self.assertEqual(0, match_cache.hits)
+        self.assertEqual(0, match_cache.invalidations)
+
+    def test_entries_without_time_of_use_are_read(self) -> None:
+        self.assign_scorings(self.scorings)
+        with self.cache_file.open('r') as file:
+            entries = json.load(file)
+        with self.cache_file.open('w') as file:
+            json.dump({key: entry[:3] for (key, entry) in entries.items()},
+                      file)
+
+        matches, match_cache = self.assign_scorings(self.scorings)
+        self.assertEqual(self.expected, matches)
+        self.assertEqual(0, match_cache.misses)
+
+    def test_truncated_cache_is_ignored(self) -> None:
+        self.assign_scorings(self.scorings)
+        content = self.cache_file.read_text()
+        self.cache_file.write_text(content[:len(content) // 2])
+
+        with self.assertLogs('Matching', 'WARNING'):
+            matches, match_cache = self.assign_scorings(self.scorings)
+        self.assertEqual(self.expected, matches)
+        self.assertEqual(0, match_cache.hits)
+        # Written in full again, without leaving the temporary file behind
+        self.assertEqual(content, self.cache_file.read_text())
+        self.assertEqual([self.cache_file.name],
+                         [path.name for path in
+                          self.cache_file.parent.iterdir()])
+
+
+class TestNameNormalization(unittest.TestCase):
+
+    def test_accent_folding(self) -> None:
+        self.assertEqual("vina ardanza reserva",
+                         normalize_name("Viña Ardanza, Reserva"))
+        self.assertEqual("musar bekaa valley",
+                         normalize_name("Château Musar, Bekaa Valley"))
+        self.assertEqual("brondum oeil de perdrix",
+                         normalize_name("Brøndum Œil-de-Perdrix"))
+
+    def test_producer_stopwords(self) -> None:
+        self.assertEqual("chateau margaux margaux",
+                         normalize_name("Chateau Margaux, Margaux"))
+        self.assertEqual("margaux",
+                         normalize_name("Margaux"))
+        self.assertEqual("palmer margaux",
+                         normalize_name("Chateau Palmer, Margaux"))
+        self.assertEqual("black stallion",
+                         normalize_name("Black Stallion Estate Winery"))
+        self.assertEqual("domaine winery",
+                         normalize_name("Domaine Winery"))
+
+    def test_other_wines_of_appellation_do_not_match(self) -> None:
+        # Neither a perfect match for the first growth, as they would be if
+        # its name was reduced to the appellation
+        for name in ("Pavillon Rouge du Chateau Margaux, Margaux",
+                     "Brio de Cantenac Brown, Margaux",
+                     "Chateau Marquis de Terme, Margaux"):
+            self.assertLess(fuzz.token_set_ratio(
+                normalize_name(name),
+                normalize_name("Chateau Margaux, Margaux")), 90, name)
+
+    def test_accents_match_like_without(self) -> None:
+        inventory, scorings = load_test_data()
+        scoring = scorings[0]._replace(
+            wine="La Rioja Alta, Vina Ardanza Reserva", appellation="Rioja")
+        inventory_item = inventory[-1]._replace(
+            ProductNameBold="Viña Ardanza", ProductNameThin="Reserva",
+            ProducerName="La Rioja Alta", Country="Spanien",
+            Vintage=int(scoring.vintage))
+        scoring = scoring._replace(country="Spain")
+
+        [(_, certainty, _)] = assign_scorings([inventory_item], [scoring])
+        self.assertEqual(100, certainty)
+
+    def test_persisted_across_runs(self) -> None:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_file = Path(cache_dir) / 'normalized_names.json'
+            normalizer = NameNormalizer(cache_file)
+            self.assertEqual("palmer margaux",
+                             normalizer("Château Palmer, Margaux"))
+            normalizer.save()
+
+            with cache_file.open('r') as file:
+                self.assertEqual({'rules': NORMALIZATION_RULES, 'names': {
+                    "Château Palmer, Margaux": "palmer margaux"}},
+                    json.load(file))
+            self.assertEqual("palmer margaux", NameNormalizer(cache_file)(
+                "Château Palmer, Margaux"))
+
+    def test_truncated_cache_is_ignored(self) -> None:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_file = Path(cache_dir) / 'normalized_names.json'
+            cache_file.write_text('{"rules": "')
+            with self.assertLogs('Matching', 'WARNING'):
+                normalizer = NameNormalizer(cache_file)
+            self.assertEqual("palmer margaux",
+                             normalizer("Château Palmer, Margaux"))
+            normalizer.save()
+            self.assertEqual("palmer margaux", NameNormalizer(cache_file)(
+                "Château Palmer, Margaux"))
+
+    def test_names_of_other_rules_are_ignored(self) -> None:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_file = Path(cache_dir) / 'normalized_names.json'
+            for cached in ({"Château Margaux": "margaux"},
+                           {'rules': "other", 'names': {
+                               "Château Margaux": "margaux"}}):
+                with cache_file.open('w') as file:
+                    json.dump(cached, file)
+                normalizer = NameNormalizer(cache_file)
+                self.assertEqual("chateau margaux",
+                                 normalizer("Château Margaux"))
@@ -1,7 +1,14 @@
 import unittest
+import csv
+import io
+import json
+import random
 
+from src.availability import AvailabilityMatrix
 from src.globalwinescore import Scoring
-from src.recommender import assign_scorings
+from src.recommender import Query, RecommendationIndex, TopMatches, \
+    answer_queries, assign_scorings, assign_scorings_by_color, \
+    read_queries, stream_top_matches, write_results
 from src.systembolaget import InventoryItem
 
 
@@ -88,3 +95,210 @@ class TestRedWineRecommendations(unittest.TestCase):
         recommendations = list(assign_scorings([self.inventory_item],
                                                [new_scoring]))
         self.assertEqual(0, len(recommendations))
+
+    def test_recommendation_by_color(self) -> None:
+        white_scoring = self.scoring._replace(wine="A crisp white",
+                                              color="White")
+        white_item = self.inventory_item._replace(
+            ProductNameBold="A crisp white", ProductNameThin="",
+            Category="Vita viner")
+        matches = assign_scorings_by_color(
+            {'red': [self.inventory_item], 'white': [white_item]},
+            {'red': [self.scoring], 'white': [white_scoring]})
+        self.assertEqual([self.scoring],
+                         [scoring for (_, _, scoring) in matches['red']])
+        self.assertEqual([white_scoring],
+                         [scoring for (_, _, scoring) in matches['white']])
+
+    def test_color_without_items_or_scores(self) -> None:
+        # No white wines in stock and no rosé wines scored
+        matches = assign_scorings_by_color(
+            {'red': [self.inventory_item], 'white': [],
+             'rose': [self.inventory_item]},
+            {'red': [self.scoring], 'white': [self.scoring], 'rose': []})
+        self.assertEqual({'red': [(self.inventory_item, 100, self.scoring)],
+                          'white': [], 'rose': []}, matches)
+
+
+class TestRecommendationIndex(unittest.TestCase):
+
+    def setUp(self) -> None:
+        TestRedWineRecommendations.setUp(self)
+        rng = random.Random(17)
+        self.sorted_matches = sorted((
+            (self.inventory_item._replace(ProductNumber=str(i),
+                                          Price=float(rng.randint(50, 800))),
+             100, self.scoring._replace(score=rng.uniform(85, 100)))
+            for i in range(1000)), key=lambda triple: triple[2].score,
+            reverse=True)
+        self.store_products = {
+            f"Store {i}": {str(rng.randrange(1000)) for _ in range(200)}
+            for i in range(10)}
+        self.store_products["Empty store"] = set()
+        self.availability = AvailabilityMatrix(self.store_products)
+
+    def brute_force(self, store_name, max_price):
+        recommendations = self.sorted_matches
+        if max_price is not None:
+            recommendations = filter(
+                lambda triple: int(triple[0].Price) <= max_price,
+                recommendations)
+        if store_name is not None:
+            recommendations = filter(
+                lambda triple:
+                triple[0].ProductNumber in self.store_products[store_name],
+                recommendations)
+        return list(recommendations)
+
+    def test_identical_to_filtering(self) -> None:
+        index = RecommendationIndex(self.sorted_matches, self.availability)
+        for store_name in [None, *self.store_products]:
+            for max_price in (None, 49, 50, 100, 399, 800):
+                expected = self.brute_force(store_name, max_price)
+                self.assertEqual(len(expected),
+                                 index.count(store_name, max_price))
+                for n in (1, 5, 2000):
+                    self.assertEqual(expected[:n],
+                                     index.top(n, store_name, max_price))
+
+    def test_any_of_stores(self) -> None:
+        index = RecommendationIndex(self.sorted_matches, self.availability)
+        store_names = ["Store 1", "Store 2", "Empty store", "Unknown store"]
+        expected = [triple for triple in self.brute_force(None, 400)
+                    if any(triple[0].ProductNumber in self.store_products.get(
+                        store_name, ()) for store_name in store_names)]
+        self.assertEqual(len(expected), index.count(store_names, 400))
+        self.assertEqual(expected[:5], index.top(5, store_names, 400))
+        self.assertEqual(index.top(5, "Store 1"), index.top(5, ["Store 1"]))
+
+    def test_min_score(self) -> None:
+        index = RecommendationIndex(self.sorted_matches, self.availability)
+        for min_score in (80, 90, 95.5, 101):
+            expected = [triple for triple in self.brute_force("Store 1", 400)
+                        if triple[2].score >= min_score]
+            self.assertEqual(len(expected),
+                             index.count("Store 1", 400, min_score))
+            self.assertEqual(expected,
+                             index.top(None, "Store 1", 400, min_score))
+
+    def test_unknown_store(self) -> None:
+        index = RecommendationIndex(self.sorted_matches, self.availability)
+        self.assertEqual(0, index.count("Unknown store"))
+        self.assertEqual([], index.top(5, "Unknown store"))
+
+
+class TestTopMatches(unittest.TestCase):
+
+    def setUp(self) -> None:
+        TestRecommendationIndex.setUp(self)
+        self.index = RecommendationIndex(self.sorted_matches,
+                                         self.availability)
+        # In the order they are matched in rather than by score
+        self.matches = random.Random(17).sample(self.sorted_matches,
+                                                len(self.sorted_matches))
+
+    def test_identical_to_index(self) -> None:
+        for store_name in (None, "Store 1", ["Store 1", "Unknown store"]):
+            for (max_price, min_score) in ((None, None), (400, 95), (49, 0)):
+                for n in (1, 5, 2000):
+                    top = TopMatches(n, store_name, max_price, min_score,
+                                     self.availability)
+                    for match in self.matches:
+                        top.offer(match)
+                    self.assertEqual(
+                        self.index.top(n, store_name, max_price, min_score),
+                        top.matches())
+                    self.assertEqual(
+                        self.index.count(store_name, max_price, min_score),
+                        top.total)
+
+    def test_stream_yields_matches_entering_top(self) -> None:
+        tops = {'cheap': TopMatches(5, max_price=100),
+                'store': TopMatches(5, "Store 1",
+                                    availability=self.availability)}
+        streamed = list(stream_top_matches(iter(self.matches), tops))
+        for key, top in tops.items():
+            entered = [match for (top_key, match) in streamed
+                       if top_key == key]
+            self.assertLess(len(entered), top.total)
+            # The final top is made of the latest entries
+            for match in top.matches():
+                self.assertIn(match, entered)
+
+    def test_ties_keep_first_offered(self) -> None:
+        top = TopMatches(1)
+        first, second = [(self.inventory_item, 100, self.scoring)] * 2
+        self.assertTrue(top.offer(first))
+        self.assertFalse(top.offer(second))
+        self.assertFalse(TopMatches(0).offer(first))
+
+
+class TestBatchQueries(unittest.TestCase):
+
+    def setUp(self) -> None:
+        TestRecommendationIndex.setUp(self)
+        self.indexes = {'red': RecommendationIndex(self.sorted_matches,
+                                                   self.availability)}
+
+    def test_read_queries(self) -> None:
+        queries = read_queries(io.StringIO(
+            '{"store": "Store 1", "max_price": 200}\n'
+            '\n'
+            '{"id": "nightly", "store": ["Store 1", "Store 2"], '
+            '"min_score": 95, "limit": null}\n'))
+        self.assertEqual(
+            [Query(1, 'red', "Store 1", 200, None, 10),
+             Query("nightly", 'red', ["Store 1", "Store 2"], None, 95, None)],
+            queries)
+
+        with self.assertRaises(ValueError):
+            read_queries(io.StringIO('{"color": "orange"}\n'))
+        with self.assertRaises(ValueError):
+            read_queries(io.StringIO('{"max_prize": 100}\n'))
+
+    def test_invalid_field_types(self) -> None:
+        for line in ('{"max_price": "200"}', '{"max_price": 99.5}',
+                     '{"min_score": "92"}', '{"min_score": true}',
+                     '{"limit": -1}', '{"limit": 2.5}', '{"store": 7}',
+                     '{"store": ["Store 1", null]}', '[]', '{"limit": '):
+            with self.assertRaisesRegex(ValueError, "line 2"):
+                read_queries(io.StringIO('{}\n' + line + '\n'))
+
+        queries = read_queries(io.StringIO(
+            '{"max_price": 200, "min_score": 92.5, "limit": 0}\n'))
+        self.assertEqual([Query(1, 'red', None, 200, 92.5, 0)], queries)
+
+    def test_answer_queries(self) -> None:
+        queries = [Query(1, 'red', None, 100, None, 3),
+                   Query(2, 'red', ["Store 1", "Store 2"], None, 95, None),
+                   Query(3, 'red', "Unknown store", None, None, 3)]
+        rows = list(answer_queries(queries, self.indexes))
+
+        index = self.indexes['red']
+        for query in queries:
+            expected = index.top(query.limit, query.store, query.max_price,
+                                 query.min_score)
+            query_rows = [row for row in rows if row['query'] == query.id]
+            self.assertEqual([str(scoring) for (_, _, scoring) in expected],
+                             [row['gws_wine'] for row in query_rows])
+            self.assertEqual(list(range(1, len(expected) + 1)),
+                             [row['rank'] for row in query_rows])
+            self.assertTrue(all(
+                row['total'] == index.count(query.store, query.max_price,
+                                            query.min_score)
+                for row in query_rows))
+
+    def test_write_results(self) -> None:
+        rows = list(answer_queries([Query(1, 'red', None, None, None, 5)],
+                                   self.indexes))
+        jsonl = io.StringIO()
+        self.assertEqual(5, write_results(rows, jsonl, 'jsonl'))
+        self.assertEqual(rows, [json.loads(line)
+                                for line in jsonl.getvalue().splitlines()])
+
+        csv_file = io.StringIO()
+        self.assertEqual(5, write_results(rows, csv_file, 'csv'))
+        csv_file.seek(0)
+        self.assertEqual([row['product_number'] for row in rows],
+                         [row['product_number']
+                          for row in csv.DictReader(csv_file)])
@@ -0,0 +1,83 @@
+import multiprocessing
+import tempfile
+import unittest
+from pathlib import Path
+
+from src.serving import ServingSnapshot, route_key, serve, \
+    write_serving_snapshot
+
+# Inherited by the forked workers, which report their answers through it
+answers = multiprocessing.Queue()
+
+
+def answer(update: dict, data: dict) -> None:
+    text = update['message']['text']
+    if text == 'fail':
+        raise ValueError(text)
+    answers.put((update['message']['chat']['id'],
+                 multiprocessing.current_process().name, data[text]))
+
+
+def stub_updates(messages):
+    # Stands in for polling Telegram, in the shape of `Update.to_dict()`
+    for update_id, (chat_id, text) in enumerate(messages, start=1):
+        yield {'update_id': update_id,
+               'message': {'message_id': update_id, 'text': text,
+                           'chat': {'id': chat_id, 'type': 'private'}}}
+
+
+class TestServing(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.snapshot_file = Path(self.cache_dir.name) / 'serving.pickle'
+        write_serving_snapshot(self.snapshot_file,
+                               {'red': 'Barolo', 'white': 'Chablis'})
+
+    def tearDown(self) -> None:
+        self.cache_dir.cleanup()
+
+    def answers(self, n: int) -> list:
+        return [answers.get(timeout=10) for _ in range(n)]
+
+    def test_workers_answer_from_snapshot(self) -> None:
+        messages = [(chat_id, text) for chat_id in (11, 12, 13, 14)
+                    for text in ('red', 'white')]
+        serve(stub_updates(messages), self.snapshot_file, answer, workers=3)
+
+        received = self.answers(len(messages))
+        self.assertEqual(sorted((chat_id, {'red': 'Barolo',
+                                           'white': 'Chablis'}[text])
+                                for (chat_id, text) in messages),
+                         sorted((chat_id, wine)
+                                for (chat_id, _, wine) in received))
+        # Every chat is answered by a single worker
+        workers = {}
+        for chat_id, worker, _ in received:
+            self.assertEqual(workers.setdefault(chat_id, worker), worker)
+        self.assertEqual(3, len(set(workers.values())))
+
+    def test_failed_update_does_not_stop_worker(self) -> None:
+        serve(stub_updates([(11, 'fail'), (11, 'red')]), self.snapshot_file,
+              answer, workers=1)
+        self.assertEqual([(11, 'Barolo')],
+                         [(chat_id, wine)
+                          for (chat_id, _, wine) in self.answers(1)])
+
+    def test_snapshot_is_reloaded_once_replaced(self) -> None:
+        snapshot = ServingSnapshot(self.snapshot_file)
+        data = snapshot.get()
+        self.assertIs(data, snapshot.get())
+
+        write_serving_snapshot(self.snapshot_file, {'red': 'Rioja'})
+        self.assertEqual({'red': 'Rioja'}, snapshot.get())
+
+    def test_no_data_before_first_snapshot(self) -> None:
+        snapshot = ServingSnapshot(
+            Path(self.cache_dir.name) / 'missing.pickle')
+        self.assertIsNone(snapshot.get())
+
+    def test_routes_by_chat(self) -> None:
+        update, = stub_updates([(42, 'red')])
+        self.assertEqual(42, route_key(update))
+        self.assertEqual(7, route_key({'update_id': 7}))
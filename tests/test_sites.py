@@ -0,0 +1,45 @@
+import unittest
+import json
+from datetime import date
+from pathlib import Path
+
+from src.sites import SiteDirectory
+
+
+class TestSiteDirectory(unittest.TestCase):
+
+    def setUp(self) -> None:
+        sites_file = Path(__file__).resolve().parent / 'data' / \
+            'sb_all_sites.json'
+        with sites_file.open('r') as file:
+            self.sites = json.load(file)
+        self.directory = SiteDirectory(self.sites + [
+            dict(self.sites[0], Name="Stockholm, Söder"),
+            dict(self.sites[0], Name="Stockholm, Sundbyberg"),
+            dict(self.sites[0], Name=None)])
+
+    def test_lookup_ignores_case_accents_and_punctuation(self) -> None:
+        self.assertEqual(5, len(self.directory))
+        self.assertEqual("Globen",
+                         self.directory.lookup("globen").site['Name'])
+        self.assertEqual("Stockholm, Söder",
+                         self.directory.lookup("stockholm soder").site['Name'])
+        self.assertIsNone(self.directory.lookup("Glob"))
+
+    def test_opening_hours_are_rendered(self) -> None:
+        entry = self.directory.lookup("Gullmarsplan")
+        self.assertEqual("Open from 10:00 until 19:00",
+                         entry.opening_hours[date(2020, 4, 7)])
+        self.assertNotIn(date(2000, 1, 1), entry.opening_hours)
+
+    def test_suggests_completions_first(self) -> None:
+        self.assertEqual(["Stockholm, Söder", "Stockholm, Sundbyberg"],
+                         self.directory.suggest("Stockholm S", n=2))
+        self.assertEqual(["Globen"], self.directory.suggest("GLOB", n=1))
+
+    def test_suggests_similar_names(self) -> None:
+        self.assertEqual(["Gullmarsplan"],
+                         self.directory.suggest("Gulmarsplan"))
+        self.assertEqual("Ringen", self.directory.suggest("Rigen")[0])
+        self.assertEqual([], self.directory.suggest("Kiruna"))
+        self.assertEqual([], self.directory.suggest("..."))
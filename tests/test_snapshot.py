@@ -0,0 +1,80 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from src import snapshot
+from src.globalwinescore import GWS_FIELDS, GlobalWineScore, Scoring
+from src.snapshot import read_snapshot, write_snapshot
+from src.systembolaget import InventoryItem, SystembolagetAPI
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.data_dir = Path(__file__).resolve().parent / 'data'
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.source_file = Path(self.cache_dir.name) / 'gws_red_wines.json'
+        self.snapshot_file = self.source_file.with_suffix('.pickle')
+        shutil.copy(self.data_dir / 'gws_red_wines.json', self.source_file)
+        with self.source_file.open('r') as file:
+            self.scorings = [Scoring(**item)
+                             for item in json.load(file)['results']]
+
+    def tearDown(self) -> None:
+        self.cache_dir.cleanup()
+
+    def test_round_trip(self) -> None:
+        n_rows = write_snapshot(self.snapshot_file, self.scorings, GWS_FIELDS,
+                                count=123)
+        self.assertEqual(len(self.scorings), n_rows)
+
+        metadata, scorings = read_snapshot(self.snapshot_file,
+                                           self.source_file, Scoring)
+        scorings = list(scorings)
+        self.assertEqual({'count': 123}, metadata)
+        self.assertEqual(self.scorings, scorings)
+        self.assertIsInstance(scorings[0], Scoring)
+
+    def test_batches(self) -> None:
+        batch_size, snapshot.BATCH_SIZE = snapshot.BATCH_SIZE, 3
+        try:
+            write_snapshot(self.snapshot_file, self.scorings, GWS_FIELDS)
+        finally:
+            snapshot.BATCH_SIZE = batch_size
+        _, scorings = read_snapshot(self.snapshot_file, self.source_file,
+                                    Scoring)
+        self.assertEqual(self.scorings, list(scorings))
+
+    def test_outdated_snapshot_is_ignored(self) -> None:
+        self.assertIsNone(read_snapshot(self.snapshot_file, self.source_file,
+                                        Scoring))
+
+        write_snapshot(self.snapshot_file, self.scorings, GWS_FIELDS[:-1])
+        self.assertIsNone(read_snapshot(self.snapshot_file, self.source_file,
+                                        Scoring))
+
+        write_snapshot(self.snapshot_file, self.scorings, GWS_FIELDS)
+        source_mtime = self.snapshot_file.stat().st_mtime + 1
+        os.utime(self.source_file, (source_mtime, source_mtime))
+        self.assertIsNone(read_snapshot(self.snapshot_file, self.source_file,
+                                        Scoring))
+
+    def test_used_by_api_clients(self) -> None:
+        gws = GlobalWineScore('api_token')
+        gws._wines_files['red'] = self.source_file
+        write_snapshot(self.snapshot_file, self.scorings[:3], GWS_FIELDS,
+                       count=3)
+        self.assertEqual(self.scorings[:3], gws.get_red_wines())
+
+        systembolaget = SystembolagetAPI('api_token')
+        systembolaget._inventory_file = \
+            Path(self.cache_dir.name) / 'sb_inventory.json'
+        shutil.copy(self.data_dir / 'sb_inventory.json',
+                    systembolaget._inventory_file)
+        inventory = list(systembolaget.get_inventory())
+        write_snapshot(systembolaget._inventory_file.with_suffix('.pickle'),
+                       inventory[:1], InventoryItem._fields)
+        self.assertEqual(inventory[:1], list(systembolaget.get_inventory()))
@@ -0,0 +1,70 @@
+import unittest
+
+from src.recommender import assign_scorings
+from src.stats import Stats, stats
+from tests import test_recommender
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.stats = Stats()
+        self.stats.enable()
+
+    def test_disabled_by_default(self) -> None:
+        disabled = Stats()
+        disabled.enabled = False
+        with disabled.timed("timer"):
+            pass
+        disabled.count("counter")
+        self.assertEqual("No stats recorded", disabled.report())
+
+    def test_timers_and_counters(self) -> None:
+        for seconds in range(1, 101):
+            self.stats.record("timer", seconds / 1000)
+        with self.stats.timed("timer"):
+            pass
+        self.stats.count("counter", 3)
+        self.stats.count("counter")
+
+        report = self.stats.report().splitlines()
+        self.assertEqual("counter: 4", report[1])
+        self.assertTrue(report[0].startswith("timer: n=101 total=5.050s"))
+        self.assertIn("p50=50.0ms", report[0])
+        self.assertIn("p99=99.0ms", report[0])
+
+    def test_timed_iter(self) -> None:
+        items = list(self.stats.timed_iter("iter", range(3)))
+        self.assertEqual([0, 1, 2], items)
+        self.assertIn("iter: n=1", self.stats.report())
+
+    def test_timed_function(self) -> None:
+        @self.stats.timed_function("function")
+        def function(x):
+            return 2 * x
+
+        self.assertEqual(4, function(2))
+        self.assertIn("function: n=1", self.stats.report())
+
+
+class TestMatchingStats(unittest.TestCase):
+
+    def setUp(self) -> None:
+        test_recommender.TestRedWineRecommendations.setUp(self)
+        stats.enable()
+        stats.reset()
+
+    def tearDown(self) -> None:
+        stats.enabled = False
+        stats.reset()
+
+    def test_bucket_stats(self) -> None:
+        other_scoring = self.scoring._replace(wine="Another wine")
+        for workers in (None, 2):
+            stats.reset()
+            list(assign_scorings([self.inventory_item],
+                                 [self.scoring, other_scoring],
+                                 top_k=None, workers=workers))
+            report = stats.report()
+            self.assertIn("match bucket: n=1", report)
+            self.assertIn("match comparisons: 2", report)
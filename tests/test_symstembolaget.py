@@ -1,8 +1,22 @@
 import unittest
+import gzip
+import io
 import json
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
-from src.systembolaget import InventoryItem, SystembolagetAPI
+from requests import HTTPError, Timeout
+
+from src.systembolaget import InventoryItem, SystembolagetAPI, \
+    iter_json_array
+
+DATA_DIR = Path(__file__).resolve().parent / 'data'
 
 
 class TestInventoryItem(unittest.TestCase):
@@ -55,6 +69,7 @@ class TestInventoryItem(unittest.TestCase):
 
     def test_object_attributes(self) -> None:
         self.assertTrue(self.inventory_item.is_red_wine())
+        self.assertEqual('red', self.inventory_item.color())
         self.assertTrue(self.inventory_item.get_url().startswith('https://'))
         self.assertEqual('Usa', self.inventory_item.get_country())
 
@@ -76,11 +91,201 @@ class TestSystembolaget(unittest.TestCase):
         red_wines = list(self.systembolaget.get_red_wines())
         self.assertEqual(1, len(red_wines))
 
+    def test_get_wines_by_color(self) -> None:
+        wines = self.systembolaget.get_wines_by_color()
+        self.assertEqual(['red', 'white', 'rose'], list(wines))
+        self.assertEqual(list(self.systembolaget.get_red_wines()),
+                         wines['red'])
+        self.assertEqual([], wines['white'])
+
     def test_get_sites(self) -> None:
         sites = list(self.systembolaget.get_sites())
         self.assertEqual(3, len(sites))
 
 
+class TestStreamingJson(unittest.TestCase):
+
+    def setUp(self) -> None:
+        inventory_file = Path(__file__).resolve().parent / 'data' / \
+            'sb_inventory.json'
+        with inventory_file.open('r') as file:
+            self.inventory = json.load(file)
+
+    def test_identical_to_json_load(self) -> None:
+        for indent in (None, 2):
+            document = json.dumps(self.inventory, indent=indent)
+            for chunk_size in (1, 7, 4096):
+                self.assertEqual(self.inventory, list(iter_json_array(
+                    io.StringIO(document), chunk_size)))
+
+    def test_scalars_and_empty_array(self) -> None:
+        self.assertEqual([], list(iter_json_array(io.StringIO(' [ ] '))))
+        self.assertEqual([12345, "a]b", None], list(iter_json_array(
+            io.StringIO('[12345, "a]b",null]'), chunk_size=2)))
+
+    def test_truncated_document(self) -> None:
+        document = json.dumps(self.inventory)[:-10]
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_json_array(io.StringIO(document), chunk_size=16))
+
+    def test_lower_peak_memory_than_json_load(self) -> None:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            inventory_file = Path(cache_dir) / 'sb_inventory.json'
+            with inventory_file.open('w') as file:
+                json.dump(self.inventory * 1000, file, indent=2)
+
+            systembolaget = SystembolagetAPI('api_token')
+            systembolaget._inventory_file = inventory_file
+
+            tracemalloc.start()
+            with inventory_file.open('r') as file:
+                for item in json.load(file):
+                    InventoryItem(**item)
+            _, json_load_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            tracemalloc.start()
+            for _ in systembolaget.get_inventory():
+                pass
+            _, streaming_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        self.assertLess(streaming_peak * 10, json_load_peak)
+
+
+class StubSystembolagetHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        self.server.requests.append(
+            (self.path, self.headers.get('Accept-Encoding', '')))
+        time.sleep(self.server.latency)
+        body = self.server.bodies.get(self.path)
+        if body is None or self.path in self.server.failures:
+            self.send_response(500 if body else 404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        etag = f'"{sha1(body).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            # The client timed out
+            pass
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class TestPrefetch(unittest.TestCase):
+    LATENCY = 0.5
+
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          StubSystembolagetHandler)
+        self.server.requests, self.server.failures = [], set()
+        self.server.latency = self.LATENCY
+        self.server.bodies = {
+            f"/{path}": (DATA_DIR / file_name).read_bytes()
+            for (path, file_name) in (
+                ('site/v1/site', 'sb_all_sites.json'),
+                ('product/v1/product/', 'sb_inventory.json'),
+                ('product/v1/product/getproductswithstore',
+                 'sb_all_sites.json'))}
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+        self.cache_dir = tempfile.TemporaryDirectory()
+        cache_dir = Path(self.cache_dir.name)
+        self.systembolaget = SystembolagetAPI('api_token')
+        self.systembolaget._api_url = \
+            f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.systembolaget._all_sites_file = cache_dir / 'sites.json'
+        self.systembolaget._inventory_file = cache_dir / 'inventory.json'
+        self.systembolaget._products_with_stores_file = \
+            cache_dir / 'products_with_store.json'
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache_dir.cleanup()
+
+    def test_downloads_endpoints_in_parallel(self) -> None:
+        start = time.perf_counter()
+        self.systembolaget.prefetch_all()
+        self.assertLess(time.perf_counter() - start, 2 * self.LATENCY)
+        self.assertEqual(3, len(self.server.requests))
+        self.assertTrue(all('gzip' in encoding
+                            for (_, encoding) in self.server.requests))
+
+        self.assertEqual(self.server.bodies['/site/v1/site'],
+                         self.systembolaget._all_sites_file.read_bytes())
+        self.assertEqual(2, len(list(self.systembolaget.get_inventory())))
+        self.assertTrue(SystembolagetAPI._snapshot_file(
+            self.systembolaget._inventory_file).is_file())
+
+        # Everything is cached now
+        self.systembolaget.prefetch_all()
+        self.assertEqual(3, len(list(self.systembolaget.get_sites())))
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_failed_download_leaves_no_file(self) -> None:
+        self.server.failures.add('/product/v1/product/')
+        with self.assertRaises(HTTPError):
+            self.systembolaget.prefetch_all()
+        self.assertEqual([], [path.name for path in
+                              Path(self.cache_dir.name).iterdir()
+                              if path.suffix != '.json'])
+        self.assertFalse(self.systembolaget._inventory_file.exists())
+        self.assertTrue(self.systembolaget._all_sites_file.is_file())
+
+    def test_times_out(self) -> None:
+        self.systembolaget.TIMEOUT = (1, self.LATENCY / 5)
+        with self.assertRaises(Timeout):
+            self.systembolaget.prefetch_all()
+        self.assertEqual([], list(Path(self.cache_dir.name).iterdir()))
+
+    def test_revalidates_stale_files(self) -> None:
+        self.server.latency = 0
+        self.systembolaget.prefetch_all()
+        cache_files = (self.systembolaget._all_sites_file,
+                       self.systembolaget._inventory_file,
+                       SystembolagetAPI._snapshot_file(
+                           self.systembolaget._inventory_file),
+                       self.systembolaget._products_with_stores_file)
+        modified = [path.stat().st_mtime_ns for path in cache_files]
+
+        self.systembolaget.MAX_AGE = dict.fromkeys(
+            SystembolagetAPI.MAX_AGE, timedelta(0))
+        self.server.requests.clear()
+        self.systembolaget.prefetch_all()
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(modified,
+                         [path.stat().st_mtime_ns for path in cache_files])
+
+        # Only the changed endpoint is downloaded again
+        self.server.bodies['/site/v1/site'] = b'[]'
+        self.systembolaget.prefetch_all()
+        self.assertEqual([], list(self.systembolaget.get_sites()))
+        self.assertEqual(modified[1:], [path.stat().st_mtime_ns
+                                        for path in cache_files[1:]])
+
+
 class TestParsingOpeningHours(unittest.TestCase):
 
     def test_open(self) -> None:
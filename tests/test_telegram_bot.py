@@ -0,0 +1,270 @@
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+from itertools import islice
+from pathlib import Path
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+from telegram.utils.request import Request
+
+from src import matching, telegram_bot
+from src.availability import AvailabilityMatrix
+from src.globalwinescore import COLORS
+from src.recommender import RecommendationIndex
+from src.revalidation import write_metadata
+from src.serving import serve, write_serving_snapshot
+from src.sites import SiteDirectory
+from src.stats import stats
+
+DATA_DIR = Path(__file__).resolve().parent / 'data'
+
+# Inherited by the forked workers, which report the messages they send
+# through it
+replies = multiprocessing.Queue()
+
+
+class StubRequest(Request):
+    # Answers the Telegram Bot API calls without any network and keeps the
+    # texts of the messages sent
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def get(self, url, timeout=None):
+        if url.endswith('/getMyCommands'):
+            return []
+        return {'id': 1, 'is_bot': True, 'first_name': "Bot",
+                'username': 'SystembolagetBot'}
+
+    def post(self, url, data, timeout=None):
+        self.sent.append(data.get('text'))
+        return {'message_id': len(self.sent), 'date': 0,
+                'chat': {'id': data['chat_id'], 'type': 'private'},
+                'text': data.get('text')}
+
+
+class QueueRequest(StubRequest):
+
+    def post(self, url, data, timeout=None):
+        replies.put((data['chat_id'], data.get('text')))
+        return super().post(url, data, timeout)
+
+
+def command(text: str, chat_id: int = 5) -> dict:
+    return {'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'text': text,
+        'entities': [{'type': 'bot_command', 'offset': 0,
+                      'length': len(text.split()[0])}],
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': "User"}}}
+
+
+def preloaded() -> telegram_bot.Preloaded:
+    # The fixture sites without any recommendations
+    with (DATA_DIR / 'sb_all_sites.json').open('r') as file:
+        sites = json.load(file)
+    return telegram_bot.Preloaded(sites, SiteDirectory(sites), None, {
+        color: RecommendationIndex([], AvailabilityMatrix({}))
+        for color in ('red', 'white', 'rose')})
+
+
+class TestWarmingUp(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.app = telegram_bot.app = telegram_bot.WineToDine()
+        self.request = StubRequest()
+        self.dispatcher = Dispatcher(Bot('123:abc', request=self.request),
+                                     None, use_context=True)
+        telegram_bot.add_handlers(self.dispatcher)
+
+    def tearDown(self) -> None:
+        telegram_bot.app = None
+
+    def send(self, text: str) -> list:
+        self.request.sent.clear()
+        self.dispatcher.process_update(
+            Update.de_json(command(text), self.dispatcher.bot))
+        return self.request.sent
+
+    def warm_up(self) -> None:
+        self.app.preloaded = preloaded()
+
+    def test_cheap_commands_are_answered_while_warming_up(self) -> None:
+        self.assertEqual([telegram_bot.HELP_MSG], self.send('/help'))
+        self.assertEqual([telegram_bot.START_MSG], self.send('/start'))
+
+    def test_data_commands_reply_warming_up(self) -> None:
+        for text in ('/recommend_red_wines 200', '/recommend_rose_wines',
+                     '/set_store Globen'):
+            self.assertEqual([telegram_bot.WARMING_UP_MSG], self.send(text))
+
+    def test_data_commands_are_answered_once_warmed_up(self) -> None:
+        self.warm_up()
+        self.assertEqual(
+            ["Top 0 out of 0 rosé wines available _online_ with max price "
+             "of SEK 100:"], self.send('/recommend_rose_wines 100'))
+
+    def test_misspelled_store_gets_suggestions(self) -> None:
+        self.warm_up()
+        self.assertEqual(["Store name 'Gulmarsplan' not recognised, did you "
+                          "mean any of these?"],
+                         self.send('/set_store Gulmarsplan'))
+        self.assertEqual(["Store name 'Kiruna' not recognised, please try "
+                          "again."], self.send('/set_store Kiruna'))
+
+    def test_store_is_set_with_opening_hours(self) -> None:
+        self.warm_up()
+        sent = self.send('/set_store ringen')
+        self.assertEqual("Great! Now I'm only going to suggest inventory "
+                         "items available at 'Ringen'.", sent[0])
+        self.assertEqual("Today (1970-01-01): Opening hours unknown\n"
+                         "Tomorrow: Opening hours unknown", sent[-1])
+
+    def test_stats_of_a_worker_are_labelled(self) -> None:
+        with unittest.mock.patch.object(telegram_bot, 'BOT_WORKERS', 2), \
+                unittest.mock.patch.object(telegram_bot, 'ADMIN_USER_IDS',
+                                           {5}), \
+                unittest.mock.patch.object(stats, 'enabled', True):
+            sent, = self.send('/stats')
+        self.assertTrue(sent.startswith(
+            f"Stats of worker process {os.getpid()} only:\n"))
+
+
+class TestWorkers(unittest.TestCase):
+    # Drives the bot's handlers in worker processes, as with BOT_WORKERS
+
+    def setUp(self) -> None:
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.snapshot_file = Path(self.cache_dir.name) / 'serving.pickle'
+        # Created before the workers are forked, instead of by the first
+        # update in each of them, so that they send with the stub request
+        telegram_bot.app = telegram_bot.WineToDine()
+        telegram_bot.worker_dispatcher = Dispatcher(
+            Bot('123:abc', request=QueueRequest()), None, use_context=True)
+        telegram_bot.add_handlers(telegram_bot.worker_dispatcher)
+
+    def tearDown(self) -> None:
+        telegram_bot.app = telegram_bot.worker_dispatcher = None
+        self.cache_dir.cleanup()
+
+    def serve(self, *updates: dict) -> list:
+        serve(updates, self.snapshot_file, telegram_bot.handle_in_worker,
+              workers=2)
+        return sorted(replies.get(timeout=10) for _ in updates)
+
+    def test_workers_answer_from_snapshot(self) -> None:
+        write_serving_snapshot(self.snapshot_file, preloaded())
+        self.assertEqual(
+            [(11, telegram_bot.HELP_MSG),
+             (12, "Top 0 out of 0 rosé wines available _online_ with max "
+                  "price of SEK 100:")],
+            self.serve(command('/help', 11),
+                       command('/recommend_rose_wines 100', 12)))
+
+    def test_workers_warm_up_until_first_snapshot(self) -> None:
+        self.assertEqual(
+            [(11, telegram_bot.START_MSG), (12, telegram_bot.WARMING_UP_MSG)],
+            self.serve(command('/start', 11),
+                       command('/recommend_red_wines', 12)))
+
+
+class StubBot:
+    # Returns one batch of updates per call to getUpdates
+
+    def __init__(self, *batches):
+        self.batches = iter(batches)
+        self.offsets = []
+
+    def get_updates(self, offset=None, timeout=None):
+        self.offsets.append(offset)
+        return [Update(update_id) for update_id in next(self.batches)]
+
+
+class TestPollUpdates(unittest.TestCase):
+
+    def test_updates_are_confirmed_by_offset(self) -> None:
+        bot = StubBot([1, 2], [], [3])
+        self.assertEqual(
+            [{'update_id': 1}, {'update_id': 2}, {'update_id': 3}],
+            list(islice(telegram_bot.poll_updates(bot), 3)))
+        self.assertEqual([None, 3, 3], bot.offsets)
+
+
+class TestLoadData(unittest.TestCase):
+    # Loads the data from fixture cache files, all fresh, so that nothing is
+    # downloaded
+
+    def setUp(self) -> None:
+        self.cache_dir = tempfile.TemporaryDirectory()
+        cache_dir = Path(self.cache_dir.name)
+        patcher = unittest.mock.patch.object(matching, 'CACHE_DIR', cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.app = telegram_bot.WineToDine()
+        sb, gws = self.app.sb, self.app.gws
+        sb._all_sites_file = cache_dir / 'systembolaget_all_sites.json'
+        sb._inventory_file = cache_dir / 'systembolaget_inventory.json'
+        sb._products_with_stores_file = \
+            cache_dir / 'systembolaget_products_with_store.json'
+        gws._wines_files = {color: cache_dir / f'gws_{color}_wines.json'
+                            for color in COLORS}
+
+        shutil.copy(DATA_DIR / 'sb_all_sites.json', sb._all_sites_file)
+        with (DATA_DIR / 'sb_inventory.json').open('r') as file:
+            inventory = json.load(file)
+        # Scored as 'Masseto, Toscana' 2015 in the GWS fixture
+        inventory.append(dict(
+            inventory[-1], ProductNumber='123456', ProductNameBold="Masseto",
+            ProductNameThin="Toscana", ProducerName="", Vintage=2015))
+        with sb._inventory_file.open('w') as file:
+            json.dump(inventory, file)
+        with sb._products_with_stores_file.open('w') as file:
+            json.dump([{'SiteId': '0170', 'Products': [
+                {'ProductNumber': '123456'}]}], file)
+
+        shutil.copy(DATA_DIR / 'gws_red_wines.json', gws._wines_files['red'])
+        # No white or rosé wine scores at all
+        for color in ('white', 'rose'):
+            with gws._wines_files[color].open('w') as file:
+                json.dump({'count': 0, 'results': []}, file)
+
+        for cache_file in (sb._all_sites_file, sb._inventory_file,
+                           sb._products_with_stores_file,
+                           *gws._wines_files.values()):
+            write_metadata(cache_file)
+
+    def tearDown(self) -> None:
+        self.cache_dir.cleanup()
+
+    def test_load_data(self) -> None:
+        preloaded = self.app.load_data()
+        self.assertEqual(set(COLORS), set(preloaded.recommendation_indexes))
+        indexes = preloaded.recommendation_indexes
+        (masseto, _, _), = indexes['red'].top(None, 'Globen')
+        self.assertEqual("Masseto", masseto.ProductNameBold)
+        self.assertEqual(0, len(indexes['white']))
+        globen = preloaded.site_directory.lookup('globen')
+        self.assertEqual('Globen', globen.site['Name'])
+
+    def test_refresh_swaps_data(self) -> None:
+        self.app.preloaded = old = self.app.load_data()
+        self.app.refresh_data(None)
+        self.assertIsNot(old, self.app.preloaded)
+        self.assertEqual(
+            len(old.recommendation_indexes['red']),
+            len(self.app.preloaded.recommendation_indexes['red']))
+
+    def test_failed_refresh_keeps_data(self) -> None:
+        self.app.preloaded = old = self.app.load_data()
+        with unittest.mock.patch.object(self.app.sb, 'get_sites',
+                                        side_effect=OSError("unreachable")), \
+                self.assertLogs('TelegramBot', 'ERROR'):
+            self.app.refresh_data(None)
+        self.assertIs(old, self.app.preloaded)